@@ -1,10 +1,20 @@
+import re
+import time
+from copy import copy
+
 from django.template import loader
 from django.utils.datastructures import MultiValueDict
 from django.utils.encoding import smart_str
+from django.utils.safestring import mark_safe
 from django.core.cache import cache
+from django.core.cache.backends.dummy import DummyCache
+from django.contrib.contenttypes.models import ContentType
+from django.db.models.signals import post_save, post_delete, m2m_changed
+from django.dispatch import receiver
 from django.conf import settings
 
-from ella.core.cache.utils import normalize_key
+from ella.core.cache.utils import normalize_key, get_cached_objects, SKIP, \
+        start_tracking, stop_tracking, track_dependency
 from ella.core.conf import core_settings
 
 
@@ -94,18 +104,20 @@ class Box(object):
                 'box' : self,
         }
 
+    def needs_double_render(self, context):
+        return getattr(settings, 'DOUBLE_RENDER', False) and self.can_double_render and 'SECOND_RENDER' not in context
+
     def render(self, context):
         self.prepare(context)
         " Cached wrapper around self._render(). "
-        if getattr(settings, 'DOUBLE_RENDER', False) and self.can_double_render:
-            if 'SECOND_RENDER' not in context:
-                return self.double_render()
+        if self.needs_double_render(context):
+            return self.double_render()
         key = self.get_cache_key()
         if key:
-            rend = cache.get(key)
+            rend = get_boxes([key]).get(key)
             if rend is None:
-                rend = self._render(context)
-                cache.set(key, rend, core_settings.CACHE_TIMEOUT)
+                rend, deps = self._render_tracked(context)
+                store_boxes({key: (rend, deps)})
         else:
             rend = self._render(context)
         return rend
@@ -153,6 +165,20 @@ class Box(object):
         context.pop()
         return resp
 
+    def _render_tracked(self, context):
+        """
+        Render the box and return the output along with the set of objects
+        it depends on - the target and everything retrieved from cache during
+        the rendering, including nested boxes.
+        """
+        start_tracking()
+        try:
+            track_dependency(ContentType.objects.get_for_model(self.obj).pk, self.obj.pk)
+            rend = self._render(context)
+        finally:
+            deps = stop_tracking()
+        return rend, deps
+
     def get_cache_key(self):
         " Return a cache key constructed from the box's parameters. "
         if self.params:
@@ -163,3 +189,186 @@ class Box(object):
                 settings.SITE_ID, self.obj.__class__.__name__, str(self.box_type), self.obj.pk, pars
             ))
 
+
+
+class BoxBatch(object):
+    """
+    Batch of boxes rendered within one ``{% prefetchboxes %}`` block.
+
+    Targets of the boxes are fetched up front by one call to
+    ``get_cached_objects``, the boxes themselves only leave a placeholder in
+    the output. When the whole block is rendered, all the fragments are
+    retrieved by one ``get_boxes``, the missing ones are rendered and stored
+    back by one ``store_boxes`` and the placeholders are replaced.
+    """
+    def __init__(self):
+        self.active = True
+        self.objects = {}
+        self.boxes = []
+        self.placeholder = u'<!--ella-box:%d:%%d-->' % id(self)
+        self.placeholder_re = re.compile(u'<!--ella-box:%d:(\\d+)-->' % id(self))
+
+    def prefetch(self, lookups):
+        """
+        Fetch the targets given as a list of ``(content_type_id, pk)`` tuples,
+        they are then available via ``get_object``.
+        """
+        for obj in get_cached_objects(lookups, missing=SKIP):
+            self.objects[(obj.__class__, smart_str(obj.pk))] = obj
+
+    def get_object(self, model, pk):
+        return self.objects.get((model, smart_str(pk)))
+
+    def defer(self, box, context):
+        " Return a placeholder that will be replaced by the rendered ``box``. "
+        if box.needs_double_render(context):
+            return box.render(context)
+
+        box.prepare(context)
+        key = box.get_cache_key()
+        if not key:
+            return box._render(context)
+
+        # context will change before the box is rendered, the for tag for
+        # example modifies the topmost dict in place
+        c = copy(context)
+        c.dicts = [d.copy() for d in context.dicts]
+        self.boxes.append((box, key, c))
+        return self.placeholder % (len(self.boxes) - 1)
+
+    def finish(self, output):
+        " Render the deferred boxes and put them into ``output``. "
+        self.active = False
+        if not self.boxes:
+            return output
+
+        fragments = get_boxes(set(key for box, key, c in self.boxes))
+        rendered = []
+        to_set = {}
+        for box, key, c in self.boxes:
+            if key not in fragments:
+                to_set[key] = box._render_tracked(c)
+                fragments[key] = to_set[key][0]
+            rendered.append(fragments[key])
+
+        if to_set:
+            store_boxes(to_set)
+
+        return mark_safe(self.placeholder_re.sub(lambda m: rendered[int(m.group(1))], output))
+
+
+DEPS_KEY_PREFIX = 'core.box.deps'
+
+def _get_deps_key(ct_id, pk):
+    return ':'.join((DEPS_KEY_PREFIX, str(ct_id), smart_str(pk)))
+
+def get_boxes(keys):
+    """
+    Return a dict mapping cache keys of rendered boxes to their output for
+    the boxes found in the cache and still valid.
+    """
+    found = cache.get_many(keys)
+    gens, current = {}, {}
+    for value in found.values():
+        if isinstance(value, tuple):
+            gens.update(value[1])
+    if gens:
+        # the box depends on an object with an overflowed index
+        current = cache.get_many(gens.keys())
+
+    out = {}
+    for key, value in found.items():
+        if isinstance(value, tuple):
+            value, box_gens = value
+            if any(current.get(dkey) != gen for dkey, gen in box_gens.items()):
+                continue
+        out[key] = value
+    return out
+
+def store_boxes(boxes):
+    """
+    Store rendered boxes in the cache and remember which boxes depend on
+    which objects.
+
+    Every object has an index of the boxes depending on it. Once the index
+    would grow over ``BOX_DEPENDENCY_INDEX_LIMIT`` keys (it has to fit into
+    a single cache entry), it is replaced by a generation that the dependent
+    boxes store along with their output and check when retrieved.
+
+    The update of the index is not atomic - a box rendered concurrently by
+    another process can get lost from the index. Such box is not deleted
+    when the object changes and lives for ``CACHE_TIMEOUT_BOX``.
+
+    Params:
+        boxes - dict mapping cache key of a rendered box to a tuple of its
+                output and a set of (content_type_id, pk) tuples
+    """
+    index = {}
+    for key, (rend, objs) in boxes.items():
+        for ct_id, pk in objs:
+            index.setdefault(_get_deps_key(ct_id, pk), set()).add(key)
+
+    gens = {}
+    to_delete = set()
+    current = cache.get_many(index.keys())
+    for dkey, keys in index.items():
+        old = current.get(dkey, set())
+        if not isinstance(old, set):
+            gens[dkey] = old
+        elif len(old | keys) > core_settings.BOX_DEPENDENCY_INDEX_LIMIT:
+            # boxes from the old index don't check the generation
+            to_delete.update(old)
+            gens[dkey] = time.time()
+        else:
+            keys.update(old)
+
+    data = dict(index)
+    data.update(gens)
+    for key, (rend, objs) in boxes.items():
+        box_gens = {}
+        for ct_id, pk in objs:
+            dkey = _get_deps_key(ct_id, pk)
+            if dkey in gens:
+                box_gens[dkey] = gens[dkey]
+        data[key] = box_gens and (rend, box_gens) or rend
+
+    to_delete.difference_update(boxes.keys())
+    if to_delete:
+        cache.delete_many(list(to_delete))
+
+    kw = {}
+    if not isinstance(cache, DummyCache):
+        kw['timeout'] = core_settings.CACHE_TIMEOUT_BOX
+    cache.set_many(data, **kw)
+
+def invalidate_dependencies(objs):
+    """
+    Delete all rendered boxes depending on any of the objects given as
+    (content_type_id, pk) tuples. Deleting the index also changes the
+    generation of objects whose index overflowed.
+    """
+    dkeys = [_get_deps_key(ct_id, pk) for ct_id, pk in objs]
+    keys = set(dkeys)
+    for box_keys in cache.get_many(dkeys).values():
+        if isinstance(box_keys, set):
+            keys.update(box_keys)
+    cache.delete_many(list(keys))
+
+def _get_model_keys(model, pk):
+    # saving a subclass (Article) also changes the parent (Publishable)
+    return [(ContentType.objects.get_for_model(m).pk, pk) for m in [model] + list(model._meta.get_parent_list())]
+
+@receiver(post_save)
+@receiver(post_delete)
+def invalidate_boxes(sender, instance, **kwargs):
+    invalidate_dependencies(_get_model_keys(sender, instance.pk))
+
+@receiver(m2m_changed)
+def invalidate_boxes_on_m2m(sender, instance, action, model, pk_set, **kwargs):
+    if action not in ('post_add', 'post_remove', 'post_clear'):
+        return
+
+    objs = _get_model_keys(instance.__class__, instance.pk)
+    for pk in pk_set or ():
+        objs.extend(_get_model_keys(model, pk))
+    invalidate_dependencies(objs)
@@ -1,9 +1,13 @@
 from __future__ import absolute_import
 
+import os
+import atexit
 import logging
+import threading
 import time
 from datetime import datetime, date, timedelta
-from hashlib import md5
+from hashlib import md5, sha1
+from zlib import crc32
 
 from django.conf import settings
 from django.db.models.loading import get_model
@@ -15,6 +19,11 @@ log = logging.getLogger('ella.core')
 
 client = None
 
+try:
+    from redis.exceptions import ResponseError, InvalidResponse
+except ImportError:
+    ResponseError = InvalidResponse = None
+
 if hasattr(settings, 'LISTINGS_REDIS'):
     try:
         from redis import Redis
@@ -24,80 +33,153 @@ if hasattr(settings, 'LISTINGS_REDIS'):
     else:
         client = Redis(**getattr(settings, 'LISTINGS_REDIS'))
 
-def publishable_published(publishable, **kwargs):
-    pipe = client.pipeline()
-    for l in publishable.listing_set.all():
-        RedisListingHandler.add_publishable(
-            l.category,
-            publishable,
-            repr(time.mktime(l.publish_from.timetuple())),
-            pipe=pipe,
-            commit=False
-        )
-    pipe.execute()
-
-def publishable_unpublished(publishable, **kwargs):
-    pipe = client.pipeline()
-    for l in publishable.listing_set.all():
-        RedisListingHandler.remove_publishable(
-            l.category,
-            publishable,
-            pipe=pipe,
-            commit=False
-        )
-    pipe.execute()
+def _listing_score(listing):
+    return repr(time.mktime(listing.publish_from.timetuple()))
+
+def publishable_published(publishable, bulk=False, **kwargs):
+    # handled by publishables_published
+    if bulk:
+        return
+    RedisListingHandler.add_publishables(
+        [(l.category, publishable, _listing_score(l)) for l in publishable.listing_set.all()]
+    )
+
+def publishable_unpublished(publishable, bulk=False, **kwargs):
+    if bulk:
+        return
+    RedisListingHandler.remove_publishables(
+        [(l.category, publishable) for l in publishable.listing_set.all()]
+    )
+
+def _get_listings(publishables):
+    Listing = get_model('core', 'listing')
+    publishables = dict((p.pk, p) for p in publishables)
+    return [(l, publishables[l.publishable_id]) for l in Listing.objects.filter(publishable__in=publishables.keys())]
+
+def publishables_published(publishables, **kwargs):
+    RedisListingHandler.add_publishables(
+        [(l.category, p, _listing_score(l)) for l, p in _get_listings(publishables)]
+    )
+
+def publishables_unpublished(publishables, **kwargs):
+    RedisListingHandler.remove_publishables(
+        [(l.category, p) for l, p in _get_listings(publishables)]
+    )
 
 def listing_pre_delete(sender, instance, **kwargs):
     # prepare redis pipe for deletion...
-    instance.__pipe = RedisListingHandler.remove_publishable(
-        instance.category,
-        instance.publishable,
+    instance.__pipe = RedisListingHandler.remove_publishables(
+        [(instance.category, instance.publishable)],
         commit=False
     )
 
 def listing_post_delete(sender, instance, **kwargs):
     # but only delete it if the model delete went through
-    pipe = instance.__pipe
-    for l in instance.publishable.listing_set.all():
-        RedisListingHandler.add_publishable(
-            l.category,
-            instance.publishable,
-            repr(time.mktime(l.publish_from.timetuple())),
-            pipe=pipe,
-            commit=False
-        )
-    pipe.execute()
+    RedisListingHandler.add_publishables(
+        [(l.category, instance.publishable, _listing_score(l)) for l in instance.publishable.listing_set.all()],
+        pipe=instance.__pipe
+    )
 
 def listing_pre_save(sender, instance, **kwargs):
     if instance.pk:
         # prepare deletion of stale data
         old_listing = instance.__class__.objects.get(pk=instance.pk)
-        instance.__pipe = RedisListingHandler.remove_publishable(
-            old_listing.category,
-            old_listing.publishable,
+        instance.__pipe = RedisListingHandler.remove_publishables(
+            [(old_listing.category, old_listing.publishable)],
             commit=False
         )
 
 def listing_post_save(sender, instance, **kwargs):
     pipe = getattr(instance, '__pipe', None)
     if instance.publishable.is_published():
-        pipe = RedisListingHandler.add_publishable(
-            instance.category,
-            instance.publishable,
-            repr(time.mktime(instance.publish_from.timetuple())),
+        pipe = RedisListingHandler.add_publishables(
+            [(instance.category, instance.publishable, _listing_score(instance))],
             pipe=pipe,
             commit=False
         )
     if pipe:
         pipe.execute()
 
+# KEYS: result key, category key, content type keys...
+# ARGV: max score, min score, offset, count, excluded value, ttl of result key,
+#       whether to rebuild the result key
+# returns total count and the requested window with scores
+LISTING_SCRIPT = '''
+local function num(v)
+    if v == '+inf' then return math.huge end
+    if v == '-inf' then return -math.huge end
+    return tonumber(v)
+end
+
+local key = KEYS[2]
+if #KEYS > 2 then
+    -- intersect category with union of content types
+    key = KEYS[1]
+    if ARGV[7] == '1' or redis.call('EXISTS', key) == 0 then
+        local args = {key, #KEYS - 2}
+        for i = 3, #KEYS do
+            args[#args + 1] = KEYS[i]
+        end
+        args[#args + 1] = 'AGGREGATE'
+        args[#args + 1] = 'MAX'
+        redis.call('ZUNIONSTORE', unpack(args))
+        redis.call('ZINTERSTORE', key, 2, key, KEYS[2], 'AGGREGATE', 'MAX')
+        redis.call('EXPIRE', key, ARGV[6])
+    end
+end
+
+local max, min = ARGV[1], ARGV[2]
+local offset, count = tonumber(ARGV[3]), tonumber(ARGV[4])
+local total = redis.call('ZCOUNT', key, min, max)
+local fetch = count
+
+-- skip excluded value by rank arithmetic instead of copying the set
+local exclude = ARGV[5]
+if exclude ~= '' then
+    local score = redis.call('ZSCORE', key, exclude)
+    if score and num(score) <= num(max) and num(score) >= num(min) then
+        total = total - 1
+        local rank = redis.call('ZREVRANK', key, exclude)
+        if max ~= '+inf' then
+            rank = rank - redis.call('ZCOUNT', key, '(' .. max, '+inf')
+        end
+        if rank < offset then
+            offset = offset + 1
+        elseif rank < offset + count then
+            fetch = count + 1
+        end
+    end
+end
+
+local items = {}
+if count > 0 then
+    local result = redis.call('ZREVRANGEBYSCORE', key, max, min, 'WITHSCORES', 'LIMIT', offset, fetch)
+    for i = 1, #result, 2 do
+        if result[i] ~= exclude then
+            items[#items + 1] = result[i]
+            items[#items + 1] = result[i + 1]
+        end
+    end
+end
+return {total, items}
+'''
+LISTING_SCRIPT_SHA = sha1(LISTING_SCRIPT).hexdigest()
+
 class RedisListingHandler(ListingHandler):
     PREFIX = 'listing'
 
+    # compute the whole listing in one round trip using a Lua script
+    # (requires redis 2.6), fall back to pipelines with temporary keys
+    USE_LUA = True
+    RESULT_KEY_TIMEOUT = 60
+
     @classmethod
     def get_value(cls, publishable):
         return ':'.join((str(publishable.content_type_id), str(publishable.pk)))
 
+    # maximum number of members sent in one ZADD/ZREM command
+    CHUNK_SIZE = 1000
+
     @classmethod
     def get_keys(cls, category, publishable):
         # main category
@@ -117,8 +199,9 @@ class RedisListingHandler(ListingHandler):
             keys.append(':'.join((cls.PREFIX, 'c', str(category.tree_parent_id))))
 
         # all children
+        Category = get_model('core', 'category')
         while category.tree_parent_id:
-            category = category.tree_parent
+            category = Category.objects.get_parent(category)
             keys.append(':'.join((cls.PREFIX, 'd', str(category.id))))
             if not category.app_data.get('ella', {}).get('propagate_listings', True):
                 break
@@ -126,12 +209,53 @@ class RedisListingHandler(ListingHandler):
         return keys
 
     @classmethod
-    def add_publishable(cls, category, publishable, score, pipe=None, commit=True):
+    def _store_keys(cls, keys, pipe):
+        " Hook called with all the keys a batch of publishables is written to. "
+        pass
+
+    @classmethod
+    def _fan_out(cls, items, pipe):
+        """
+        Map ``(category, publishable, ...)`` tuples to ``{key: {value: [items]}}``,
+        keys for each category and content type are only computed once.
+        """
+        keys_cache = {}
+        out = {}
+        for item in items:
+            category, publishable = item[0], item[1]
+            cache_key = (category.pk, publishable.content_type_id)
+            if cache_key not in keys_cache:
+                keys_cache[cache_key] = cls.get_keys(category, publishable)
+            v = cls.get_value(publishable)
+            for k in keys_cache[cache_key]:
+                out.setdefault(k, {}).setdefault(v, []).append(item)
+        cls._store_keys(out.keys(), pipe)
+        return out
+
+    @classmethod
+    def _chunks(cls, data):
+        data = list(data)
+        for i in xrange(0, len(data), cls.CHUNK_SIZE):
+            yield data[i:i + cls.CHUNK_SIZE]
+
+    @classmethod
+    def _zadd(cls, key, values, pipe):
+        scores = [(v, max(float(i[2]) for i in items)) for v, items in values.iteritems()]
+        for chunk in cls._chunks(scores):
+            pipe.zadd(key, **dict(chunk))
+
+    @classmethod
+    def add_publishables(cls, items, pipe=None, commit=True):
+        """
+        Add ``(category, publishable, score)`` tuples to all relevant
+        listings using a single pipeline. When a publishable ends up in the
+        same key more than once, the highest score is used.
+        """
         if pipe is None:
             pipe = client.pipeline()
 
-        for k in cls.get_keys(category, publishable):
-            pipe.zadd(k, cls.get_value(publishable), score)
+        for k, values in cls._fan_out(items, pipe).iteritems():
+            cls._zadd(k, values, pipe)
 
         if commit:
             pipe.execute()
@@ -139,13 +263,18 @@ class RedisListingHandler(ListingHandler):
             return pipe
 
     @classmethod
-    def incr_score(cls, category, publishable, incr_by=1, pipe=None, commit=True):
+    def add_publishable(cls, category, publishable, score, pipe=None, commit=True):
+        return cls.add_publishables([(category, publishable, score)], pipe=pipe, commit=commit)
+
+    @classmethod
+    def incr_scores(cls, items, pipe=None, commit=True):
+        " Increment scores by ``(category, publishable, incr_by)`` tuples in a single pipeline. "
         if pipe is None:
             pipe = client.pipeline()
 
-        v = cls.get_value(publishable)
-        for k in cls.get_keys(category, publishable):
-            pipe.zincrby(k, v, incr_by)
+        for k, values in cls._fan_out(items, pipe).iteritems():
+            for v, its in values.iteritems():
+                pipe.zincrby(k, v, sum(i[2] for i in its))
 
         if commit:
             pipe.execute()
@@ -153,19 +282,60 @@ class RedisListingHandler(ListingHandler):
             return pipe
 
     @classmethod
-    def remove_publishable(cls, category, publishable, pipe=None, commit=True):
+    def incr_score(cls, category, publishable, incr_by=1, pipe=None, commit=True):
+        return cls.incr_scores([(category, publishable, incr_by)], pipe=pipe, commit=commit)
+
+    @classmethod
+    def remove_publishables(cls, items, pipe=None, commit=True):
+        " Remove ``(category, publishable)`` tuples from all relevant listings in a single pipeline. "
         if pipe is None:
             pipe = client.pipeline()
 
-        for k in cls.get_keys(category, publishable):
-            pipe.zrem(k, cls.get_value(publishable))
+        for k, values in cls._fan_out(items, pipe).iteritems():
+            for chunk in cls._chunks(values):
+                pipe.zrem(k, *chunk)
 
         if commit:
             pipe.execute()
         else:
             return pipe
 
+    @classmethod
+    def remove_publishable(cls, category, publishable, pipe=None, commit=True):
+        return cls.remove_publishables([(category, publishable)], pipe=pipe, commit=commit)
+
+    def _run_script(self, offset, count):
+        keys = [self._get_result_key(), self._get_category_key()]
+        keys.extend(self._get_ct_keys())
+
+        min_score, max_score = self._get_score_limits()
+        args = [
+            max_score is None and '+inf' or repr(max_score),
+            min_score is None and '-inf' or repr(min_score),
+            offset, count,
+            self.exclude and self.get_value(self.exclude) or '',
+            self.RESULT_KEY_TIMEOUT,
+            # result key is recomputed once per handler instance
+            not hasattr(self, '_count') and '1' or '0',
+        ]
+        try:
+            total, items = client.execute_command('EVALSHA', LISTING_SCRIPT_SHA, len(keys), *(keys + args))
+        except (ResponseError, InvalidResponse):
+            # script not loaded yet (older clients cannot parse NOSCRIPT),
+            # any other error will be raised again
+            client.execute_command('SCRIPT', 'LOAD', LISTING_SCRIPT)
+            total, items = client.execute_command('EVALSHA', LISTING_SCRIPT_SHA, len(keys), *(keys + args))
+
+        # count is the same for all windows
+        self._count = total
+        return [(items[i], float(items[i + 1])) for i in xrange(0, len(items), 2)]
+
     def count(self):
+        if self.USE_LUA:
+            if not hasattr(self, '_count'):
+                self._run_script(0, 0)
+            return self._count
+
         key, pipe = self._get_key()
         if pipe is None:
             pipe = client.pipeline()
@@ -182,11 +352,31 @@ class RedisListingHandler(ListingHandler):
         min_score = None
 
         if self.date_range:
-            max_score = time.mktime(min(self.date_range[1], datetime.now()).timetule())
+            max_score = time.mktime(min(self.date_range[1], datetime.now()).timetuple())
             min_score = time.mktime(self.date_range[0].timetuple())
         return min_score, max_score
 
     def get_listings(self, offset=0, count=10):
+        if self.USE_LUA:
+            results = self._run_script(offset, count)
+        else:
+            results = self._get_listings_pipe(offset, count)
+
+        # get the data from redis into proper format
+        data = []
+        ids = []
+        for value, score in results:
+            ct_id, pk = value.split(':')
+            ids.append((int(ct_id), int(pk)))
+            data.append(score)
+
+        # and retrieve publishables from cache
+        publishables = get_cached_objects(ids, missing=SKIP)
+
+        # create mock Listing objects to return
+        return map(lambda (p, score): self._get_listing(p, score), zip(publishables, data))
+
+    def _get_listings_pipe(self, offset, count):
         key, pipe = self._get_key()
         if pipe is None:
             pipe = client.pipeline()
@@ -206,21 +396,24 @@ class RedisListingHandler(ListingHandler):
                 start=offset, num=offset+count-1,
                 withscores=True
             )
-        results = pipe.execute()
+        return pipe.execute()[-1]
 
-        # get the data from redis into proper format
-        data = []
-        ids = []
-        for value, score in results[-1]:
-            ct_id, pk = value.split(':')
-            ids.append((int(ct_id), int(pk)))
-            data.append(score)
+    def _get_category_key(self):
+        key_parts = [self.PREFIX]
+        # get the proper key for category
+        if self.children == ListingHandler.IMMEDIATE:
+            key_parts.append('c')
+        elif self.children == ListingHandler.ALL:
+            key_parts.append('d')
+        key_parts.append(str(self.category.id))
+        return ':'.join(key_parts)
 
-        # and retrieve publishables from cache
-        publishables = get_cached_objects(ids, missing=SKIP)
+    def _get_ct_keys(self):
+        return [':'.join((self.PREFIX, 'ct', str(ct.pk))) for ct in self.content_types]
 
-        # create mock Listing objects to return
-        return map(lambda (p, score): self._get_listing(p, score), zip(publishables, data))
+    def _get_result_key(self):
+        keys = [self._get_category_key()] + self._get_ct_keys()
+        return '%s:zls:%s' % (self.PREFIX, md5(','.join(keys)).hexdigest())
 
     def _union(self, union_keys, pipe):
         if len(union_keys) > 1:
@@ -234,15 +427,7 @@ class RedisListingHandler(ListingHandler):
     def _get_key(self):
         pipe = None
         if not hasattr(self, '_key'):
-            key_parts = [self.PREFIX]
-            # get the proper key for category
-            if self.children == ListingHandler.IMMEDIATE:
-                key_parts.append('c')
-            elif self.children == ListingHandler.ALL:
-                key_parts.append('d')
-            key_parts.append(str(self.category.id))
-
-            key = ':'.join(key_parts)
+            key = self._get_category_key()
 
             # do everything in one pipeline
             pipe = client.pipeline()
@@ -251,7 +436,7 @@ class RedisListingHandler(ListingHandler):
             ct_key = None
             if self.content_types:
                 # get the union of all content_type listings
-                ct_key = self._union([':'.join((self.PREFIX, 'ct', str(ct.pk))) for ct in self.content_types], pipe)
+                ct_key = self._union(self._get_ct_keys(), pipe)
 
 
             # do the intersect if required and output a single key
@@ -274,10 +459,99 @@ class RedisListingHandler(ListingHandler):
             self._key = key
         return self._key, pipe
 
+def rebuild_listings(category=None, chunk_size=1000, progress=None, now=None):
+    """
+    Regenerate the sorted sets of ``RedisListingHandler`` from the database.
+
+    Live listings are read in chunks of ``chunk_size`` ordered by pk and
+    written into temporary keys which then atomically replace the live ones.
+    Only the keys of ``category`` and its descendants are rebuilt if
+    ``category`` is given, otherwise all of them including content type keys.
+    ``progress`` is called with the number of listings processed so far, the
+    total and the number of seconds elapsed after every chunk.
+
+    Changes made to the affected listings during the rebuild are lost.
+    Returns a dict with the number of ``listings`` and ``keys`` written,
+    ``seconds`` it took and the resulting ``rate`` (listings per second).
+    """
+    from django.contrib.contenttypes.models import ContentType
+    Listing = get_model('core', 'listing')
+    Category = get_model('core', 'category')
+    handler = RedisListingHandler
+
+    if now is None:
+        now = datetime.now()
+
+    qset = Listing.objects.filter(publishable__published=True, publishable__publish_from__lt=now).exclude(publishable__publish_to__lt=now)
+    if category is None:
+        categories = Category.objects.values_list('pk', flat=True)
+        keys = set(':'.join((handler.PREFIX, 'ct', str(pk))) for pk in ContentType.objects.values_list('pk', flat=True))
+    else:
+        categories = [category.pk] + [c.pk for c in Category.objects.get_children(category, recursive=True)]
+        qset = qset.filter(category__in=categories)
+        keys = set()
+    for pk in categories:
+        keys.add(':'.join((handler.PREFIX, str(pk))))
+        keys.add(':'.join((handler.PREFIX, 'c', str(pk))))
+        keys.add(':'.join((handler.PREFIX, 'd', str(pk))))
+
+    tmp_mask = '%%s:rebuild:%d.%d' % (os.getpid(), time.time())
+    written = set()
+    done = 0
+    total = qset.count()
+    start = time.time()
+    last_pk = 0
+    try:
+        while True:
+            items = []
+            for l in qset.filter(pk__gt=last_pk).order_by('pk').select_related('publishable')[:chunk_size].iterator():
+                items.append((l.category, l.publishable, _listing_score(l)))
+                last_pk = l.pk
+            if not items:
+                break
+
+            pipe = client.pipeline(transaction=False)
+            for k, values in handler._fan_out(items, pipe).iteritems():
+                # ancestors outside of the rebuilt subtree stay untouched
+                if k in keys:
+                    handler._zadd(tmp_mask % k, values, pipe)
+                    written.add(k)
+            pipe.execute()
+
+            done += len(items)
+            if progress is not None:
+                progress(done, total, time.time() - start)
+
+        # swap all the keys at once
+        pipe = client.pipeline()
+        for k in keys:
+            if k in written:
+                pipe.rename(tmp_mask % k, k)
+            else:
+                pipe.delete(k)
+        pipe.execute()
+    except:
+        if written:
+            client.delete(*[tmp_mask % k for k in written])
+        raise
+
+    elapsed = time.time() - start
+    return {
+        'listings': done,
+        'keys': len(written),
+        'seconds': elapsed,
+        'rate': elapsed and done / elapsed or 0,
+    }
+
 class SlidingListingHandler(RedisListingHandler):
     WINDOW_SIZE = 7
     REMOVE_OLD_SLOTS = True
 
+    # maintain the aggregates incrementally, regenerate() then only
+    # subtracts the days that fell out of the window from each key instead
+    # of summing up all the days again
+    INCREMENTAL = False
+
     @classmethod
     def base_key_set(cls):
         return ':'.join((cls.PREFIX, 'KEYS'))
@@ -286,23 +560,68 @@ class SlidingListingHandler(RedisListingHandler):
     def window_key_zset(cls):
         return ':'.join((cls.PREFIX, 'WINDOWS'))
 
+    @classmethod
+    def window_start_hash(cls):
+        return ':'.join((cls.PREFIX, 'STARTS'))
+
     @classmethod
     def get_keys(cls, category, publishable):
         base_keys = super(SlidingListingHandler, cls).get_keys(category, publishable)
-        day = date.today().strftime('%Y%m%d')
-        day_mask = '%%s:%s' % day
-        day_keys = [day_mask % k for k in base_keys]
+        day_mask = '%%s:%s' % date.today().strftime('%Y%m%d')
+        return base_keys + [day_mask % k for k in base_keys]
 
+    @classmethod
+    def _store_keys(cls, keys, pipe):
         # store all the keys somewhere so that we can construct windows
-        pipe = client.pipeline()
-        pipe.sadd(cls.base_key_set(), *base_keys)
-        pipe.zadd(cls.window_key_zset(), **dict((k, day) for k in day_keys))
-        pipe.execute()
+        day = date.today().strftime('%Y%m%d')
+        day_keys = [k for k in keys if k.endswith(':' + day)]
+        if day_keys:
+            pipe.sadd(cls.base_key_set(), *[k[:-len(day) - 1] for k in day_keys])
+            pipe.zadd(cls.window_key_zset(), **dict((k, day) for k in day_keys))
+
+    @classmethod
+    def track_hit(cls, sender, category, publishable, **kwargs):
+        """
+        Receiver for the ``object_rendered`` signal, connect it to get listings
+        of the most read publishables::
 
-        return base_keys + day_keys
+            object_rendered.connect(MostReadListingHandler.track_hit)
+        """
+        if publishable is not None:
+            cls.incr_score(category, publishable)
 
     @classmethod
-    def regenerate(cls, today=None):
+    def _in_shard(cls, key, shard, shards):
+        return crc32(key) % shards == shard
+
+    @classmethod
+    def _roll(cls, keys, days, pipe):
+        first_day = days[-1]
+        starts = client.hmget(cls.window_start_hash(), keys)
+        for k, start in zip(keys, starts):
+            if start is None:
+                # key not maintained incrementally yet, sum it up once
+                pipe.zunionstore(k, ['%s:%s' % (k, day) for day in days], aggregate='SUM')
+            elif start < first_day:
+                # subtract all the days that are no longer in the window
+                weights = {k: 1}
+                d = datetime.strptime(start, '%Y%m%d').date()
+                while d.strftime('%Y%m%d') < first_day:
+                    weights['%s:%s' % (k, d.strftime('%Y%m%d'))] = -1
+                    d += timedelta(days=1)
+                pipe.zunionstore(k, weights, aggregate='SUM')
+                pipe.zremrangebyscore(k, '-inf', 0)
+            else:
+                continue
+            pipe.hset(cls.window_start_hash(), k, first_day)
+
+    @classmethod
+    def regenerate(cls, today=None, shard=0, shards=1):
+        """
+        Recompute the aggregates over the last ``WINDOW_SIZE`` days. Keys can
+        be split into ``shards`` processed independently (each by a single
+        worker at a time), ``shard`` is the index of the one to process.
+        """
         if today is None:
             today = date.today()
 
@@ -312,29 +631,187 @@ class SlidingListingHandler(RedisListingHandler):
             last_day = (today - timedelta(days=d)).strftime('%Y%m%d')
             days.append(last_day)
 
+        keys = [k for k in client.smembers(cls.base_key_set()) if cls._in_shard(k, shard, shards)]
+
         pipe = client.pipeline()
 
+        if cls.INCREMENTAL:
+            if keys:
+                cls._roll(keys, days, pipe)
+        else:
+            for k in keys:
+                # store the aggregate for all keys over WINDOW_SIZE days
+                pipe.zunionstore(k, ['%s:%s' % (k, day) for day in days], aggregate='SUM')
+
         if cls.REMOVE_OLD_SLOTS:
             # get all the day keys older than last day requested
-            to_remove = client.zrangebyscore(cls.window_key_zset(), 0, '(' + last_day)
+            to_remove = [k for k in client.zrangebyscore(cls.window_key_zset(), 0, '(' + last_day)
+                            if cls._in_shard(k.rsplit(':', 1)[0], shard, shards)]
             if to_remove:
                 # delete those keys
                 pipe.delete(*to_remove)
                 # and remove them from the zset index
-                pipe.zremrangebyscore(cls.window_key_zset(), 0, '(' + last_day)
+                pipe.zrem(cls.window_key_zset(), *to_remove)
 
-        for k in client.smembers(cls.base_key_set()):
-            # store the aggregate for all keys over WINDOW_SIZE days
-            pipe.zunionstore(k, ['%s:%s' % (k, day) for day in days], aggregate='SUM')
+        pipe.execute()
+
+class HitBuffer(object):
+    """
+    Counts hits of publishables in process memory and writes them to the
+    listings of ``handler`` (typically a ``SlidingListingHandler``) in one
+    pipeline once ``max_hits`` hits were collected or ``interval`` seconds
+    passed since the last flush (checked when a hit comes in). Whatever is
+    left is flushed when the process exits.
+
+    ``stats`` holds the number of ``hits`` received, ``flushed`` and
+    ``dropped`` (lost due to redis errors) and ``flushes`` performed,
+    ``pending()`` returns the number of hits not flushed yet. Usage::
+
+        most_read_hits = HitBuffer(MostReadListingHandler)
+        object_rendered.connect(most_read_hits.track_hit)
+    """
+    def __init__(self, handler, max_hits=100, interval=1.0):
+        self.handler = handler
+        self.max_hits = max_hits
+        self.interval = interval
+        self.stats = {'hits': 0, 'flushed': 0, 'dropped': 0, 'flushes': 0}
+        self._lock = threading.Lock()
+        self._hits = {}
+        self._count = 0
+        self._last_flush = time.time()
+        atexit.register(self.flush)
+
+    def pending(self):
+        return self._count
+
+    def add(self, category, publishable, incr_by=1):
+        key = (category.pk, publishable.content_type_id, publishable.pk)
+        self._lock.acquire()
+        try:
+            if key in self._hits:
+                self._hits[key][2] += incr_by
+            else:
+                self._hits[key] = [category, publishable, incr_by]
+            self._count += incr_by
+            self.stats['hits'] += incr_by
+            flush = self._count >= self.max_hits or time.time() - self._last_flush >= self.interval
+        finally:
+            self._lock.release()
+
+        if flush:
+            self.flush()
+
+    def track_hit(self, sender, category, publishable, **kwargs):
+        " Receiver for the ``object_rendered`` signal. "
+        if publishable is not None:
+            self.add(category, publishable)
+
+    def flush(self):
+        self._lock.acquire()
+        try:
+            hits, count = self._hits, self._count
+            self._hits, self._count = {}, 0
+            self._last_flush = time.time()
+        finally:
+            self._lock.release()
+
+        if not hits:
+            return
+        try:
+            self.handler.incr_scores(hits.values())
+        except Exception, e:
+            log.warning('Failed to flush %d hits to %s: %s', count, self.handler.__name__, e)
+            self.stats['dropped'] += count
+        else:
+            self.stats['flushed'] += count
+            self.stats['flushes'] += 1
+
+SCHEDULE_KEY = 'publish:schedule'
+
+def _get_transition(publishable, now):
+    " Return the time of the next change of ``publishable``'s publication status. "
+    if not publishable.published:
+        return None
+    times = [t for t in (publishable.publish_from, publishable.publish_to) if t and t > now]
+    return times and min(times) or None
+
+def _timestamp(dt):
+    return repr(time.mktime(dt.timetuple()) + dt.microsecond / 1e6)
+
+def schedule_publishables(publishables, now=None, pipe=None):
+    """
+    Store the upcoming publish/unpublish time of each of ``publishables`` in a
+    sorted set so that ``process_schedule`` can announce it on time.
+    """
+    if now is None:
+        now = datetime.now()
+    commit = pipe is None
+    if commit:
+        pipe = client.pipeline()
 
+    for p in publishables:
+        t = _get_transition(p, now)
+        if t is None:
+            pipe.zrem(SCHEDULE_KEY, p.pk)
+        else:
+            pipe.zadd(SCHEDULE_KEY, **{str(p.pk): _timestamp(t)})
+
+    if commit:
         pipe.execute()
 
+def process_schedule(now=None, batch_size=1000):
+    """
+    Announce publishables whose scheduled publish/unpublish time has come, in
+    batches of ``batch_size`` using ``ella.core.management.announce``. Safe
+    to run from several processes at once, each item is claimed by ZREM.
+    Returns the number of publishables processed.
+    """
+    from ella.core.management import announce
+    Publishable = get_model('core', 'publishable')
+
+    if now is None:
+        now = datetime.now()
+    max_score = _timestamp(now)
+
+    processed = 0
+    while True:
+        ids = client.zrangebyscore(SCHEDULE_KEY, '-inf', max_score, start=0, num=batch_size)
+        if not ids:
+            break
+
+        pipe = client.pipeline()
+        for pk in ids:
+            pipe.zrem(SCHEDULE_KEY, pk)
+        # somebody else might have claimed some of the items
+        ids = [pk for pk, removed in zip(ids, pipe.execute()) if removed]
+
+        publishables = list(Publishable.objects.filter(pk__in=ids))
+        published = [p for p in publishables if p.is_published(now) and not p.announced]
+        unpublished = [p for p in publishables if not p.is_published(now) and p.announced]
+        if published:
+            announce(published, True)
+        if unpublished:
+            announce(unpublished, False)
+
+        schedule_publishables(publishables, now)
+        processed += len(publishables)
+    return processed
+
+def publishable_post_save(sender, instance, **kwargs):
+    schedule_publishables([instance])
+
+def publishable_post_delete(sender, instance, **kwargs):
+    client.zrem(SCHEDULE_KEY, instance.pk)
+
 def connect_signals():
     from django.db.models.signals import pre_save, post_save, post_delete, pre_delete
-    from ella.core.signals import content_published, content_unpublished
+    from ella.core.signals import content_published, content_unpublished, \
+            content_published_bulk, content_unpublished_bulk, connect_publishable_signal
     from ella.core.models import Listing
     content_published.connect(publishable_published)
     content_unpublished.connect(publishable_unpublished)
+    content_published_bulk.connect(publishables_published)
+    content_unpublished_bulk.connect(publishables_unpublished)
 
     pre_save.connect(listing_pre_save, sender=Listing)
     post_save.connect(listing_post_save, sender=Listing)
@@ -342,5 +819,8 @@ def connect_signals():
     pre_delete.connect(listing_pre_delete, sender=Listing)
     post_delete.connect(listing_post_delete, sender=Listing)
 
+    connect_publishable_signal(post_save, publishable_post_save)
+    connect_publishable_signal(post_delete, publishable_post_delete)
+
 if client:
     connect_signals()
@@ -0,0 +1,337 @@
+"""
+Optional in-process tier in front of Django's shared cache.
+
+Objects retrieved via ``get_cached_object`` and ``get_cached_objects`` are
+kept in a bounded LRU in every worker process so that the hottest ones are
+served without any network I/O. Deletions (issued by ``invalidate_cache`` when
+an object is saved or deleted) are broadcast to the other processes through
+a pluggable invalidation channel.
+
+Enable it via the ``CACHE_LOCAL_TIER`` setting::
+
+    CACHE_LOCAL_TIER = {
+        'max_entries': 1000,
+        'max_size': 10 * 1024 * 1024,
+        'timeout': 60,
+        'channel': 'ella.core.cache.tiered.VersionKeyChannel',
+        'channel_options': {},
+        'models': ['core.category', 'core.publishable'],
+    }
+
+Only objects of the listed models (all of them when ``models`` is omitted)
+are kept in the local tier and only their invalidations are broadcast, so
+that saving other objects doesn't flush the tiers of all processes when the
+``VersionKeyChannel`` is used.
+"""
+import os
+import time
+import threading
+import logging
+import cPickle as pickle
+
+from django.core.cache.backends.dummy import DummyCache
+from django.core.exceptions import ImproperlyConfigured
+from django.utils.importlib import import_module
+from django.db.models import get_model
+from django.contrib.contenttypes.models import ContentType
+
+log = logging.getLogger('ella.core.cache.tiered')
+
+PREV, NEXT, KEY, EXPIRES, VALUE = 0, 1, 2, 3, 4
+
+class LRUCache(object):
+    """
+    Thread-safe LRU cache bounded by the number of entries and by the total
+    size of the stored values. Values are stored pickled so that every reader
+    gets its own copy and the size is known exactly.
+    """
+    def __init__(self, max_entries=1000, max_size=10 * 1024 * 1024, timeout=60):
+        self.max_entries = max_entries
+        self.max_size = max_size
+        self.timeout = timeout
+        self._lock = threading.Lock()
+        self.clear()
+
+    def clear(self):
+        self._lock.acquire()
+        try:
+            self._data = {}
+            self._size = 0
+            # circular doubly linked list, most recently used at the end
+            self._root = root = []
+            root[:] = [root, root, None, None, None]
+        finally:
+            self._lock.release()
+
+    def __len__(self):
+        return len(self._data)
+
+    def _unlink(self, link):
+        link[PREV][NEXT] = link[NEXT]
+        link[NEXT][PREV] = link[PREV]
+
+    def _remove(self, link):
+        self._unlink(link)
+        del self._data[link[KEY]]
+        self._size -= len(link[VALUE])
+
+    def get(self, key, default=None):
+        self._lock.acquire()
+        try:
+            link = self._data.get(key)
+            if link is None:
+                return default
+            if link[EXPIRES] < time.time():
+                self._remove(link)
+                return default
+            # move to the most recently used position
+            self._unlink(link)
+            last = self._root[PREV]
+            link[PREV], link[NEXT] = last, self._root
+            last[NEXT] = self._root[PREV] = link
+            value = link[VALUE]
+        finally:
+            self._lock.release()
+        return pickle.loads(value)
+
+    def set(self, key, value, timeout=None):
+        if not timeout or timeout > self.timeout:
+            timeout = self.timeout
+        value = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+        if len(value) > self.max_size:
+            self.delete(key)
+            return
+
+        self._lock.acquire()
+        try:
+            if key in self._data:
+                self._remove(self._data[key])
+
+            last = self._root[PREV]
+            link = [last, self._root, key, time.time() + timeout, value]
+            last[NEXT] = self._root[PREV] = self._data[key] = link
+            self._size += len(value)
+
+            # evict least recently used entries
+            while len(self._data) > self.max_entries or self._size > self.max_size:
+                self._remove(self._root[NEXT])
+        finally:
+            self._lock.release()
+
+    def delete(self, key):
+        self._lock.acquire()
+        try:
+            if key in self._data:
+                self._remove(self._data[key])
+        finally:
+            self._lock.release()
+
+
+class InvalidationChannel(object):
+    """
+    Base class for channels propagating deletions to local tiers in other
+    processes.
+    """
+    def connect(self, local):
+        self.local = local
+
+    def publish(self, keys):
+        " Announce that ``keys`` were deleted from the shared cache. "
+        raise NotImplementedError()
+
+    def sync(self):
+        " Apply invalidations from other processes, called once per request. "
+        pass
+
+
+class VersionKeyChannel(InvalidationChannel):
+    """
+    Coarse channel: any deletion of a key that can live in the local tier
+    bumps a version key in the shared cache and every process drops its whole
+    local tier when it notices the change at the beginning of the next request.
+    """
+    def __init__(self, shared, key='core.gco.local_version'):
+        self.shared = shared
+        self.key = key
+        self.version = None
+
+    def publish(self, keys):
+        self.version = time.time()
+        # expiration of the key only means one extra flush of every tier
+        self.shared.set(self.key, self.version)
+
+    def sync(self):
+        version = self.shared.get(self.key)
+        if version != self.version:
+            self.local.clear()
+            self.version = version
+
+
+class RedisPubSubChannel(InvalidationChannel):
+    """
+    Exact channel: deleted keys are published over Redis pub/sub and removed
+    from the local tier by a listener thread in every process.
+    """
+    def __init__(self, shared, channel='core.gco.invalidate', **redis_options):
+        from redis import Redis
+        self.client = Redis(**redis_options)
+        self.channel = channel
+        self._pid = None
+
+    def publish(self, keys):
+        pipe = self.client.pipeline()
+        for k in keys:
+            pipe.publish(self.channel, k)
+        pipe.execute()
+
+    def sync(self):
+        # threads don't survive fork, start the listener in every process
+        if self._pid != os.getpid():
+            self._pid = os.getpid()
+            t = threading.Thread(target=self._listen)
+            t.setDaemon(True)
+            t.start()
+
+    def _listen(self):
+        while True:
+            try:
+                pubsub = self.client.pubsub()
+                pubsub.subscribe(self.channel)
+                # we might have missed something while disconnected
+                self.local.clear()
+                for message in pubsub.listen():
+                    if message['type'] == 'message':
+                        self.local.delete(message['data'])
+            except Exception, e:
+                log.warning('Lost connection to invalidation channel (%s), reconnecting.', e)
+                time.sleep(1)
+
+
+class TieredCache(object):
+    """
+    Wrapper around Django's cache object that keeps the keys starting with
+    ``prefix`` in the local ``LRUCache`` as well. If ``models`` (a list of
+    ``'app_label.model'`` strings) are given, only the keys of those models'
+    objects are kept locally. Other keys (locks, generation counters, ...)
+    always go to the shared cache only and their deletion is not broadcast.
+
+    Keys that get overwritten instead of deleted may be stale in other
+    processes for up to the local tier's timeout.
+    """
+    def __init__(self, shared, local, channel, prefix, models=None):
+        self.shared = shared
+        self.local = local
+        self.channel = channel
+        self.prefix = prefix
+        self.models = models
+        self._prefixes = None
+        channel.connect(local)
+
+    def _get_prefixes(self):
+        # content types cannot be resolved before the database is ready
+        if self._prefixes is None:
+            if self.models is None:
+                self._prefixes = self.prefix
+            else:
+                self._prefixes = tuple(
+                    '%s%s:' % (self.prefix, ContentType.objects.get_for_model(_get_model(m)).pk)
+                    for m in self.models
+                )
+        return self._prefixes
+
+    def _is_local(self, key):
+        return key.startswith(self._get_prefixes())
+
+    def sync(self):
+        self.channel.sync()
+
+    def get(self, key, default=None):
+        if not self._is_local(key):
+            return self.shared.get(key, default)
+
+        value = self.local.get(key)
+        if value is None:
+            value = self.shared.get(key)
+            if value is None:
+                return default
+            self.local.set(key, value)
+        return value
+
+    def get_many(self, keys):
+        out = {}
+        remote = []
+        for k in keys:
+            value = self._is_local(k) and self.local.get(k) or None
+            if value is None:
+                remote.append(k)
+            else:
+                out[k] = value
+
+        if remote:
+            for k, value in self.shared.get_many(remote).items():
+                if self._is_local(k):
+                    self.local.set(k, value)
+                out[k] = value
+        return out
+
+    def set(self, key, value, timeout=None):
+        self.shared.set(key, value, timeout)
+        if self._is_local(key):
+            self.local.set(key, value, timeout)
+
+    def set_many(self, data, timeout=None):
+        if timeout is None or isinstance(self.shared, DummyCache):
+            self.shared.set_many(data)
+        else:
+            self.shared.set_many(data, timeout=timeout)
+        for k, value in data.items():
+            if self._is_local(k):
+                self.local.set(k, value, timeout)
+
+    def add(self, key, value, timeout=None):
+        self.local.delete(key)
+        return self.shared.add(key, value, timeout)
+
+    def delete(self, key):
+        self.shared.delete(key)
+        self.local.delete(key)
+        if self._is_local(key):
+            self.channel.publish([key])
+
+    def delete_many(self, keys):
+        self.shared.delete_many(keys)
+        for k in keys:
+            self.local.delete(k)
+        keys = filter(self._is_local, keys)
+        if keys:
+            self.channel.publish(keys)
+
+    def clear(self):
+        self.shared.clear()
+        self.local.clear()
+
+    def __getattr__(self, name):
+        # incr, decr, has_key, ... go directly to the shared cache
+        return getattr(self.shared, name)
+
+
+def _get_model(name):
+    model = get_model(*name.split('.', 1))
+    if model is None:
+        raise ImproperlyConfigured('Unknown model %s in CACHE_LOCAL_TIER' % name)
+    return model
+
+def get_tiered_cache(shared, config, prefix):
+    " Build TieredCache around ``shared`` from the ``CACHE_LOCAL_TIER`` setting. "
+    config = dict(config)
+    models = config.pop('models', None)
+    channel_path = config.pop('channel', 'ella.core.cache.tiered.VersionKeyChannel')
+    channel_options = config.pop('channel_options', {})
+
+    module, attr = channel_path.rsplit('.', 1)
+    try:
+        channel_class = getattr(import_module(module), attr)
+    except (ImportError, AttributeError), e:
+        raise ImproperlyConfigured('Error importing invalidation channel %s: "%s"' % (channel_path, e))
+
+    return TieredCache(shared, LRUCache(**config), channel_class(shared, **channel_options), prefix, models)
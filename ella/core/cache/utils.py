@@ -1,5 +1,9 @@
 from hashlib import md5
+from threading import local
+import math
+from random import random
 import logging
+import time
 
 from django.dispatch import receiver
 from django.db.models import ObjectDoesNotExist
@@ -15,13 +19,98 @@ from django.conf import settings
 log = logging.getLogger('ella.core.cache.utils')
 
 KEY_PREFIX = 'core.gco'
+GENERATION_KEY_PREFIX = 'core.gco.gen'
 CACHE_TIMEOUT = getattr(settings, 'CACHE_TIMEOUT', 10*60)
+NEGATIVE_CACHE_TIMEOUT = getattr(settings, 'CACHE_TIMEOUT_NEGATIVE', 60)
+
+if getattr(settings, 'CACHE_LOCAL_TIER', None):
+    from ella.core.cache.tiered import get_tiered_cache
+    cache = get_tiered_cache(cache, settings.CACHE_LOCAL_TIER, KEY_PREFIX + ':')
+
+class Tombstone(object):
+    """
+    Cached in place of an object that does not exist so that repeated lookups
+    don't hit the database.
+
+    Tombstones stored under pk keys are deleted by ``invalidate_cache`` when
+    the object is created. Other lookups cannot be mapped to a key from the
+    instance, so their tombstones remember the model's generation instead,
+    which is changed whenever an instance of the model is saved.
+    """
+    def __init__(self, generation=None):
+        self.generation = generation
+
+def _get_generation_key(model):
+    return ':'.join((GENERATION_KEY_PREFIX, str(model.pk)))
+
+def _does_not_exist(model):
+    mclass = model.model_class()
+    return mclass.DoesNotExist('%s matching query does not exist.' % mclass._meta.object_name)
+
+_identity_map = local()
+
+def activate_identity_map():
+    """
+    Start a fresh identity map for the current thread. Until it is
+    deactivated, ``get_cached_object`` and ``get_cached_objects`` will return
+    the same instance for the same key without asking the shared cache again.
+
+    When the local cache tier is enabled, invalidations from other processes
+    are applied here as well.
+    """
+    _identity_map.objects = {}
+    if hasattr(cache, 'sync'):
+        cache.sync()
+
+def deactivate_identity_map():
+    " Drop the identity map for the current thread. "
+    _identity_map.objects = None
+
+def get_identity_map():
+    " Return the active identity map (a dict keyed by cache key) or None. "
+    return getattr(_identity_map, 'objects', None)
+
+_tracking = local()
+
+def start_tracking():
+    """
+    Start recording which objects are retrieved via ``get_cached_object`` and
+    ``get_cached_objects`` in the current thread. Calls can be nested, objects
+    recorded in the inner frame are added to the outer one as well.
+    """
+    if not hasattr(_tracking, 'frames'):
+        _tracking.frames = []
+    _tracking.frames.append(set())
+
+def stop_tracking():
+    " Stop recording and return a set of (content_type_id, pk) tuples. "
+    deps = _tracking.frames.pop()
+    if _tracking.frames:
+        _tracking.frames[-1].update(deps)
+    return deps
+
+def track_dependency(ct_id, pk):
+    " Record a dependency on an object in all active tracking frames. "
+    frames = getattr(_tracking, 'frames', None)
+    if frames:
+        frames[-1].add((ct_id, smart_str(pk)))
 
 @receiver(post_save)
 @receiver(post_delete)
 def invalidate_cache(sender, instance, **kwargs):
-    key = _get_key(KEY_PREFIX, ContentType.objects.get_for_model(sender), pk=instance.pk)
-    cache.delete(key)
+    identity_map = get_identity_map()
+    # saving a subclass (Article) also changes the parent (Publishable)
+    for model in [sender] + list(sender._meta.get_parent_list()):
+        ct = ContentType.objects.get_for_model(model)
+        key = _get_key(KEY_PREFIX, ct, pk=instance.pk)
+        cache.delete(key)
+
+        if 'created' in kwargs:
+            # post_save, invalidate tombstones for non-pk lookups
+            cache.set(_get_generation_key(ct), time.time(), NEGATIVE_CACHE_TIMEOUT)
+
+        if identity_map is not None:
+            identity_map.pop(key, None)
 
 def normalize_key(key):
     if len(key) < 255:
@@ -54,18 +143,47 @@ def get_cached_object(model, timeout=CACHE_TIMEOUT, **kwargs):
         **kwargs - lookup parameters for content_type.get_object_for_this_type and for key creation
 
     Throws:
-        model.DoesNotExist is propagated from content_type.get_object_for_this_type
+        model.DoesNotExist is propagated from content_type.get_object_for_this_type,
+        non-existence is cached for NEGATIVE_CACHE_TIMEOUT
     """
     if not isinstance(model, ContentType):
         model = ContentType.objects.get_for_model(model)
 
+    pk_lookup = kwargs.keys() == ['pk']
     key = _get_key(KEY_PREFIX, model, **kwargs)
 
-    obj = cache.get(key)
-    if obj is None:
-        mclass = model.model_class()
-        obj = mclass._default_manager.get(**kwargs)
-        cache.set(key, obj, timeout)
+    identity_map = get_identity_map()
+    if identity_map is not None and key in identity_map:
+        obj = identity_map[key]
+    else:
+        obj = cache.get(key)
+        if isinstance(obj, Tombstone) and not pk_lookup and \
+                obj.generation != cache.get(_get_generation_key(model)):
+            obj = None
+
+        if obj is None:
+            mclass = model.model_class()
+            try:
+                obj = mclass._default_manager.get(**kwargs)
+            except mclass.DoesNotExist:
+                if pk_lookup:
+                    obj = Tombstone()
+                else:
+                    obj = Tombstone(cache.get(_get_generation_key(model)))
+                cache.set(key, obj, NEGATIVE_CACHE_TIMEOUT)
+            else:
+                cache.set(key, obj, timeout)
+
+        if identity_map is not None:
+            identity_map[key] = obj
+
+    if pk_lookup:
+        track_dependency(model.pk, kwargs['pk'])
+    elif not isinstance(obj, Tombstone):
+        track_dependency(model.pk, obj.pk)
+
+    if isinstance(obj, Tombstone):
+        raise _does_not_exist(model)
     return obj
 
 RAISE, SKIP, NONE = 0, 1, 2
@@ -80,6 +198,9 @@ def get_cached_objects(pks, model=None, timeout=CACHE_TIMEOUT, missing=RAISE):
 
     Throws:
         model.DoesNotExist is propagated from content_type.get_object_for_this_type
+
+    Objects that don't exist are remembered using the same tombstones
+    ``get_cached_object`` uses for pk lookups.
     """
     if model is not None:
         if not isinstance(model, ContentType):
@@ -90,10 +211,25 @@ def get_cached_objects(pks, model=None, timeout=CACHE_TIMEOUT, missing=RAISE):
 
     keys = [_get_key(KEY_PREFIX, model, pk=pk) for (model, pk) in pks]
 
-    cached = cache.get_many(keys)
+    identity_map = get_identity_map()
+    if identity_map is not None:
+        # objects already seen during this request
+        cached = dict((k, identity_map[k]) for k in keys if k in identity_map)
+        keys_to_get = [k for k in keys if k not in cached]
+    else:
+        cached = {}
+        keys_to_get = keys
+
+    if keys_to_get:
+        cached.update(cache.get_many(keys_to_get))
+
+    # keys known not to exist
+    tombstones = set(k for k, v in cached.items() if isinstance(v, Tombstone))
+    for k in tombstones:
+        del cached[k]
 
     # keys not in cache
-    keys_to_set = set(keys) - set(cached.keys())
+    keys_to_set = set(keys) - set(cached.keys()) - tombstones
     if keys_to_set:
         # build lookup to get model and pks from the key
         lookup = dict(zip(keys, pks))
@@ -117,6 +253,19 @@ def get_cached_objects(pks, model=None, timeout=CACHE_TIMEOUT, missing=RAISE):
         # write them into cache
         cache.set_many(to_set, **kw)
 
+        # remember the ones that don't exist
+        not_found = keys_to_set - set(to_set.keys())
+        if not_found:
+            if 'timeout' in kw:
+                kw['timeout'] = NEGATIVE_CACHE_TIMEOUT
+            cache.set_many(dict((k, Tombstone()) for k in not_found), **kw)
+
+    if identity_map is not None:
+        identity_map.update(cached)
+
+    for ct, pk in pks:
+        track_dependency(ct.pk, pk)
+
     out = []
     for k in keys:
         try:
@@ -127,11 +276,98 @@ def get_cached_objects(pks, model=None, timeout=CACHE_TIMEOUT, missing=RAISE):
             elif missing == SKIP:
                 pass
             elif missing == RAISE:
-                ct = ContentType.objects.get_for_id(int(k.split(':')[1]))
-                raise ct.model_class().DoesNotExist(
-                    '%s matching query does not exist.' % ct.model_class()._meta.object_name)
+                raise _does_not_exist(ContentType.objects.get_for_id(int(k.split(':')[1])))
+    return out
+
+def get_cached_objects_by(model, field, values, timeout=CACHE_TIMEOUT, **lookup):
+    """
+    Batch version of ``get_cached_object(model, <field>=value, **lookup)``
+    for all the ``values``, returns a dict {value: object} of the objects
+    that exist (model instances in ``values`` are replaced by their pk).
+
+    Uses the same keys and tombstones as ``get_cached_object`` so that both
+    share the cached objects. All the keys are retrieved with one
+    ``cache.get_many`` and the misses are loaded by one ``<field>__in`` query.
+    """
+    if not isinstance(model, ContentType):
+        model = ContentType.objects.get_for_model(model)
+    mclass = model.model_class()
+    attname = mclass._meta.get_field(field).attname
+
+    keys = {}
+    for value in values:
+        value = getattr(value, 'pk', value)
+        keys[_get_key(KEY_PREFIX, model, **dict(lookup, **{field: value}))] = value
+
+    identity_map = get_identity_map()
+    if identity_map is not None:
+        cached = dict((k, identity_map[k]) for k in keys if k in identity_map)
+        keys_to_get = [k for k in keys if k not in cached]
+    else:
+        cached = {}
+        keys_to_get = keys.keys()
+
+    if keys_to_get:
+        cached.update(cache.get_many(keys_to_get))
+
+    tombstones = [k for k, v in cached.items() if isinstance(v, Tombstone)]
+    if tombstones:
+        generation = cache.get(_get_generation_key(model))
+        for k in tombstones:
+            if cached[k].generation != generation:
+                # something has been created since, look again
+                del cached[k]
+
+    keys_to_set = set(keys) - set(cached.keys())
+    if keys_to_set:
+        lookup_keys = dict((smart_str(keys[k]), k) for k in keys_to_set)
+        qset = mclass._default_manager.filter(**dict(lookup, **{str(field + '__in'): [keys[k] for k in keys_to_set]}))
+
+        to_set = {}
+        for obj in qset:
+            k = lookup_keys[smart_str(getattr(obj, attname))]
+            cached[k] = to_set[k] = obj
+        kw = {}
+        if not isinstance(cache, DummyCache):
+            kw['timeout'] = timeout
+        cache.set_many(to_set, **kw)
+
+        not_found = keys_to_set - set(to_set.keys())
+        if not_found:
+            if 'timeout' in kw:
+                kw['timeout'] = NEGATIVE_CACHE_TIMEOUT
+            generation = cache.get(_get_generation_key(model))
+            to_set = dict((k, Tombstone(generation)) for k in not_found)
+            cached.update(to_set)
+            cache.set_many(to_set, **kw)
+
+    if identity_map is not None:
+        identity_map.update(cached)
+
+    out = {}
+    for k, obj in cached.items():
+        if not isinstance(obj, Tombstone):
+            track_dependency(model.pk, obj.pk)
+            out[keys[k]] = obj
     return out
 
+def invalidate_cached_objects(model, lookups):
+    """
+    Drop results of ``get_cached_object(model, **lookup)`` for every lookup
+    from the cache. Needed for lookups other than by pk when the objects are
+    changed without sending ``post_save`` (eg. by ``QuerySet.update``).
+    """
+    if not isinstance(model, ContentType):
+        model = ContentType.objects.get_for_model(model)
+
+    keys = [_get_key(KEY_PREFIX, model, **dict(lookup)) for lookup in lookups]
+    cache.delete_many(keys)
+
+    identity_map = get_identity_map()
+    if identity_map is not None:
+        for k in keys:
+            identity_map.pop(k, None)
+
 
 def get_cached_object_or_404(model, timeout=CACHE_TIMEOUT, **kwargs):
     """
@@ -144,24 +380,104 @@ def get_cached_object_or_404(model, timeout=CACHE_TIMEOUT, **kwargs):
     except ObjectDoesNotExist, e:
         raise Http404('Reason: %s' % str(e))
 
-def cache_this(key_getter, timeout=CACHE_TIMEOUT):
+class CachedValue(object):
+    """
+    Value stored by ``cache_this`` with stampede protection together with
+    the time it expires, how long it took to compute and its version.
+    Anything else found under the key (eg. stored by an older version of
+    ``cache_this``) is treated as a miss.
+    """
+    def __init__(self, value, expires, delta, version=None):
+        self.value = value
+        self.expires = expires
+        self.delta = delta
+        self.version = version
+
+def cache_this(key_getter, timeout=CACHE_TIMEOUT, stale_timeout=None, lock_timeout=10, beta=0, version_getter=None):
+    """
+    Cache the result of the decorated function under the key returned by
+    ``key_getter`` (called with the same arguments) for ``timeout`` seconds.
+
+    If ``stale_timeout`` is given, the cached value is protected against
+    stampedes: it is kept in the cache ``stale_timeout`` seconds longer than
+    ``timeout`` and once it expires only one worker (the one that obtains a
+    lock key for ``lock_timeout`` seconds) recomputes it, the others keep
+    serving the stale value meanwhile. A positive ``beta`` additionally
+    enables probabilistic early refresh (XFetch) - the closer the value is to
+    its expiration and the longer it took to compute, the likelier it is to
+    be refreshed before it expires. ``beta=1`` is a sensible default.
+
+    ``version_getter`` (called with the same arguments, only used together
+    with ``stale_timeout``) returns the current version of the value, eg. a
+    generation bumped whenever the underlying data change. A value of
+    another version is treated as expired, so it's recomputed right away but
+    can still be served as stale while that happens. Keep the version out of
+    the key for that to work.
+
+    Counters of hits, misses, recomputations and stale values served are
+    available as the ``stats`` attribute of the decorated function.
+    """
     def wrapped_decorator(func):
+        stats = {'hit': 0, 'miss': 0, 'recompute': 0, 'stale': 0}
+
+        def compute(key, version, args, kwargs):
+            start = time.time()
+            result = func(*args, **kwargs)
+            if key is not None:
+                if stale_timeout is None:
+                    cache.set(key, result, timeout)
+                else:
+                    now = time.time()
+                    cache.set(key, CachedValue(result, now + timeout, now - start, version), timeout + stale_timeout)
+            return result
+
         def wrapped_func(*args, **kwargs):
             key = key_getter(*args, **kwargs)
             if key is not None:
                 result = cache.get(key)
             else:
                 result = None
+
+            version = None
+            if stale_timeout is not None:
+                if not isinstance(result, CachedValue):
+                    result = None
+                if version_getter is not None:
+                    version = version_getter(*args, **kwargs)
+
             if result is None:
+                stats['miss'] += 1
                 log.debug('cache_this(key=%s), object not cached.', key)
-                result = func(*args, **kwargs)
-                cache.set(key, result, timeout)
-            return result
+                return compute(key, version, args, kwargs)
+
+            if stale_timeout is None:
+                stats['hit'] += 1
+                return result
+
+            now = time.time()
+            if beta:
+                # XFetch, 1 - random() is never 0
+                now -= result.delta * beta * math.log(1 - random())
+            if now < result.expires and result.version == version:
+                stats['hit'] += 1
+                return result.value
+
+            if cache.add(normalize_key(key + ':lock'), 1, lock_timeout):
+                stats['recompute'] += 1
+                log.debug('cache_this(key=%s), refreshing object.', key)
+                try:
+                    return compute(key, version, args, kwargs)
+                finally:
+                    cache.delete(normalize_key(key + ':lock'))
+
+            # somebody else is already working on it
+            stats['stale'] += 1
+            return result.value
 
         wrapped_func.__dict__ = func.__dict__
         wrapped_func.__doc__ = func.__doc__
         wrapped_func.__name__ = func.__name__
+        wrapped_func.stats = stats
 
         return wrapped_func
     return wrapped_decorator
-
@@ -6,6 +6,8 @@ gettext = lambda s: s
 # Caching-related
 CACHE_TIMEOUT = 10 * 60
 CACHE_TIMEOUT_LONG = 60 * 60
+CACHE_TIMEOUT_BOX = CACHE_TIMEOUT
+CACHE_TIMEOUT_LISTING = CACHE_TIMEOUT
 
 DOUBLE_RENDER = False
 DOUBLE_RENDER_EXCLUDE_URLS = None
@@ -13,6 +15,7 @@ DOUBLE_RENDER_EXCLUDE_URLS = None
 # Box
 BOX_INFO = 'ella.core.box.BOX_INFO'
 MEDIA_KEY = 'ella.core.box.MEDIA_KEY'
+BOX_DEPENDENCY_INDEX_LIMIT = 1000
 
 # Publishing configuration
 CATEGORY_LISTINGS_PAGINATE_BY = 20
@@ -57,4 +60,7 @@ ECACHE_INFO = 'ella.core.middleware.ECACHE_INFO'
 # templates
 ARCHIVE_TEMPLATE = True
 
+# resolve ella.core.urls using ella.core.dispatcher.SegmentDispatcher
+URL_DISPATCHER = False
+
 core_settings = Settings('ella.core.conf', '')
@@ -23,6 +23,7 @@ class CustomURLResolver(object):
     """
     def __init__(self):
         self._patterns = {}
+        self._resolvers = {}
         self.root_mapping = {}
 
     def has_custom_detail(self, obj):
@@ -49,9 +50,14 @@ class CustomURLResolver(object):
                     url('^%s/' % re.escape(prefix), include((urlpatterns, '', ''))),
                 )
         self._patterns.setdefault(key, []).extend(urlpatterns)
+        # patterns registered for ALL are part of every resolver
+        self._resolvers = {}
 
     def _get_resolver(self, obj):
-        return RegexURLResolver(r'^', self._patterns.get(str(obj._meta), []) + self._patterns.get(ALL, []))
+        key = str(obj._meta)
+        if key not in self._resolvers:
+            self._resolvers[key] = RegexURLResolver(r'^', self._patterns.get(key, []) + self._patterns.get(ALL, []))
+        return self._resolvers[key]
 
     def resolve(self, obj, url_remainder):
         return self._get_resolver(obj).resolve(url_remainder)
@@ -59,6 +65,21 @@ class CustomURLResolver(object):
     def reverse(self, obj, view_name, *args, **kwargs):
         return obj.get_absolute_url() + self._get_resolver(obj).reverse(view_name, *args, **kwargs)
 
+    def reverse_many(self, objects, view_name, *args, **kwargs):
+        """
+        Same as ``reverse`` for a list of objects, the URL suffix is only
+        computed once for every model. Raises ``NoReverseMatch`` if any of
+        the objects doesn't have the view.
+        """
+        suffixes = {}
+        urls = []
+        for obj in objects:
+            key = str(obj._meta)
+            if key not in suffixes:
+                suffixes[key] = self._get_resolver(obj).reverse(view_name, *args, **kwargs)
+            urls.append(obj.get_absolute_url() + suffixes[key])
+        return urls
+
     def call_custom_view(self, request, obj, url_remainder, context):
         view, args, kwargs = self.resolve(obj, url_remainder)
         return view(request, context, *args, **kwargs)
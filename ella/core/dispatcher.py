@@ -0,0 +1,292 @@
+"""
+Optional replacement for the sequential regex matching of ``ella.core.urls``.
+
+``SegmentDispatcher`` splits the patterns it is given into ``/``-separated
+segments. Patterns with a fixed number of segments are grouped by it, so
+only those with as many segments as the requested path are tried. The
+others (containing the category, which can span multiple segments) are
+walked down as a trie. Once the category is matched, the rest of the path
+is again matched by one regex per pattern. The extents of the category are
+tried in the order of the first pattern that could match the segments
+following them, so only one or two of them are usually tried.
+
+The result is exactly the one the first matching pattern would produce -
+every segment is still checked by the pattern's own regex and for the same
+pattern the longest category is used as the greedy regex would.
+
+Enable it by setting ``URL_DISPATCHER = True``. The original patterns stay
+in place behind the dispatcher so that ``reverse`` and URL names keep
+working and paths the dispatcher cannot handle still get resolved.
+"""
+import re
+
+from django.core.urlresolvers import ResolverMatch, RegexURLPattern
+
+# segments that are matched by a simple dictionary lookup
+LITERAL_RE = re.compile(r'^[a-z0-9_]+$')
+
+class Node(object):
+    def __init__(self):
+        # patterns with a fixed number of segments left from here, matched
+        # by a single regex each: {n: [(index, regex, pattern)]}, the regex
+        # is None for n == 0
+        self.suffixes = {}
+        # the trie for the other patterns, those with multi segment tokens
+        self.literals = {}
+        self.regexes = {}
+        # (regex, is_remainder, child) for tokens spanning multiple segments
+        self.multi = []
+        # smallest index of a pattern reachable from this node and of one
+        # reachable via the trie
+        self.first = None
+        self.variable = None
+        # nodes following a multi segment token: (table, tail), table[n] is
+        # the smallest index of a pattern that can match n more segments
+        # from here, tail the same for any longer rest of the path
+        self.bounds = None
+
+class SegmentDispatcher(object):
+    """
+    Resolve paths for ``patterns`` (a list of ``RegexURLPattern``).
+    ``multi_segment`` are regexes from the patterns that can match more than
+    one segment, ``remainder`` those that can only be used at the end and
+    consume the rest of the path including the trailing slash.
+
+    Patterns are only used up to the first one that cannot be split into
+    segments, the rest is left for the regular resolver.
+    """
+    # RegexURLResolver indexes all patterns for reverse(), there is nothing
+    # to reverse here
+    regex = re.compile(r'^$')
+    name = None
+    default_args = {}
+
+    def __init__(self, patterns, multi_segment=(), remainder=()):
+        self.multi_segment = list(multi_segment)
+        self.remainder = list(remainder)
+        self.root = Node()
+        self.patterns = []
+        for index, pattern in enumerate(patterns):
+            tokens = self._split(pattern)
+            if tokens is None:
+                break
+            self._add(tokens, index, pattern)
+            self.patterns.append(pattern)
+        self._set_bounds(self.root)
+
+    @property
+    def callback(self):
+        return self
+
+    def __repr__(self):
+        return '<%s %d patterns>' % (self.__class__.__name__, len(self.patterns))
+
+    def _split(self, pattern):
+        p = pattern.regex.pattern
+        if not isinstance(pattern, RegexURLPattern) or not (p.startswith('^') and p.endswith('$')):
+            return None
+        if pattern.regex.groups != len(pattern.regex.groupindex):
+            # unnamed groups would have to be passed as positional arguments
+            return None
+        p = p[1:-1]
+        if not p:
+            return []
+
+        # hide regexes containing slashes before splitting
+        placeholders = {}
+        for i, r in enumerate(self.multi_segment + self.remainder):
+            placeholder = '\0%d\0' % i
+            placeholders[placeholder] = (re.compile(r'^%s\Z' % r, re.UNICODE), r in self.remainder)
+            p = p.replace(r, placeholder)
+
+        tokens = []
+        last = None
+        for t in p.split('/'):
+            if t in placeholders:
+                tokens.append(placeholders[t])
+            elif '\0' in t:
+                # placeholder and something else within one segment
+                return None
+            elif LITERAL_RE.match(t):
+                tokens.append(t)
+            else:
+                tokens.append(re.compile(r'^%s\Z' % t, re.UNICODE))
+            last = t
+
+        if last in placeholders and placeholders[last][1]:
+            # ends with a remainder which includes the trailing slash
+            return tokens
+        if last != '' or any(isinstance(t, tuple) and t[1] for t in tokens):
+            # everything else has to end with a slash, remainder only at the end
+            return None
+        return tokens[:-1]
+
+    def _add(self, tokens, index, pattern):
+        node = self.root
+        for i, t in enumerate(tokens):
+            if node.first is None:
+                node.first = index
+            if not any(isinstance(r, tuple) for r in tokens[i:]):
+                break
+            if node.variable is None:
+                node.variable = index
+            if isinstance(t, basestring):
+                node = node.literals.setdefault(t, Node())
+            elif isinstance(t, tuple):
+                for regex, is_remainder, child in node.multi:
+                    if regex.pattern == t[0].pattern:
+                        node = child
+                        break
+                else:
+                    child = Node()
+                    node.multi.append((t[0], t[1], child))
+                    node = child
+            else:
+                node = node.regexes.setdefault(t.pattern, (t, Node()))[1]
+        else:
+            i = len(tokens)
+            if node.first is None:
+                node.first = index
+
+        rest = tokens[i:]
+        regex = None
+        if rest:
+            # compiled tokens are r'^...\Z'
+            regex = re.compile(r'^%s\Z' % '/'.join(
+                isinstance(t, basestring) and re.escape(t) or t.pattern[1:-2] for t in rest), re.UNICODE)
+        node.suffixes.setdefault(len(rest), []).append((index, regex, pattern))
+
+    def _collect_lengths(self, node, depth, fixed, variable):
+        for n, suffixes in node.suffixes.iteritems():
+            fixed[depth + n] = min(fixed.get(depth + n, suffixes[0][0]), suffixes[0][0])
+        for child in node.literals.itervalues():
+            self._collect_lengths(child, depth + 1, fixed, variable)
+        for regex, child in node.regexes.itervalues():
+            self._collect_lengths(child, depth + 1, fixed, variable)
+        for regex, is_remainder, child in node.multi:
+            # at least one more segment, any number of them
+            variable.append((depth + 1, child.first))
+
+    def _set_bounds(self, node):
+        for child in node.literals.itervalues():
+            self._set_bounds(child)
+        for regex, child in node.regexes.itervalues():
+            self._set_bounds(child)
+        for regex, is_remainder, child in node.multi:
+            self._set_bounds(child)
+            if is_remainder:
+                continue
+            fixed, variable = {}, []
+            self._collect_lengths(child, 0, fixed, variable)
+            size = max(fixed.keys() + [d for d, index in variable] + [0]) + 1
+            table = []
+            for n in xrange(size):
+                candidates = [index for d, index in variable if d <= n]
+                if n in fixed:
+                    candidates.append(fixed[n])
+                table.append(min(candidates) if candidates else None)
+            tail = min(index for d, index in variable) if variable else None
+            child.bounds = (table, tail)
+
+    def _match(self, node, segments, i, matches, best):
+        """
+        Return the (index, pattern, matches) of the first pattern matching
+        segments[i:]. ``matches`` is a linked list of the match objects
+        collected on the way, so that nothing gets copied for branches that
+        fail.
+        """
+        count = len(segments)
+        suffixes = node.suffixes.get(count - i)
+        if suffixes:
+            rest = '/'.join(segments[i:])
+            for index, regex, pattern in suffixes:
+                if best is not None and index >= best[0]:
+                    break
+                if regex is None:
+                    best = (index, pattern, matches)
+                    break
+                match = regex.match(rest)
+                if match:
+                    best = (index, pattern, (match, matches))
+                    break
+
+        if node.variable is None or i == count or (best is not None and node.variable >= best[0]):
+            return best
+
+        segment = segments[i]
+        child = node.literals.get(segment)
+        if child is not None and (best is None or child.first < best[0]):
+            best = self._match(child, segments, i + 1, matches, best)
+
+        for regex, child in node.regexes.itervalues():
+            if best is not None and child.first >= best[0]:
+                continue
+            match = regex.match(segment)
+            if match:
+                best = self._match(child, segments, i + 1, (match, matches), best)
+
+        for regex, is_remainder, child in node.multi:
+            if best is not None and child.first >= best[0]:
+                continue
+            if is_remainder:
+                match = regex.match('/'.join(segments[i:]) + '/')
+                if match:
+                    best = self._match(child, segments, count, (match, matches), best)
+                continue
+            # Try the extents of the token ordered by the first pattern that
+            # could match the rest of the path after it, for the same pattern
+            # the longest first as the greedy regex would. Most extents can
+            # thus be skipped without matching anything.
+            table, tail = child.bounds
+            size = len(table)
+            candidates = []
+            for end in xrange(i + 1, count + 1):
+                rest = count - end
+                first = table[rest] if rest < size else tail
+                if first is not None and (best is None or first <= best[0]):
+                    candidates.append((first, -end))
+            candidates.sort()
+
+            # extent of the best match found here
+            extent = None
+            for first, end in candidates:
+                end = -end
+                if best is None:
+                    bound = None
+                elif first > best[0]:
+                    break
+                elif extent is not None and end > extent:
+                    # the best pattern can still match with a longer extent
+                    bound = (best[0] + 1, None, None)
+                elif first == best[0]:
+                    continue
+                else:
+                    bound = best
+                match = regex.match('/'.join(segments[i:end]))
+                if match:
+                    found = self._match(child, segments, end, (match, matches), bound)
+                    if found is not bound:
+                        best, extent = found, end
+        return best
+
+    def resolve(self, path):
+        if path == '':
+            segments = []
+        elif path.endswith('/'):
+            segments = path[:-1].split('/')
+        else:
+            return None
+
+        best = self._match(self.root, segments, 0, None, None)
+        if best is None:
+            return None
+
+        index, pattern, matches = best
+        kwargs = {}
+        while matches is not None:
+            match, matches = matches
+            # walking backwards, values matched later take precedence
+            for k, v in match.groupdict().iteritems():
+                kwargs.setdefault(k, v)
+        kwargs.update(pattern.default_args)
+        return ResolverMatch(pattern.callback, (), kwargs, pattern.name)
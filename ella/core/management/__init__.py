@@ -1,23 +1,45 @@
 from datetime import datetime, date
 
-from ella.core.signals import content_published, content_unpublished
+from ella.core.signals import content_published, content_unpublished, \
+        content_published_bulk, content_unpublished_bulk
 from ella.core.models import Publishable, Listing
 
-def generate_publish_signals(now=None):
+def announce(publishables, published=True):
+    """
+    Send ``content_published`` (or ``content_unpublished`` if ``published`` is
+    False) for each of ``publishables`` followed by the bulk variant for all
+    of them and mark exactly those as (not) announced.
+    """
+    if published:
+        signal, bulk_signal = content_published, content_published_bulk
+    else:
+        signal, bulk_signal = content_unpublished, content_unpublished_bulk
+    for p in publishables:
+        signal.send(sender=p.content_type.model_class(), publishable=p, bulk=True)
+    bulk_signal.send(sender=Publishable, publishables=publishables)
+
+    Publishable.objects.filter(pk__in=[p.pk for p in publishables]).update(announced=published)
+
+def _announce(qset, published, chunk_size):
+    last_pk = 0
+    while True:
+        chunk = list(qset.filter(pk__gt=last_pk).order_by('pk')[:chunk_size])
+        if not chunk:
+            break
+        last_pk = chunk[-1].pk
+        announce(chunk, published)
+
+def generate_publish_signals(now=None, chunk_size=1000):
     if now is None:
         now = datetime.now()
 
     # content that went live and isn't announced yet
     qset = Publishable.objects.filter(announced=False, publish_from__lt=now, published=True).exclude(publish_to__lt=now)
-    for p in qset:
-        content_published.send(sender=p.content_type.model_class(), publishable=p)
-    qset.update(announced=True)
+    _announce(qset, True, chunk_size)
 
     # content that went down but was announced as live
     qset = Publishable.objects.filter(announced=True, publish_to__lt=now, published=True)
-    for p in qset:
-        content_unpublished.send(sender=p.content_type.model_class(), publishable=p)
-    qset.update(announced=False)
+    _announce(qset, False, chunk_size)
 
 def regenerate_listing_handlers(today=None):
     if today is None:
@@ -0,0 +1,13 @@
+from django.core.management.base import BaseCommand
+
+from ella.core.models import CategoryClosure
+
+
+class Command(BaseCommand):
+
+    help = 'Recompute the closure of the category tree, eg. after loading categories from fixtures'
+
+    def handle(self, *args, **options):
+        CategoryClosure.objects.rebuild()
+        if int(options['verbosity']) > 0:
+            self.stdout.write('Rebuilt %d category closure records\n' % CategoryClosure.objects.count())
@@ -0,0 +1,43 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from ella.core.cache import redis
+from ella.core.models import Category
+
+
+class Command(BaseCommand):
+
+    help = 'Regenerate listings stored in redis from the database'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--category',
+            dest='category',
+            default=None,
+            help='Only rebuild listings of category with given tree_path and its descendants'),
+        make_option('--chunk-size',
+            dest='chunk_size',
+            type='int',
+            default=1000,
+            help='Number of listings read from the database and written to redis at once'),
+        )
+
+    def handle(self, *args, **options):
+        if redis.client is None:
+            raise CommandError('Redis listings are not configured, set LISTINGS_REDIS.')
+
+        category = None
+        if options['category'] is not None:
+            try:
+                category = Category.objects.get_by_tree_path(options['category'])
+            except Category.DoesNotExist:
+                raise CommandError('Category with tree_path "%s" does not exist.' % options['category'])
+
+        verbosity = int(options['verbosity'])
+        def progress(done, total, elapsed):
+            if verbosity > 1:
+                self.stdout.write('%d/%d listings (%.0f listings/sec)\n' % (done, total, elapsed and done / elapsed or 0))
+
+        stats = redis.rebuild_listings(category, chunk_size=options['chunk_size'], progress=progress)
+        if verbosity > 0:
+            self.stdout.write('Rebuilt %(keys)d keys from %(listings)d listings in %(seconds).1fs (%(rate).0f listings/sec)\n' % stats)
@@ -0,0 +1,42 @@
+import time
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from ella.core.cache import redis
+
+
+class Command(BaseCommand):
+
+    help = 'Announce scheduled publishing and unpublishing of content as it happens'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--interval',
+            dest='interval',
+            type='float',
+            default=5,
+            help='Number of seconds to wait between checks'),
+        make_option('--batch-size',
+            dest='batch_size',
+            type='int',
+            default=1000,
+            help='Number of publishables announced at once'),
+        make_option('--once',
+            action='store_true',
+            dest='once',
+            default=False,
+            help='Process due items and exit'),
+        )
+
+    def handle(self, *args, **options):
+        if redis.client is None:
+            raise CommandError('Redis is not configured, set LISTINGS_REDIS.')
+
+        verbosity = int(options['verbosity'])
+        while True:
+            processed = redis.process_schedule(batch_size=options['batch_size'])
+            if processed and verbosity > 1:
+                self.stdout.write('Processed %d publishables\n' % processed)
+            if options['once']:
+                break
+            time.sleep(options['interval'])
@@ -1,14 +1,20 @@
+import time
 from datetime import datetime
 from operator import attrgetter
 
-from django.db import models
+from django.db import models, connections, transaction
 from django.core.exceptions import ImproperlyConfigured
 from django.utils.importlib import import_module
 from django.utils.encoding import smart_str
 from django.db.models.loading import get_model
 from django.conf import settings
+from django.core.cache import cache
+from django.core.cache.backends.dummy import DummyCache
+from django.contrib.contenttypes.models import ContentType
 
 from ella.core.cache import cache_this
+from ella.core.cache.utils import track_dependency
+from ella.core.box import invalidate_dependencies
 from ella.core.conf import core_settings
 
 def _import_module_member(modstr, noun):
@@ -23,61 +29,148 @@ def _import_module_member(modstr, noun):
         raise ImproperlyConfigured('Error importing %s %s: "%s"' % (noun, modstr, e))
     return member
 
+CATEGORY_TREE_VERSION_KEY = 'core.category.version'
+
+class CategoryTree(object):
+    """
+    Snapshot of all categories of all sites indexed by pk, by (site_id,
+    tree_path) and by parent. It's never modified once built, a new one
+    replaces it whenever a category changes.
+    """
+    def __init__(self, categories, version):
+        self.version = version
+        self.created = time.time()
+        self.by_pk = {}
+        self.by_path = {}
+        children = {}
+        for c in categories:
+            self.by_pk[c.pk] = c
+            self.by_path[(c.site_id, c.tree_path)] = c
+            children.setdefault(c.tree_parent_id, []).append(c)
+        self.children = dict((pk, tuple(cats)) for pk, cats in children.iteritems())
+
 class CategoryManager(models.Manager):
-    _cache = {}
-    _hierarchy = {}
+    # how often to check for changes made by other processes, in seconds
+    VERSION_CHECK_INTERVAL = 1
+
+    _tree = None
+    _checked = 0
+
+    def get_tree(self):
+        """
+        Return the current ``CategoryTree``. It's loaded in one query and
+        reloaded when the version key in the cache changes (checked at most
+        every ``VERSION_CHECK_INTERVAL`` seconds) or after ``CACHE_TIMEOUT``.
+        """
+        cls = self.__class__
+        tree = cls._tree
+        now = time.time()
+        if tree is None or now - cls._checked > cls.VERSION_CHECK_INTERVAL:
+            cls._checked = now
+            version = cache.get(CATEGORY_TREE_VERSION_KEY)
+            if tree is None or tree.version != version or now - tree.created > core_settings.CACHE_TIMEOUT:
+                tree = cls._tree = CategoryTree(self.order_by('title'), version)
+        return tree
+
     def get_for_id(self, pk):
         try:
-            return self.__class__._cache[settings.SITE_ID][pk]
+            cat = self.get_tree().by_pk[pk]
         except KeyError:
             cat = self.get(pk=pk)
-            self._add_to_cache(cat)
-            return cat
+        track_dependency(ContentType.objects.get_for_model(self.model).pk, pk)
+        return cat
 
     def get_by_tree_path(self, tree_path):
         try:
-            return self.__class__._cache[settings.SITE_ID][tree_path]
+            return self.get_tree().by_path[(settings.SITE_ID, tree_path)]
         except KeyError:
-            cat = self.get(site=settings.SITE_ID, tree_path=tree_path)
-            self._add_to_cache(cat)
-            return cat
-
-    def _add_to_cache(self, category):
-        cache = self.__class__._cache.setdefault(category.site_id, {})
-        # pk and tree_path can never clash, safe to store in one dict
-        cache[category.pk] = category
-        cache[category.tree_path] = category
+            return self.get(site=settings.SITE_ID, tree_path=tree_path)
 
     def clear_cache(self):
-        self.__class__._cache.clear()
-        self.__class__._hierarchy.clear()
-
-    def _load_hierarchy(self, site_id):
-        cache = self.__class__._cache.setdefault(site_id, {})
-        hierarchy = self.__class__._hierarchy.setdefault(site_id, {})
-        for c in self.filter(site=site_id).order_by('title'):
-            # make sure we are working with the instance already in cache
-            c = cache.setdefault(c.id, c)
-            hierarchy.setdefault(c.tree_parent_id, []).append(c)
-
-    def _retrieve_children(self, category):
-        if not self.__class__._hierarchy:
-            self._load_hierarchy(category.site_id)
-        return self.__class__._hierarchy[category.site_id].get(category.pk, [])
+        " Drop the tree in all processes, to be called after a category changes. "
+        self.__class__._tree = None
+        cache.set(CATEGORY_TREE_VERSION_KEY, repr(time.time()), core_settings.CACHE_TIMEOUT_LONG)
+
+    def get_parent(self, category):
+        " Return the parent of ``category`` (or None) from the category tree. "
+        if category.tree_parent_id is None:
+            return None
+        return self.get_for_id(category.tree_parent_id)
 
     def get_children(self, category, recursive=False):
-        #make sure this is the instance stored in our cache
-        self._add_to_cache(category)
-        children = self._retrieve_children(category)
+        tree = self.get_tree()
+        children = list(tree.children.get(category.pk, ()))
         if recursive:
             to_process = children[:]
             while to_process:
-                grand_children = self._retrieve_children(to_process.pop())
+                grand_children = tree.children.get(to_process.pop().pk, ())
                 children.extend(grand_children)
                 to_process.extend(grand_children)
             children = sorted(children, key=attrgetter('tree_path'))
         return children
 
+class CategoryClosureManager(models.Manager):
+    def rebuild(self, category=None):
+        """
+        Recompute the closure records for ``category`` and all its
+        descendants, to be called whenever it's saved. Without ``category``
+        the records of all categories are recomputed (see the
+        ``rebuild_category_closure`` command).
+        """
+        Category = self.model._meta.get_field('ancestor').rel.to
+
+        qset = Category.objects.all()
+        if category is not None:
+            qset = qset.filter(site=category.site_id)
+
+        categories = {}
+        hierarchy = {}
+        for c in qset.only('id', 'tree_parent', 'app_data'):
+            categories[c.id] = c
+            hierarchy.setdefault(c.tree_parent_id, []).append(c.id)
+
+        if category is None:
+            subtree = categories.keys()
+        else:
+            subtree = [category.pk]
+            to_process = [category.pk]
+            while to_process:
+                children = hierarchy.get(to_process.pop(), [])
+                subtree.extend(children)
+                to_process.extend(children)
+
+        rows = []
+        for pk in subtree:
+            depth = 0
+            propagates = True
+            ancestor = pk
+            while ancestor is not None:
+                rows.append((ancestor, pk, depth, propagates))
+                c = categories[ancestor]
+                if not c.app_data.get('ella', {}).get('propagate_listings', True):
+                    propagates = False
+                ancestor = c.tree_parent_id
+                depth += 1
+
+        if category is None:
+            self.all().delete()
+        else:
+            self.filter(descendant__in=subtree).delete()
+        self._insert(rows)
+
+    def _insert(self, rows):
+        " Insert (ancestor_id, descendant_id, depth, propagates) ``rows`` in one go. "
+        if not rows:
+            return
+        connection = connections[self.db]
+        qn = connection.ops.quote_name
+        opts = self.model._meta
+        columns = [opts.get_field(f).column for f in ('ancestor', 'descendant', 'depth', 'propagates')]
+        cursor = connection.cursor()
+        cursor.executemany('INSERT INTO %s (%s) VALUES (%s)' % (
+                qn(opts.db_table), ', '.join(map(qn, columns)), ', '.join(['%s'] * len(columns))), rows)
+        transaction.commit_unless_managed(using=self.db)
+
 class RelatedManager(models.Manager):
     def collect_related(self, finder_funcs, obj, count, *args, **kwargs):
         """
@@ -140,12 +233,19 @@ class ListingHandler(object):
     NONE = 0
     IMMEDIATE = 1
     ALL = 2
+
+    # get_listings accepts before and after cursors, get_cursor(listing)
+    # returns the cursor for a listing it returned
+    supports_cursors = False
+
     @classmethod
     def regenerate(cls, today=None):
         pass
 
 
     def __init__(self, category, children=NONE, content_types=[], date_range=(), exclude=None):
+        # boxes listing the category are rendered again once it changes
+        _track_listing_generation(category and category.pk)
         self.category = category
         self.children = children
         self.content_types = content_types
@@ -162,16 +262,113 @@ class ListingHandler(object):
         return self.get_listings(offset, count)
 
 
-def get_listings_key(self, category=None, children=ListingHandler.NONE, count=10, offset=0, content_types=[], date_range=(), exclude=None, **kwargs):
+LISTING_GENERATION_KEY_PREFIX = 'core.listing.gen'
+
+def _get_listing_generation_key(category_id):
+    return '%s:%s' % (LISTING_GENERATION_KEY_PREFIX, category_id or '')
+
+def _track_listing_generation(category_id):
+    # rendered boxes depend on the generation as if it was an object, see
+    # ella.core.box.store_boxes
+    track_dependency(LISTING_GENERATION_KEY_PREFIX, category_id or '')
+
+def get_listing_generation(category=None):
+    """
+    Return the current generation of listings in ``category`` and its
+    descendants, or of all listings if no category is given. The generation
+    changes every time any listing there can change and is part of the cache
+    keys of listings. Boxes rendered while it's being retrieved are
+    invalidated when a new generation starts.
+    """
+    category_id = category and category.pk
+    _track_listing_generation(category_id)
+    key = _get_listing_generation_key(category_id)
+    gen = cache.get(key)
+    if gen is None:
+        # missing generation (evicted or never set) is just a new one
+        cache.add(key, repr(time.time()), core_settings.CACHE_TIMEOUT_LISTING)
+        gen = cache.get(key)
+    return gen
+
+def bump_listing_generation(category_ids):
+    """
+    Start a new generation of listings for categories with given IDs, their
+    ancestors and for all listings and invalidate boxes that depend on them.
+
+    Categories are never loaded from the database, their ancestors are
+    taken from the category tree. The IDs can therefore belong to categories
+    that are just being deleted, those not found in the tree only get their
+    own generation bumped.
+    """
+    by_pk = get_model('core', 'category').objects.get_tree().by_pk
+    ids = set([None])
+    for pk in category_ids:
+        while pk is not None and pk not in ids:
+            ids.add(pk)
+            cat = by_pk.get(pk)
+            pk = cat and cat.tree_parent_id
+
+    gen = repr(time.time())
+    kw = {}
+    if not isinstance(cache, DummyCache):
+        kw['timeout'] = core_settings.CACHE_TIMEOUT_LISTING
+    cache.set_many(dict((_get_listing_generation_key(pk), gen) for pk in ids), **kw)
+    invalidate_dependencies([(LISTING_GENERATION_KEY_PREFIX, pk or '') for pk in ids])
+
+CURSOR_FORMAT = '%Y%m%d%H%M%S%f'
+
+def get_cursor(listing, grouped=False):
+    """
+    Return a string identifying position of ``listing`` in listings ordered
+    by ``publish_from`` and ``id``, used for keyset pagination. Listings
+    including children categories (``grouped``) are ordered by
+    ``publish_from`` and publishable's id instead, see ``get_listing``.
+    """
+    pk = grouped and listing.publishable_id or listing.id
+    return '%s-%d' % (listing.publish_from.strftime(CURSOR_FORMAT), pk)
+
+def parse_cursor(value):
+    """
+    Return a ``(publish_from, id)`` tuple from a string produced by
+    ``get_cursor`` or None if the string is not a valid cursor.
+    """
+    try:
+        publish_from, pk = value.split('-')
+        # strptime doesn't support %f in python 2.5
+        return datetime.strptime(publish_from[:14], CURSOR_FORMAT[:-2]).replace(microsecond=int(publish_from[14:] or 0)), int(pk)
+    except ValueError:
+        return None
+
+def _get_cursor_key(cursor):
+    if not cursor:
+        return ''
+    return '%s-%d' % (cursor[0].strftime(CURSOR_FORMAT), cursor[1])
+
+def get_listings_key(self, category=None, children=ListingHandler.NONE, count=10, offset=0, content_types=[], date_range=(), exclude=None, before=None, after=None, **kwargs):
     c = category and  category.id or ''
 
-    return 'core.get_listing:%s:%d:%d:%d:%d:%s:%s:%s' % (
+    # the generation is stored with the value (see get_listings_version) so
+    # that the previous generation can be served while the new one is computed
+    return 'core.get_listing:%s:%d:%d:%d:%d:%s:%s:%s:%s:%s' % (
             c, count, offset, children, exclude.id if exclude else 0,
             ','.join(map(lambda ct: str(ct.pk), content_types)),
             ','.join(map(lambda d: d.strftime('%Y%m%d'), date_range)),
+            _get_cursor_key(before), _get_cursor_key(after),
             ','.join(':'.join((k, smart_str(v))) for k, v in kwargs.items()),
     )
 
+def get_listings_version(self, category=None, *args, **kwargs):
+    return get_listing_generation(category)
+
+def get_listing_count_key(self, category=None, children=ListingHandler.NONE, content_types=[], date_range=(), exclude=None):
+    c = category and  category.id or ''
+
+    return 'core.get_listing_count:%s:%s:%d:%d:%s:%s' % (
+            c, get_listing_generation(category), children, exclude.id if exclude else 0,
+            ','.join(map(lambda ct: str(ct.pk), content_types)),
+            ','.join(map(lambda d: d.strftime('%Y%m%d'), date_range)),
+    )
+
 class ListingManager(models.Manager):
     def clean_listings(self):
         """
@@ -201,21 +398,12 @@ class ListingManager(models.Manager):
             if children == ListingHandler.NONE:
                 # only this one category
                 qset = qset.filter(category=category)
-            elif children == ListingHandler.IMMEDIATE:
-                # this category and its children
-                qset = qset.filter(models.Q(category__tree_parent=category) | models.Q(category=category))
-
-                for c in category.get_children():
-                    if not c.app_data.get('ella', {}).get('propagate_listings', True):
-                        qset = qset.exclude(category=c)
-
-            elif children == ListingHandler.ALL:
-                # this category and all its descendants
-                qset = qset.filter(category__tree_path__startswith=category.tree_path, category__site=category.site_id)
-
-                for c in category.get_children(True):
-                    if not c.app_data.get('ella', {}).get('propagate_listings', True):
-                        qset = qset.exclude(category__tree_path__startswith=c.tree_path)
+            elif children in (ListingHandler.IMMEDIATE, ListingHandler.ALL):
+                # this category and its children/all its descendants
+                descendants = get_model('core', 'categoryclosure').objects.filter(ancestor=category, propagates=True)
+                if children == ListingHandler.IMMEDIATE:
+                    descendants = descendants.filter(depth__lte=1)
+                qset = qset.filter(category__in=descendants.values('descendant'))
 
             else:
                 raise AttributeError('Invalid children value (%s) - should be one of (%s, %s, %s)' % (children, self.NONE, self.IMMEDIATE, self.ALL))
@@ -228,10 +416,21 @@ class ListingManager(models.Manager):
         if exclude:
             qset = qset.exclude(publishable=exclude)
 
-        return qset.exclude(publish_to__lt=now).order_by('-publish_from')
+        return qset.exclude(publish_to__lt=now).order_by('-publish_from', '-id')
 
-    @cache_this(get_listings_key)
-    def get_listing(self, category=None, children=ListingHandler.NONE, count=10, offset=0, content_types=[], date_range=(), exclude=None, **kwargs):
+    @cache_this(get_listing_count_key, timeout=core_settings.CACHE_TIMEOUT_LISTING)
+    def get_listing_count(self, category=None, children=ListingHandler.NONE, content_types=[], date_range=(), exclude=None):
+        """
+        Cached count of listings matching the parameters, see get_listing.
+        """
+        qset = self.get_listing_queryset(category, children, content_types, date_range, exclude)
+        if children != ListingHandler.NONE:
+            # get_listing returns every publishable only once
+            qset = qset.order_by().values('publishable').distinct()
+        return qset.count()
+
+    @cache_this(get_listings_key, timeout=core_settings.CACHE_TIMEOUT_LISTING, stale_timeout=core_settings.CACHE_TIMEOUT, beta=1, version_getter=get_listings_version)
+    def get_listing(self, category=None, children=ListingHandler.NONE, count=10, offset=0, content_types=[], date_range=(), exclude=None, before=None, after=None, **kwargs):
         """
         Get top objects for given category and potentionally also its child categories.
 
@@ -241,10 +440,18 @@ class ListingManager(models.Manager):
             offset - starting with object number... 1-based
             content_types - list of ContentTypes to list, if empty, object from all models are included
             date_range - range for listing's publish_from field
+            before - (publish_from, id) cursor, only list objects older than that
+            after - (publish_from, id) cursor, only list objects newer than that
             **kwargs - rest of the parameter are passed to the queryset unchanged
+
+        Cursors (see get_cursor and parse_cursor) cannot be combined with
+        offset, but unlike it they don't make the database scan all the
+        skipped rows. With ``children`` every publishable is only listed
+        once and the id in cursors is the publishable's.
         """
         assert offset >= 0, "Offset must be a positive integer"
         assert count >= 0, "Count must be a positive integer"
+        assert not (offset and (before or after)), "Offset cannot be combined with a cursor"
 
         if not count:
             return []
@@ -253,27 +460,52 @@ class ListingManager(models.Manager):
 
         qset = self.get_listing_queryset(category, children, content_types, date_range, exclude, **kwargs)
 
-        # direct listings, we don't need to check for duplicates
         if children == ListingHandler.NONE:
+            # direct listings, we don't need to check for duplicates
+            if before:
+                publish_from, pk = before
+                qset = qset.filter(models.Q(publish_from__lt=publish_from) | models.Q(publish_from=publish_from, id__lt=pk))
+            elif after:
+                # go the other way and reverse the result
+                publish_from, pk = after
+                qset = qset.filter(models.Q(publish_from__gt=publish_from) | models.Q(publish_from=publish_from, id__gt=pk))
+                return list(qset.order_by('publish_from', 'id')[offset:limit])[::-1]
             return qset[offset:limit]
 
-        seen = set()
-        out = []
-        while len(out) < count:
-            skip = 0
-            # 2 i a reasonable value for padding, wouldn't you say dear Watson?
-            for l in qset[offset:limit + 2]:
-                if l.publishable_id not in seen:
-                    seen.add(l.publishable_id)
-                    out.append(l)
-                    if len(out) == count:
-                        break
-                else:
-                    skip += 1
-            if skip <= 2:
-                break
-
-        return out
+        if after:
+            return self._get_grouped_listing(qset, offset, limit, after, ascending=True)[::-1]
+        return self._get_grouped_listing(qset, offset, limit, before)
+
+    def _get_grouped_listing(self, qset, offset, limit, cursor=None, ascending=False):
+        """
+        One listing per publishable, the one with the latest publish_from,
+        ordered by that publish_from and publishable's id. ``cursor`` is
+        compared against the same (publish_from, publishable id) pair.
+        """
+        groups = qset.order_by().values('publishable').annotate(last=models.Max('publish_from'))
+        if ascending:
+            groups, op = groups.order_by('last', 'publishable'), 'gt'
+        else:
+            groups, op = groups.order_by('-last', '-publishable'), 'lt'
+
+        if cursor:
+            # the cursor has to be applied to the aggregate (HAVING), the
+            # publishables tied with it go first in a separate query since
+            # the ORM cannot OR the two conditions together
+            publish_from, pk = cursor
+            ids = [row['publishable'] for row in groups.filter(last=publish_from, **{'publishable__%s' % op: pk})[:limit]]
+            if len(ids) < limit:
+                ids.extend(row['publishable'] for row in groups.filter(**{'last__%s' % op: publish_from})[:limit - len(ids)])
+        else:
+            ids = [row['publishable'] for row in groups[offset:limit]]
+
+        if not ids:
+            return []
+
+        listings = {}
+        for l in qset.filter(publishable__in=ids).order_by('-publish_from', '-id'):
+            listings.setdefault(l.publishable_id, l)
+        return [listings[pk] for pk in ids]
 
     def get_listing_handler(self, source, fallback=True):
         if not hasattr(self, '_listing_handlers'):
@@ -302,7 +534,12 @@ class ListingManager(models.Manager):
 
 
 class ModelListingHandler(ListingHandler):
-    def get_listings(self, offset=0, count=10):
+    supports_cursors = True
+
+    def get_cursor(self, listing):
+        return get_cursor(listing, self.children != ListingHandler.NONE)
+
+    def get_listings(self, offset=0, count=10, before=None, after=None):
         Listing = get_model('core', 'listing')
         return Listing.objects.get_listing(
                 self.category,
@@ -311,18 +548,20 @@ class ModelListingHandler(ListingHandler):
                 date_range=self.date_range,
                 offset=offset,
                 count=count,
-                exclude=self.exclude
+                exclude=self.exclude,
+                before=before,
+                after=after
             )
 
     def count(self):
         if not hasattr(self, '_count'):
             Listing = get_model('core', 'listing')
-            self._count = Listing.objects.get_listing_queryset(
+            self._count = Listing.objects.get_listing_count(
                 self.category,
                 children=self.children,
                 content_types=self.content_types,
                 date_range=self.date_range,
                 exclude=self.exclude
-            ).count()
+            )
         return self._count
 
@@ -9,6 +9,7 @@ from django.core.cache import cache
 from django.utils.cache import get_cache_key, add_never_cache_headers, learn_cache_key
 from django.conf import settings
 from ella.core.conf import core_settings
+from ella.core.cache.utils import activate_identity_map, deactivate_identity_map
 
 class DoubleRenderMiddleware(object):
 
@@ -47,6 +48,26 @@ class DoubleRenderMiddleware(object):
 
         return response
 
+class IdentityMapMiddleware(object):
+    """
+    Keeps a request-scoped identity map in front of the shared cache so that
+    objects retrieved via ``get_cached_object`` and ``get_cached_objects``
+    (and therefore ``CachedForeignKey``, ``CachedGenericForeignKey`` and the
+    ``{% box %}`` tag) are fetched from the cache only once per request.
+
+    Should be placed as high as possible in MIDDLEWARE_CLASSES so that the map
+    is active for the whole request, including template rendering.
+    """
+    def process_request(self, request):
+        activate_identity_map()
+
+    def process_exception(self, request, exception):
+        deactivate_identity_map()
+
+    def process_response(self, request, response):
+        deactivate_identity_map()
+        return response
+
 class CacheMiddleware(DjangoCacheMiddleware):
     def process_request(self, request):
         resp = super(CacheMiddleware, self).process_request(request)
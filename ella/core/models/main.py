@@ -1,4 +1,5 @@
 from django.db import models
+from django.db.models.signals import post_save
 from django.core.urlresolvers import reverse
 from django.utils.translation import ugettext_lazy as _
 from django.conf import settings
@@ -12,7 +13,7 @@ from jsonfield.fields import JSONField
 from ella.core.box import Box
 from ella.core.cache import CachedGenericForeignKey, SiteForeignKey, ContentTypeForeignKey, CategoryForeignKey, CachedForeignKey
 from ella.core.conf import core_settings
-from ella.core.managers import CategoryManager
+from ella.core.managers import CategoryManager, CategoryClosureManager
 
 
 class Author(models.Model):
@@ -115,8 +116,8 @@ class Category(models.Model):
                 self.tree_path = self.slug
         else:
             self.tree_path = ''
-        Category.objects.clear_cache()
         super(Category, self).save(**kwargs)
+        Category.objects.clear_cache()
         if old_tree_path != self.tree_path:
             # the tree_path has changed, update children
             children = Category.objects.filter(
@@ -179,6 +180,42 @@ class Category(models.Model):
     draw_title.allow_tags = True
 
 
+class CategoryClosure(models.Model):
+    """
+    Transitive closure of the category tree - one record for every category
+    and each of its ancestors (including itself with ``depth`` of 0). Used to
+    select listings from a category and its descendants using an indexed
+    lookup. Maintained automatically whenever a ``Category`` is saved, except
+    for raw saves (``loaddata``) - run the ``rebuild_category_closure``
+    command after loading categories from fixtures.
+
+    ``propagates`` is ``False`` if listings from ``descendant`` shouldn't
+    show up in ``ancestor`` because some category on the path between them
+    has ``propagate_listings`` turned off in its ``app_data``.
+    """
+    ancestor = models.ForeignKey(Category, related_name='descendant_links')
+    descendant = models.ForeignKey(Category, related_name='ancestor_links')
+    depth = models.PositiveIntegerField()
+    propagates = models.BooleanField(default=True)
+
+    objects = CategoryClosureManager()
+
+    class Meta:
+        app_label = 'core'
+        unique_together = (('ancestor', 'descendant'),)
+        verbose_name = _('Category closure')
+        verbose_name_plural = _('Category closures')
+
+    def __unicode__(self):
+        return u'%s > %s' % (self.ancestor_id, self.descendant_id)
+
+def rebuild_category_closure(sender, instance, raw=False, **kwargs):
+    # fixtures are loaded in no particular order, parents may be missing
+    if not raw:
+        CategoryClosure.objects.rebuild(instance)
+post_save.connect(rebuild_category_closure, sender=Category)
+
+
 class Dependency(models.Model):
     """
     Captures relations between objects to simplify finding out what other objects
@@ -9,16 +9,19 @@ from django.core.urlresolvers import reverse
 from django.contrib.redirects.models import Redirect
 from django.core.validators import validate_slug
 from django.core.exceptions import ValidationError
+from django.db.models.signals import pre_save, post_save, post_delete, class_prepared
 
 from jsonfield.fields import JSONField
 
 from ella.core.box import Box
 from ella.core.conf import core_settings
-from ella.core.signals import content_published, content_unpublished
+from ella.core.signals import content_published, content_unpublished, \
+        content_published_bulk, content_unpublished_bulk, \
+        connect_publishable_signal, publishable_prepared
 from ella.core.cache import CachedGenericForeignKey, \
     CachedForeignKey, ContentTypeForeignKey, CategoryForeignKey
-from ella.core.managers import ListingManager, RelatedManager
-from ella.core.models.main import Author, Source
+from ella.core.managers import ListingManager, RelatedManager, bump_listing_generation
+from ella.core.models.main import Author, Source, Category
 from ella.photos.models import Photo
 
 def PublishableBox(publishable, box_type, nodelist, model=None):
@@ -200,9 +203,10 @@ class Publishable(models.Model):
             content_unpublished.send(sender=self.__class__, publishable=self)
         return super(Publishable, self).delete()
 
-    def is_published(self):
-        "Return True if the Publishable is currently active."
-        now = datetime.now()
+    def is_published(self, now=None):
+        "Return True if the Publishable is currently (or at ``now``) active."
+        if now is None:
+            now = datetime.now()
         return self.published and now > self.publish_from and \
             (self.publish_to is None or now < self.publish_to)
 
@@ -288,3 +292,55 @@ class Related(models.Model):
         return _(u'%s relates to %s') % (self.publishable, self.related)
 
 
+
+
+def _get_listed_category_ids(publishable):
+    # IDs only, the categories can be just being deleted
+    cats = set([publishable.category_id])
+    cats.update(Listing.objects.filter(publishable=publishable).values_list('category', flat=True))
+    return cats
+
+def publishable_changed(sender, instance=None, publishable=None, bulk=False, **kwargs):
+    " Start new generation of listings containing the publishable. "
+    publishable = publishable or instance
+    # handled by publishables_changed
+    if isinstance(publishable, Publishable) and not bulk:
+        bump_listing_generation(_get_listed_category_ids(publishable))
+
+def publishables_changed(sender, publishables, **kwargs):
+    cats = set(p.category_id for p in publishables)
+    cats.update(Listing.objects.filter(publishable__in=publishables).values_list('category', flat=True))
+    bump_listing_generation(cats)
+
+def listing_pre_save(sender, instance, **kwargs):
+    if instance.pk:
+        old = Listing.objects.filter(pk=instance.pk).values_list('category', flat=True)
+        if old and old[0] != instance.category_id:
+            bump_listing_generation(old)
+
+def listing_changed(sender, instance, **kwargs):
+    bump_listing_generation([instance.category_id])
+
+def category_deleted(sender, instance, **kwargs):
+    # listings of a deleted category (and of its deleted descendants) don't
+    # know its ancestors anymore, see bump_listing_generation
+    bump_listing_generation([instance.tree_parent_id])
+
+def register_publishable(sender, **kwargs):
+    if issubclass(sender, Publishable):
+        publishable_prepared(sender)
+
+# subclasses are defined (and prepared) after this module is imported
+register_publishable(Publishable)
+class_prepared.connect(register_publishable)
+# only listen to saves of publishables, not of every model
+connect_publishable_signal(post_save, publishable_changed)
+connect_publishable_signal(post_delete, publishable_changed)
+content_published.connect(publishable_changed)
+content_unpublished.connect(publishable_changed)
+content_published_bulk.connect(publishables_changed)
+content_unpublished_bulk.connect(publishables_changed)
+pre_save.connect(listing_pre_save, sender=Listing)
+post_save.connect(listing_changed, sender=Listing)
+post_delete.connect(listing_changed, sender=Listing)
+post_delete.connect(category_deleted, sender=Category)
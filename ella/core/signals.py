@@ -6,8 +6,42 @@ content_published = Signal(providing_args=['publishable'])
 # and when it's taken down
 content_unpublished = Signal(providing_args=['publishable'])
 
+# a chunk of Publishables became live or was taken down at once, fired by
+# generate_publish_signals after content_published/content_unpublished were
+# sent (with bulk=True) for each of them
+content_published_bulk = Signal(providing_args=['publishables'])
+content_unpublished_bulk = Signal(providing_args=['publishables'])
+
 # category or publishable is about to be rendered
 object_rendering = Signal(providing_args=['request', 'category', 'publishable'])
 
 # category or publishable was rendered
 object_rendered = Signal(providing_args=['request', 'category', 'publishable'])
+
+# (signal, receiver) pairs connected to Publishable and all its subclasses
+# and the models prepared so far, see connect_publishable_signal
+_publishable_receivers = []
+_publishable_models = []
+
+def connect_publishable_signal(signal, receiver):
+    """
+    Connect ``receiver`` to a model ``signal`` (``post_save``,
+    ``post_delete``...) sent by ``Publishable`` and its subclasses only,
+    including the ones defined later, instead of by every model.
+    """
+    _publishable_receivers.append((signal, receiver))
+    for model in _publishable_models:
+        signal.connect(receiver, sender=model)
+
+def disconnect_publishable_signal(signal, receiver):
+    " Undo ``connect_publishable_signal``. "
+    while (signal, receiver) in _publishable_receivers:
+        _publishable_receivers.remove((signal, receiver))
+    for model in _publishable_models:
+        signal.disconnect(receiver, sender=model)
+
+def publishable_prepared(model):
+    " Register ``Publishable`` or its subclass ``model`` once it's prepared. "
+    _publishable_models.append(model)
+    for signal, receiver in _publishable_receivers:
+        signal.connect(receiver, sender=model)
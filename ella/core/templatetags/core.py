@@ -10,7 +10,7 @@ from django.contrib.contenttypes.models import ContentType
 from ella.core.models import Listing, Category
 from ella.core.managers import ListingHandler
 from ella.core.cache.utils import get_cached_object
-from ella.core.box import Box
+from ella.core.box import Box, BoxBatch
 
 
 log = logging.getLogger('ella.core.templatetags')
@@ -167,6 +167,14 @@ class EmptyNode(template.Node):
 
 class ObjectNotFoundOrInvalid(Exception): pass
 
+BOX_BATCH_VAR = '_box_batch'
+
+def _get_box_batch(context):
+    batch = context.get(BOX_BATCH_VAR)
+    if batch is not None and batch.active:
+        return batch
+    return None
+
 class BoxNode(template.Node):
 
     def __init__(self, box_type, nodelist, model=None, lookup=None, var=None):
@@ -184,6 +192,12 @@ class BoxNode(template.Node):
             else:
                 lookup_val = self.lookup[1]
 
+            batch = _get_box_batch(context)
+            if batch is not None and self.lookup[0] == 'pk':
+                obj = batch.get_object(self.model, lookup_val)
+                if obj is not None:
+                    return obj
+
             try:
                 obj = get_cached_object(self.model, **{self.lookup[0] : lookup_val})
             except (models.ObjectDoesNotExist, AssertionError), e:
@@ -214,6 +228,9 @@ class BoxNode(template.Node):
             return ''
 
         # render the box
+        batch = _get_box_batch(context)
+        if batch is not None:
+            return batch.defer(box, context)
         return box.render(context)
 
 @register.tag('box')
@@ -314,6 +331,59 @@ def _parse_box(nodelist, bits):
             pass
         return BoxNode(bits[1], nodelist, model=model, lookup=(smart_str(bits[5]), lookup_val))
 
+class PrefetchBoxesNode(template.Node):
+    def __init__(self, nodelist):
+        self.nodelist = nodelist
+
+    def render(self, context):
+        batch = BoxBatch()
+
+        lookups = []
+        for node in self.nodelist.get_nodes_by_type(BoxNode):
+            if not node.model or node.lookup[0] != 'pk':
+                continue
+            lookup_val = node.lookup[1]
+            if isinstance(lookup_val, template.Variable):
+                try:
+                    lookup_val = lookup_val.resolve(context)
+                except template.VariableDoesNotExist:
+                    # variable set within the block (loop variable etc.)
+                    continue
+            lookups.append((ContentType.objects.get_for_model(node.model).pk, lookup_val))
+        if lookups:
+            batch.prefetch(lookups)
+
+        context.push()
+        context[BOX_BATCH_VAR] = batch
+        output = self.nodelist.render(context)
+        context.pop()
+
+        return batch.finish(output)
+
+@register.tag
+def prefetchboxes(parser, token):
+    """
+    Render all the boxes within the block in one batch - retrieve the target
+    objects given by ``pk`` lookup in one go and fetch all the rendered boxes
+    from cache using one ``get_many`` call instead of one call per box.
+
+    Usage::
+
+        {% prefetchboxes %}
+            {% for l in listings %}
+                {% box listing for l %}{% endbox %}
+            {% endfor %}
+            {% box sidebar for articles.article with pk 1 %}{% endbox %}
+        {% endprefetchboxes %}
+    """
+    bits = token.split_contents()
+    if len(bits) != 1:
+        raise template.TemplateSyntaxError, "%r tag takes no arguments" % bits[0]
+
+    nodelist = parser.parse(('end' + bits[0],))
+    parser.delete_first_token()
+    return PrefetchBoxesNode(nodelist)
+
 class RenderNode(template.Node):
     def __init__(self, var):
         self.var = template.Variable(var)
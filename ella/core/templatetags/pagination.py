@@ -12,7 +12,9 @@ def _do_paginator(context, adjacent_pages, template_name):
     else:
         template_name = 'inclusion_tags/paginator_%s.html' % template_name
 
-    if not 'page' in context:
+    if context.get('page') is None:
+        if context.get('next_cursor') or context.get('prev_cursor'):
+            return template_name, _do_cursor_paginator(context)
         # improper use of paginator tag, bail out
         return template_name, {}
 
@@ -38,6 +40,25 @@ def _do_paginator(context, adjacent_pages, template_name):
     }
 
 
+def _do_cursor_paginator(context):
+    " Links to the next and previous page of listings paginated by cursors. "
+    query_params = '?'
+    if 'request' in context:
+        get = context['request'].GET
+        params = urlencode(dict((k, smart_str(v)) for (k, v) in get.iteritems() if k not in ('p', 'before', 'after')))
+        if params:
+            query_params = '?%s&' % params
+
+    next_cursor, prev_cursor = context.get('next_cursor'), context.get('prev_cursor')
+    return {
+        'cursor': True,
+        'query_params': query_params,
+        'results_per_page': context.get('results_per_page'),
+        'next_url': next_cursor and '%sbefore=%s' % (query_params, next_cursor) or None,
+        'prev_url': prev_cursor and '%safter=%s' % (query_params, prev_cursor) or None,
+    }
+
+
 @register.simple_tag(takes_context=True)
 def paginator(context, adjacent_pages=2, template_name=None):
     """
@@ -54,6 +75,11 @@ def paginator(context, adjacent_pages=2, template_name=None):
 
     Taken from http://www.djangosnippets.org/snippets/73/
 
+    When the listing is paginated by cursors (``?before=`` or ``?after=``
+    instead of ``?p=``), there are no page numbers and the template gets
+    ``cursor`` set to ``True`` and ``next_url`` and ``prev_url`` (``None``
+    when there is no such page) instead.
+
     Syntax::
 
         {% paginator [NUMBER_OF_ADJACENT_PAGES] [TEMPLATE_NAME] %}
@@ -16,6 +16,8 @@ except:
     pass
 
 from ella.core.feeds import RSSTopCategoryListings, AtomTopCategoryListings
+from ella.core.dispatcher import SegmentDispatcher
+from ella.core.conf import core_settings
 
 
 res = {
@@ -84,3 +86,6 @@ urlpatterns = patterns( '',
     url( r'^%(cat)s/$' % res, category_detail, name="category_detail" ),
 
 )
+
+if core_settings.URL_DISPATCHER:
+    urlpatterns.insert(0, SegmentDispatcher(urlpatterns, multi_segment=[res['cat']], remainder=[res['rest']]))
@@ -14,7 +14,8 @@ from ella.core.models import Listing, Category, Publishable
 from ella.core.cache import get_cached_object_or_404, cache_this
 from ella.core import custom_urls
 from ella.core.conf import core_settings
-from ella.core.managers import ListingHandler
+from ella.core.managers import ListingHandler, get_listing_generation, \
+        parse_cursor
 from ella.core.signals import object_rendering, object_rendered
 
 __docformat__ = "restructuredtext en"
@@ -158,7 +159,7 @@ class ObjectDetail(EllaCoreView):
         return context
 
 def archive_year_cache_key(self, category):
-    return 'core.archive_year:%d' % category.pk
+    return 'core.archive_year:%d:%s' % (category.pk, get_listing_generation(category))
 
 class ListContentType(EllaCoreView):
     """
@@ -188,9 +189,12 @@ class ListContentType(EllaCoreView):
     * ``category``
     * ``listings``: list of ``Listing`` objects ordered by date
 
-    * ``page``: ``django.core.paginator.Page`` instance
+    * ``page``: ``django.core.paginator.Page`` instance, ``None`` when paginating by cursor
     * ``is_paginated``: ``True`` if there are more pages
     * ``results_per_page``: number of objects on one page
+    * ``next_cursor``, ``prev_cursor``: values for ``before`` and ``after``
+      GET parameters pointing to the next (older) and previous page, if
+      the listing handler supports them
 
     * ``content_type``: ``ContentType`` of the objects, if filtered on content type
     * ``content_type_name``: name of the objects' type, if filtered on content type
@@ -200,6 +204,7 @@ class ListContentType(EllaCoreView):
     :param year, month, day: date matching the ``publish_from`` field of the ``Listing`` object.
     :param content_type: slugified verbose_name_plural of the target model, if omitted all content_types are listed
     :param page_no: which page to display
+    :param before, after: cursors (GET parameters) to paginate by instead of ``page_no``, deep pages are much cheaper this way
     :keyword paginate_by: number of records in one page
 
     All parameters are optional, filtering is done on those supplied
@@ -313,23 +318,60 @@ class ListContentType(EllaCoreView):
 
         paginate_by = cat.app_data.get('ella', {}).get('paginate_by', core_settings.CATEGORY_LISTINGS_PAGINATE_BY)
         qset = Listing.objects.get_queryset_wrapper(**kwa)
-        paginator = Paginator(qset, paginate_by)
 
-        if page_no > paginator.num_pages or page_no < 1:
-            return self._handle_404(_('Invalid page number %r') % page_no,
-                is_homepage)
+        supports_cursors = getattr(qset, 'supports_cursors', False)
+        cursor = {}
+        if supports_cursors:
+            for k in ('before', 'after'):
+                if k in request.GET:
+                    cursor[k] = parse_cursor(request.GET[k])
+                    if cursor[k] is None:
+                        return self._handle_404(_('Invalid cursor %r') % request.GET[k],
+                            is_homepage)
+
+        if cursor:
+            # keyset pagination, get one more to see if there is another page
+            listings = qset.get_listings(count=paginate_by + 1, **cursor)
+            has_more = len(listings) > paginate_by
+            if 'before' in cursor:
+                listings = listings[:paginate_by]
+                has_next, has_previous = has_more, True
+            else:
+                listings = listings[-paginate_by:]
+                has_next, has_previous = True, has_more
+            page = None
+            is_paginated = True
+            category_title_page = False
+        else:
+            paginator = Paginator(qset, paginate_by)
+
+            if page_no > paginator.num_pages or page_no < 1:
+                return self._handle_404(_('Invalid page number %r') % page_no,
+                    is_homepage)
+
+            page = paginator.page(page_no)
+            listings = page.object_list
+            has_next, has_previous = page.has_next(), page.has_previous()
+            is_paginated = paginator.num_pages > 1
 
-        page = paginator.page(page_no)
-        listings = page.object_list
+        next_cursor = prev_cursor = None
+        if supports_cursors and listings:
+            listings = list(listings)
+            if has_next:
+                next_cursor = qset.get_cursor(listings[-1])
+            if has_previous:
+                prev_cursor = qset.get_cursor(listings[0])
 
         context = {
             'category' : cat,
             'is_homepage': is_homepage,
             'is_title_page': category_title_page,
-            'is_paginated': paginator.num_pages > 1,
+            'is_paginated': is_paginated,
             'results_per_page': paginate_by,
             'page': page,
             'listings' : listings,
+            'next_cursor': next_cursor,
+            'prev_cursor': prev_cursor,
             'archive_entry_year' : lambda: self._archive_entry_year(cat),
 
             'content_type' : ct,
@@ -451,8 +493,8 @@ def get_templates_from_publishable(name, publishable):
 
 
 def get_export_key(request, count, name='', content_type=None):
-    return 'core.export:%d:%d:%s:%s' % (
-            settings.SITE_ID, count, name, content_type
+    return 'core.export:%d:%s:%d:%s:%s' % (
+            settings.SITE_ID, get_listing_generation(), count, name, content_type
         )
 
 @cache_this(get_export_key, timeout=core_settings.CACHE_TIMEOUT_LONG)
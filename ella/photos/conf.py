@@ -25,5 +25,15 @@ TYPE_EXTENSION = {
 PHOTO_MIN_WIDTH=150
 PHOTO_MIN_HEIGHT=150
 
+# generate formated photos outside of the request, dotted path to the queue
+# class (see ella.photos.queue) and its keyword arguments
+GENERATE_QUEUE = None
+GENERATE_QUEUE_OPTIONS = {}
+# what to return while the photo is being generated, 'blank' or 'original'
+GENERATE_PLACEHOLDER = 'blank'
+# formats to generate when a photo with a new image is saved, list of names
+# or True for all formats of the current site
+GENERATE_ON_SAVE = ()
+
 photos_settings = Settings('ella.photos.conf', 'PHOTOS')
 
@@ -1,11 +1,72 @@
 from PIL import Image
 
+def draft(image, size):
+    """
+    Return a copy of the (not yet loaded) JPEG ``image`` configured to be
+    decoded at the smallest scale (1/2, 1/4 or 1/8) at least ``size`` big.
+    """
+    # draft a shallow copy, the supplied image object (which can be cached
+    # and used for other formats) has to keep its full size
+    copy = image.__class__.__new__(image.__class__)
+    copy.__dict__.update(image.__dict__)
+    # the file is shared, don't let the copy close it after loading
+    copy._exclusive_fp = False
+    copy.draft(copy.mode, size)
+    return copy
+
+def can_draft(image):
+    return getattr(image, 'format', None) == 'JPEG' and getattr(image, 'im', None) is None
+
+
+class Pyramid(object):
+    """
+    Image decoded once and its successive reductions by half, shared by the
+    ``Formatter`` objects generating several formats of the same photo so
+    that each of them is resized from the smallest image still big enough.
+
+    ``size`` is the biggest size any of the formats needs (see
+    ``Formatter.get_source_size``), JPEGs are decoded at the smallest scale
+    providing it.
+    """
+    USE_DRAFT = True
+
+    def __init__(self, image, size=None):
+        if size and self.USE_DRAFT and can_draft(image):
+            image = draft(image, size)
+        image.load()
+        self.levels = [image]
+
+    def get(self, size):
+        """
+        Return the smallest of the reductions at least ``size`` big, the
+        decoded image if there is none.
+        """
+        filter = getattr(Image, 'BOX', Image.ANTIALIAS)
+        i = 0
+        while True:
+            image = self.levels[i]
+            w, h = image.size
+            if w // 2 < size[0] or h // 2 < size[1]:
+                return image
+
+            i += 1
+            if i == len(self.levels):
+                self.levels.append(image.resize((w // 2, h // 2), filter))
+
+
 class Formatter(object):
-    def __init__(self, image, format, crop_box=None, important_box=None):
+    # let the JPEG decoder downscale images that are to be reduced this much
+    USE_DRAFT = True
+    # keep the image at least this many times bigger than the target before
+    # the final resampling, both after the draft and after the box filter
+    REDUCING_GAP = 2
+
+    def __init__(self, image, format, crop_box=None, important_box=None, pyramid=None):
         self.image = image
         self.fmt = format
         self.crop_box = crop_box
         self.important_box = important_box
+        self.pyramid = pyramid
 
         # precompute and store a bunch of numbers
         f = format
@@ -16,11 +77,85 @@ class Formatter(object):
         self.image_ratio = float(iw) / ih
 
     def format(self):
-        " Crop and resize the supplied image. Return the image and the crop_box used. "
-        crop_box = self.crop_to_ratio()
-        self.resize()
+        """
+        Crop and resize the supplied image. Return the image and the crop_box
+        used (always in the coordinates of the supplied image).
+
+        Unless the image has already been loaded, JPEGs are decoded directly
+        at a reduced scale when the result is to be much smaller, see ``draft``.
+        With a ``pyramid`` the image is taken from it instead.
+        """
+        crop_box, size, target_size = self.get_plan()
+
+        sx, sy = self.draft(size, target_size)
+        if crop_box and (sx, sy) != (1, 1):
+            # map the crop box into the reduced image
+            iw, ih = self.image.size
+            cl, ct, cr, cb = crop_box
+            self.image = self.image.crop((
+                int(cl * sx), int(ct * sy),
+                min(iw, int(round(cr * sx))), min(ih, int(round(cb * sy)))
+            ))
+        elif crop_box:
+            self.image = self.image.crop(crop_box)
+        self.resize(target_size)
         return self.image, crop_box
 
+    def get_plan(self):
+        """
+        Return the crop box, size of the cropped part and the size to resize
+        it to (``None`` for no resizing). Only dimensions of the image are
+        used, it doesn't have to be loaded.
+        """
+        crop_box = self.get_crop_box()
+        if crop_box:
+            crop_box = self.center_important_part(crop_box)
+            size = (crop_box[2] - crop_box[0], crop_box[3] - crop_box[1])
+        else:
+            size = self.image.size
+        return crop_box, size, self.get_resized_size(size)
+
+    def get_source_size(self, size, target_size):
+        """
+        Return the smallest size of the whole image such that its part of
+        ``size`` is still REDUCING_GAP times bigger than ``target_size``, or
+        ``None`` if the image cannot be reduced at least by half.
+        """
+        if not target_size:
+            return None
+
+        iw, ih = self.image.size
+        w, h = size
+        tw, th = target_size
+        if w < tw * self.REDUCING_GAP * 2 or h < th * self.REDUCING_GAP * 2:
+            return None
+
+        return (
+            -(-iw * tw * self.REDUCING_GAP // w),
+            -(-ih * th * self.REDUCING_GAP // h),
+        )
+
+    def draft(self, size, target_size):
+        """
+        Replace the image with a smaller one if the part of ``size`` would
+        still be at least REDUCING_GAP times bigger than ``target_size`` -
+        the best fitting reduction from ``pyramid`` or the JPEG decoded at
+        1/2, 1/4 or 1/8 scale. Returns the (x, y) scale of the image, (1, 1)
+        when nothing changed.
+        """
+        requested = self.get_source_size(size, target_size)
+        iw, ih = self.image.size
+
+        if self.pyramid is not None:
+            self.image = self.pyramid.get(requested or self.image.size)
+        elif requested is None or not self.USE_DRAFT or not can_draft(self.image):
+            return 1, 1
+        else:
+            self.image = draft(self.image, requested)
+
+        nw, nh = self.image.size
+        return float(nw) / iw, float(nh) / ih
+
     def set_format(self):
         """
         Check if the format has a flexible height, if so check if the ratio
@@ -124,15 +259,16 @@ class Formatter(object):
         self.image = self.image.crop(crop_box)
         return crop_box
 
-    def get_resized_size(self):
+    def get_resized_size(self, size=None):
         """
         Get target size for the stretched or shirnked image to fit within the
         target dimensions. Do not stretch images if not format.stretch.
 
-        Note that this method is designed to operate on already cropped image.
+        Note that this method is designed to operate on already cropped image,
+        or on the ``size`` of the image after cropping.
         """
         f = self.fmt
-        iw, ih = self.image.size
+        iw, ih = size or self.image.size
 
         if not f.stretch and iw <= self.fw and ih <= self.fh:
             return
@@ -149,16 +285,25 @@ class Formatter(object):
             # image wider than format
             return (self.fw, self.fw * ih / iw)
 
-    def resize(self):
+    def resize(self, target_size=None):
         """
         Get target size for a cropped image and do the resizing if we got
         anything usable.
-        """
-        target_size = self.get_resized_size()
 
-        resized_size = self.get_resized_size()
-        if not resized_size:
+        Big reductions are done in two steps - a cheap box filter down to
+        REDUCING_GAP times the target size and the antialiasing filter for
+        the rest.
+        """
+        if target_size is None:
+            target_size = self.get_resized_size()
+        if not target_size:
             return
 
-        self.image = self.image.resize(resized_size, Image.ANTIALIAS)
+        iw, ih = self.image.size
+        tw, th = target_size
+        box = getattr(Image, 'BOX', None)
+        if box is not None and iw >= tw * self.REDUCING_GAP * 2 and ih >= th * self.REDUCING_GAP * 2:
+            self.image = self.image.resize((tw * self.REDUCING_GAP, th * self.REDUCING_GAP), box)
+
+        self.image = self.image.resize(target_size, Image.ANTIALIAS)
 
@@ -0,0 +1,78 @@
+from datetime import datetime
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from ella.photos.models import Format
+from ella.photos.regenerate import regenerate_formats
+
+
+class Command(BaseCommand):
+
+    help = 'Generate missing and out of date formated photos in parallel'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--format',
+            dest='formats',
+            action='append',
+            default=[],
+            help='Only generate photos in format with given name (can be repeated)'),
+        make_option('--sites',
+            dest='sites',
+            default=None,
+            help='Comma separated list of site IDs, only generate formats of these sites'),
+        make_option('--since',
+            dest='since',
+            default=None,
+            help='Only generate photos created since given date (YYYY-MM-DD)'),
+        make_option('--workers',
+            dest='workers',
+            type='int',
+            default=None,
+            help='Number of worker processes, defaults to the number of CPUs, 0 generates photos in this process'),
+        make_option('--chunk-size',
+            dest='chunk_size',
+            type='int',
+            default=100,
+            help='Number of photos generated and written to the database and redis at once'),
+        make_option('--max-tasks-per-child',
+            dest='max_tasks_per_child',
+            type='int',
+            default=100,
+            help='Number of photos after which a worker process is replaced'),
+        )
+
+    def handle(self, *args, **options):
+        sites = None
+        if options['sites']:
+            try:
+                sites = [int(s) for s in options['sites'].split(',')]
+            except ValueError:
+                raise CommandError('--sites must be a comma separated list of IDs.')
+
+        since = None
+        if options['since']:
+            try:
+                since = datetime.strptime(options['since'], '%Y-%m-%d')
+            except ValueError:
+                raise CommandError('--since must be a date in YYYY-MM-DD format.')
+
+        formats = None
+        if options['formats']:
+            formats = Format.objects.filter(name__in=options['formats']).order_by('pk')
+            if sites:
+                formats = formats.filter(sites__id__in=sites).distinct()
+            missing = set(options['formats']) - set(f.name for f in formats)
+            if missing:
+                raise CommandError('Unknown formats: %s' % ', '.join(sorted(missing)))
+
+        verbosity = int(options['verbosity'])
+        def progress(done, failed, elapsed):
+            if verbosity > 1:
+                self.stdout.write('%d photos, %d failed (%.0f photos/sec)\n' % (done, failed, elapsed and done / elapsed or 0))
+
+        stats = regenerate_formats(formats, sites=sites, since=since, workers=options['workers'],
+            chunk_size=options['chunk_size'], max_tasks_per_child=options['max_tasks_per_child'],
+            progress=progress)
+        if verbosity > 0:
+            self.stdout.write('Generated %(generated)d formated photos, %(failed)d failed in %(seconds).1fs (%(rate).0f photos/sec)\n' % stats)
@@ -0,0 +1,43 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from ella.photos.queue import get_queue
+
+
+class Command(BaseCommand):
+
+    help = 'Generate formated photos queued by requests (PHOTOS_GENERATE_QUEUE)'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--timeout',
+            dest='timeout',
+            type='int',
+            default=5,
+            help='Number of seconds to wait for a job before checking again'),
+        make_option('--once',
+            action='store_true',
+            dest='once',
+            default=False,
+            help='Process queued jobs and exit'),
+        )
+
+    def handle(self, *args, **options):
+        queue = get_queue()
+        if queue is None:
+            raise CommandError('Asynchronous photo generation is not configured, set PHOTOS_GENERATE_QUEUE.')
+
+        verbosity = int(options['verbosity'])
+        processed = 0
+        while True:
+            job = queue.process(timeout=0 if options['once'] else options['timeout'])
+            if job is None:
+                if options['once']:
+                    break
+                continue
+            processed += 1
+            if verbosity > 1:
+                self.stdout.write('Generated photo %s in format %s\n' % job)
+
+        if verbosity > 0:
+            self.stdout.write('Generated %d formated photos\n' % processed)
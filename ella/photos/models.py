@@ -1,11 +1,12 @@
 import logging
+from hashlib import md5
 from PIL import Image
 from datetime import datetime
 from os import path
 from cStringIO import StringIO
 import os.path
 
-from django.db import models, IntegrityError
+from django.db import models, transaction, IntegrityError
 from django.db.models import signals
 from django.utils.translation import ugettext_lazy as _
 from django.utils.encoding import force_unicode, smart_str
@@ -18,10 +19,12 @@ from jsonfield.fields import JSONField
 
 from ella.core.models.main import Author, Source
 from ella.core.box import Box
-from ella.core.cache.utils import get_cached_object
+from ella.core.cache.utils import get_cached_object, get_cached_objects, \
+        get_cached_objects_by, get_identity_map, SKIP
 from ella.photos.conf import photos_settings
+from ella.photos.queue import get_queue, placeholder
 
-from formatter import Formatter
+from formatter import Formatter, Pyramid
 
 __all__ = ("Format", "FormatedPhoto", "Photo")
 
@@ -30,6 +33,8 @@ log = logging.getLogger('ella.photos')
 redis = None
 REDIS_PHOTO_KEY = 'photo:%s'
 REDIS_FORMATTED_PHOTO_KEY = 'photo:%s:%s'
+# formatted photos prefetched during the request
+IDENTITY_MAP_KEY = 'photos.fp:%s:%s'
 
 if hasattr(settings, 'PHOTOS_REDIS'):
     try:
@@ -126,7 +131,9 @@ class Photo(models.Model):
 
         - Generates slug.
         - Saves image file.
+        - Generates formats listed in PHOTOS_GENERATE_ON_SAVE for new images.
         """
+        new_image = True
         if not self.width or not self.height:
             self.width, self.height = self.image.width, self.image.height
 
@@ -159,12 +166,20 @@ class Photo(models.Model):
                 if old.image != self.image:
                     for f_photo in self.formatedphoto_set.all():
                         f_photo.delete()
+                else:
+                    new_image = False
             except Photo.DoesNotExist:
                 # somebody is just trying to create new model with given PK
                 force_update = False
 
             super(Photo, self).save(force_update=force_update)
 
+        if new_image and self.image and photos_settings.GENERATE_ON_SAVE:
+            formats = None
+            if photos_settings.GENERATE_ON_SAVE is not True:
+                formats = Format.objects.filter(name__in=photos_settings.GENERATE_ON_SAVE, sites__id=settings.SITE_ID)
+            self.generate_formats(formats)
+
     def ratio(self):
         "Return photo's width to height ratio"
         if self.height:
@@ -176,6 +191,80 @@ class Photo(models.Model):
         "Return formated photo"
         return FormatedPhoto.objects.get_photo_in_format(self, format)
 
+    def generate_formats(self, formats=None):
+        """
+        Generate the photo in all ``formats`` (those of the current site by
+        default) it is missing or outdated in. The original image is decoded
+        only once and every format is resized from the smallest of its
+        reductions still big enough (see ``formatter.Pyramid``) instead of
+        the original.
+
+        Returns the list of created or regenerated ``FormatedPhoto`` objects.
+        """
+        if formats is None:
+            formats = Format.objects.filter(sites__id=settings.SITE_ID)
+
+        existing = dict((fp.format_id, fp) for fp in self.formatedphoto_set.all())
+        todo = []
+        for format in formats:
+            outdated = existing.get(format.pk)
+            if outdated is not None and outdated.fingerprint == format.get_fingerprint():
+                continue
+            formated_photo = FormatedPhoto(photo=self, format=format)
+            if outdated is not None:
+                # the crop box might have been set by an editor
+                formated_photo.crop_left, formated_photo.crop_top = outdated.crop_left, outdated.crop_top
+                formated_photo.crop_width, formated_photo.crop_height = outdated.crop_width, outdated.crop_height
+            todo.append((formated_photo, outdated))
+
+        if not todo:
+            return []
+
+        # decode just big enough for the format that needs the most
+        width = height = 0
+        for formated_photo, outdated in todo:
+            formatter = formated_photo._get_formatter()
+            w, h = formatter.get_source_size(*formatter.get_plan()[1:]) or formatter.image.size
+            width, height = max(width, w), max(height, h)
+        pyramid = Pyramid(self._get_image(), (width, height))
+
+        created = []
+        for formated_photo, outdated in todo:
+            try:
+                formated_photo.generate(save=False, pyramid=pyramid)
+            except (IOError, SystemError), e:
+                # the outdated image (if any) stays in use
+                log.warning("Cannot create formatted photo due to %s.", e)
+                continue
+
+            if outdated is not None:
+                # the new image is stored under a new name (see
+                # FormatedPhoto.file), point the row to it and only then
+                # delete the outdated image so that no URL is ever broken
+                formated_photo.pk = outdated.pk
+                # bypass FormatedPhoto.save, it would delete the new image
+                models.Model.save(formated_photo)
+                if outdated.image.name and outdated.image.name != formated_photo.image.name:
+                    try:
+                        outdated.image.storage.delete(outdated.image.name)
+                    except (IOError, OSError), e:
+                        log.warning('Cannot delete %s: %s', outdated.image.name, e)
+                created.append(formated_photo)
+                continue
+
+            sid = transaction.savepoint()
+            try:
+                # bypass FormatedPhoto.save, the image is already generated
+                models.Model.save(formated_photo, force_insert=True)
+            except IntegrityError:
+                # generated by somebody else in the meantime
+                transaction.savepoint_rollback(sid)
+                formated_photo.image.delete(save=False)
+                continue
+            transaction.savepoint_commit(sid)
+            created.append(formated_photo)
+        return created
+
 
 
 FORMAT_CACHE = {}
@@ -214,6 +303,10 @@ class Format(models.Model):
 
     objects = FormatManager()
 
+    # fields affecting the formatted images
+    FINGERPRINT_FIELDS = ('max_width', 'max_height', 'flexible_height',
+        'flexible_max_height', 'stretch', 'nocrop', 'resample_quality')
+
     class Meta:
         verbose_name = _('Format')
         verbose_name_plural = _('Formats')
@@ -238,6 +331,13 @@ class Format(models.Model):
         """Return photo's width to height ratio"""
         return float(self.max_width) / self.max_height
 
+    def get_fingerprint(self):
+        """
+        Return hash of the format's parameters, ``FormatedPhoto`` objects
+        with a different fingerprint are out of date.
+        """
+        return md5(':'.join(str(getattr(self, f)) for f in self.FINGERPRINT_FIELDS)).hexdigest()
+
 
 class FormatedPhotoManager(models.Manager):
     def get_photo_in_format(self, photo, format):
@@ -250,6 +350,13 @@ class FormatedPhotoManager(models.Manager):
         if not isinstance(format, Format):
             format = Format.objects.get_for_name(format)
 
+        identity_map = get_identity_map()
+        if identity_map is not None:
+            # prefetched by get_photos_in_format
+            formatted = identity_map.get(IDENTITY_MAP_KEY % (photo_id, format.id))
+            if formatted is not None:
+                return formatted
+
         if redis:
             p = redis.pipeline()
             p.hgetall(REDIS_PHOTO_KEY % photo_id)
@@ -268,14 +375,90 @@ class FormatedPhotoManager(models.Manager):
         try:
             formated_photo = get_cached_object(FormatedPhoto, photo=photo, format=format)
         except FormatedPhoto.DoesNotExist:
-            try:
-                # use get or create because there is a possible race condition here
-                # we don't want to JUST use get_or_create to go through cache 99.9% of the time
-                formated_photo, _ = self.get_or_create(photo=photo, format=format)
-            except (IOError, SystemError), e:
-                log.warning("Cannot create formatted photo due to %s.", e)
-                return format.get_blank_img()
+            return self._create_photo_in_format(photo, format)
+
+        return self._get_info(photo, formated_photo)
+
+    def get_photos_in_format(self, photos, format):
+        """
+        Same as ``get_photo_in_format`` for a list of photos (instances or
+        IDs), returns a dict {photo_id: formatted photo}.
+
+        The lookup is done in one redis pipeline, the photos missing from
+        redis (or all of them without redis) are retrieved with one
+        ``cache.get_many`` per model and loaded from the database in bulk.
+        When the identity map is active, the results are remembered for the
+        rest of the request so that subsequent ``get_photo_in_format`` calls
+        (eg. the ``{% img %}`` tag) don't need any lookup at all.
+        """
+        if not isinstance(format, Format):
+            format = Format.objects.get_for_name(format)
+
+        photo_ids = []
+        known = {}
+        for photo in photos:
+            if isinstance(photo, Photo):
+                known[photo.id] = photo
+                photo = photo.id
+            else:
+                photo = int(photo)
+            if photo not in photo_ids:
+                photo_ids.append(photo)
+
+        out = {}
+        if redis and photo_ids:
+            p = redis.pipeline()
+            for photo_id in photo_ids:
+                p.hgetall(REDIS_PHOTO_KEY % photo_id)
+                p.hgetall(REDIS_FORMATTED_PHOTO_KEY % (photo_id, format.id))
+            results = p.execute()
+            for photo_id, original, formatted in zip(photo_ids, results[::2], results[1::2]):
+                if formatted:
+                    formatted['original'] = original
+                    out[photo_id] = formatted
+
+        missing = [photo_id for photo_id in photo_ids if photo_id not in out]
+        to_get = [photo_id for photo_id in missing if photo_id not in known]
+        if to_get:
+            for photo in get_cached_objects(to_get, Photo, missing=SKIP):
+                known[photo.id] = photo
+
+        missing = [photo_id for photo_id in missing if photo_id in known]
+        if missing:
+            formated_photos = get_cached_objects_by(FormatedPhoto, 'photo', missing, format=format)
+            for photo_id in missing:
+                if photo_id in formated_photos:
+                    out[photo_id] = self._get_info(known[photo_id], formated_photos[photo_id])
+                else:
+                    out[photo_id] = self._create_photo_in_format(known[photo_id], format)
+
+        for photo_id in photo_ids:
+            if photo_id not in out:
+                # photo doesn't exist
+                out[photo_id] = format.get_blank_img()
+
+        identity_map = get_identity_map()
+        if identity_map is not None:
+            for photo_id, formatted in out.iteritems():
+                identity_map[IDENTITY_MAP_KEY % (photo_id, format.id)] = formatted
+        return out
 
+    def _create_photo_in_format(self, photo, format):
+        queue = get_queue()
+        if queue is not None:
+            queue.enqueue(photo.pk, format.pk)
+            return placeholder(photo, format)
+
+        try:
+            # use get or create because there is a possible race condition here
+            # we don't want to JUST use get_or_create to go through cache 99.9% of the time
+            formated_photo, _ = self.get_or_create(photo=photo, format=format)
+        except (IOError, SystemError), e:
+            log.warning("Cannot create formatted photo due to %s.", e)
+            return format.get_blank_img()
+        return self._get_info(photo, formated_photo)
+
+    def _get_info(self, photo, formated_photo):
         return {
             'original': photo.get_image_info(),
 
@@ -302,6 +485,8 @@ class FormatedPhoto(models.Model):
     crop_height = models.PositiveIntegerField()
     width = models.PositiveIntegerField(editable=False)
     height = models.PositiveIntegerField(editable=False)
+    # Format.get_fingerprint() of the format used to generate the image
+    fingerprint = models.CharField(max_length=32, blank=True, editable=False)
 
     objects = FormatedPhotoManager()
 
@@ -318,7 +503,7 @@ class FormatedPhoto(models.Model):
         "Returns url of the photo file."
         return self.image.url
 
-    def _generate_img(self):
+    def _get_formatter(self, pyramid=None):
         crop_box = None
         if self.crop_left:
             crop_box = (self.crop_left, self.crop_top, \
@@ -329,17 +514,21 @@ class FormatedPhoto(models.Model):
             p = self.photo
             important_box = (p.important_left, p.important_top, p.important_right, p.important_bottom)
 
-        formatter = Formatter(self.photo._get_image(), self.format, crop_box=crop_box, important_box=important_box)
+        return Formatter(self.photo._get_image(), self.format, crop_box=crop_box,
+                important_box=important_box, pyramid=pyramid)
 
-        return formatter.format()
+    def _generate_img(self, pyramid=None):
+        return self._get_formatter(pyramid).format()
 
-    def generate(self, save=True):
+    def generate(self, save=True, pyramid=None):
         """
         Generates photo file in current format.
         
-        If ``save`` is ``True``, file is saved too.
+        If ``save`` is ``True``, file is saved too. The image is taken from
+        ``pyramid`` if given, see ``Photo.generate_formats``.
         """
-        stretched_photo, crop_box = self._generate_img()
+        stretched_photo, crop_box = self._generate_img(pyramid)
+        self.fingerprint = self.format.get_fingerprint()
 
         # set crop_box to (0,0,0,0) if photo not cropped
         if not crop_box:
@@ -384,8 +573,14 @@ class FormatedPhoto(models.Model):
             self.image.delete()
 
     def file(self):
-        """ Method returns formated photo path - derived from format.id and source Photo filename """
+        """
+        Method returns formated photo path - derived from format.id, the
+        format's fingerprint (so that regenerated images never overwrite the
+        ones in use) and source Photo filename
+        """
         source_file = path.split(self.photo.image.name)
+        if self.fingerprint:
+            return path.join(source_file[0], '%s-%s-%s' % (self.format.id, self.fingerprint[:8], source_file[1]))
         return path.join(source_file[0], str (self.format.id) + '-' + source_file[1])
 
 if redis:
@@ -0,0 +1,208 @@
+"""
+Asynchronous generation of ``FormatedPhoto`` objects.
+
+By default a missing ``FormatedPhoto`` is generated during the request that
+asks for it - the original image is decoded, cropped, resized and encoded
+again before the page can be rendered. With a queue configured the request
+only enqueues a job and gets a placeholder (see ``placeholder``), the photo
+is generated by a worker and its redis hash (``photo:<id>:<format_id>``) is
+written as soon as it is saved.
+
+Enable it via the ``PHOTOS_GENERATE_QUEUE`` setting::
+
+    PHOTOS_GENERATE_QUEUE = 'ella.photos.queue.RedisQueue'
+    PHOTOS_GENERATE_QUEUE_OPTIONS = {}
+
+``LocalQueue`` generates the photos in background threads of the web
+process, ``RedisQueue`` stores the jobs in redis (``PHOTOS_REDIS``) to be
+processed by the ``run_photo_worker`` management command.
+"""
+from __future__ import absolute_import
+
+import time
+import Queue
+import logging
+import threading
+
+from django.core.exceptions import ImproperlyConfigured
+from django.utils.importlib import import_module
+
+from ella.photos.conf import photos_settings
+
+log = logging.getLogger('ella.photos.queue')
+
+def generate(photo_id, format_id):
+    """
+    Generate the ``FormatedPhoto`` for given photo and format unless it
+    already exists. Returns it or ``None`` if it cannot be generated.
+    """
+    from ella.photos.models import Photo, Format, FormatedPhoto
+    try:
+        photo = Photo.objects.get(pk=photo_id)
+        format = Format.objects.get(pk=format_id)
+    except (Photo.DoesNotExist, Format.DoesNotExist):
+        log.info('Photo %s or format %s no longer exists.', photo_id, format_id)
+        return None
+
+    try:
+        formated_photo, created = FormatedPhoto.objects.get_or_create(photo=photo, format=format)
+    except (IOError, SystemError), e:
+        log.warning("Cannot create formatted photo due to %s.", e)
+        return None
+    return formated_photo
+
+def placeholder(photo, format):
+    """
+    What to return in place of a formated photo that is being generated. With
+    ``PHOTOS_GENERATE_PLACEHOLDER = 'original'`` it is the original image with
+    dimensions scaled down to fit the format, otherwise ``format.get_blank_img()``.
+    """
+    if photos_settings.GENERATE_PLACEHOLDER != 'original' or not photo.width or not photo.height:
+        return format.get_blank_img()
+
+    ratio = min(float(format.max_width) / photo.width, float(format.max_height) / photo.height, 1)
+    return {
+        'placeholder': True,
+        'original': photo.get_image_info(),
+
+        'url': photo.image.url,
+        'width': int(photo.width * ratio),
+        'height': int(photo.height * ratio),
+    }
+
+
+class LocalQueue(object):
+    """
+    Generate photos in ``workers`` daemon threads of the current process.
+    Every (photo, format) pair is only queued once until it is processed.
+
+    With ``workers=0`` nothing is processed until ``process`` is called.
+    """
+    def __init__(self, workers=2):
+        self.workers = workers
+        self._queue = Queue.Queue()
+        self._pending = set()
+        self._lock = threading.Lock()
+        self._threads = []
+
+    def __len__(self):
+        return self._queue.qsize()
+
+    def enqueue(self, photo_id, format_id):
+        " Queue the job, return False if it is already waiting. "
+        job = (photo_id, format_id)
+        self._lock.acquire()
+        try:
+            if job in self._pending:
+                return False
+            self._pending.add(job)
+            # start the threads lazily so that they are not lost on fork
+            while len(self._threads) < self.workers:
+                t = threading.Thread(target=self._work, name='ella.photos.queue')
+                t.setDaemon(True)
+                t.start()
+                self._threads.append(t)
+        finally:
+            self._lock.release()
+        self._queue.put(job)
+        return True
+
+    def process(self, timeout=None):
+        """
+        Process one job, wait at most ``timeout`` seconds for it (forever if
+        ``None``). Returns the (photo_id, format_id) processed or ``None``.
+        """
+        try:
+            job = self._queue.get(timeout is None or timeout > 0, timeout)
+        except Queue.Empty:
+            return None
+
+        try:
+            generate(*job)
+        except Exception:
+            log.exception('Error generating formated photo %s-%s.', *job)
+        finally:
+            self._lock.acquire()
+            try:
+                self._pending.discard(job)
+            finally:
+                self._lock.release()
+            self._queue.task_done()
+        return job
+
+    def join(self):
+        " Block until all the queued jobs are processed. "
+        self._queue.join()
+
+    def _work(self):
+        from django.db import connection
+        while True:
+            self.process()
+            if self._queue.empty():
+                connection.close()
+
+
+class RedisQueue(object):
+    """
+    Keep the jobs in a redis list ``key``. A job is only queued once until it
+    is processed or until ``pending_timeout`` seconds pass, so that a crashed
+    worker doesn't block the pair forever.
+    """
+    def __init__(self, key='photos:queue', pending_timeout=600, client=None):
+        if client is None:
+            from ella.photos.models import redis as client
+        if client is None:
+            raise ImproperlyConfigured('RedisQueue requires PHOTOS_REDIS to be set.')
+        self.client = client
+        self.key = key
+        self.pending_timeout = pending_timeout
+
+    def __len__(self):
+        return self.client.llen(self.key)
+
+    def _get_pending_key(self, job):
+        return '%s:%s' % (self.key, job)
+
+    def enqueue(self, photo_id, format_id):
+        " Queue the job, return False if it is already waiting. "
+        job = '%s:%s' % (photo_id, format_id)
+        if not self.client.execute_command('SET', self._get_pending_key(job), time.time(), 'NX', 'EX', self.pending_timeout):
+            return False
+        self.client.lpush(self.key, job)
+        return True
+
+    def process(self, timeout=None):
+        """
+        Process one job, wait at most ``timeout`` seconds for it (forever if
+        ``None``). Returns the (photo_id, format_id) processed or ``None``.
+        """
+        if timeout is None or timeout >= 1:
+            item = self.client.brpop(self.key, int(timeout or 0))
+            job = item and item[1]
+        else:
+            job = self.client.rpop(self.key)
+        if not job:
+            return None
+
+        photo_id, format_id = map(int, job.split(':'))
+        try:
+            generate(photo_id, format_id)
+        except Exception:
+            log.exception('Error generating formated photo %s-%s.', photo_id, format_id)
+        finally:
+            self.client.delete(self._get_pending_key(job))
+        return photo_id, format_id
+
+
+_queue = None
+def get_queue():
+    " Return the queue configured in PHOTOS_GENERATE_QUEUE or None. "
+    global _queue
+    if _queue is None and photos_settings.GENERATE_QUEUE:
+        module, attr = photos_settings.GENERATE_QUEUE.rsplit('.', 1)
+        try:
+            queue_class = getattr(import_module(module), attr)
+        except (ImportError, AttributeError), e:
+            raise ImproperlyConfigured('Error importing photo queue %s: "%s"' % (photos_settings.GENERATE_QUEUE, e))
+        _queue = queue_class(**photos_settings.GENERATE_QUEUE_OPTIONS)
+    return _queue
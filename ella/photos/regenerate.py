@@ -0,0 +1,228 @@
+"""
+Bulk generation of ``FormatedPhoto`` objects that are missing (new format,
+photos never displayed) or out of date (format's parameters changed since
+they were generated, see ``Format.get_fingerprint``).
+
+The images are generated in a pool of worker processes which only write the
+new files - always under a new name, see ``FormatedPhoto.file``. The main
+process then updates the database rows, redis hashes (one pipeline per
+chunk) and cache and finally deletes the replaced files, so no URL ever
+points to a file that is being written.
+
+A pair is done once its ``FormatedPhoto`` has the current fingerprint, an
+interrupted run therefore continues where it stopped when started again.
+"""
+import time
+import logging
+import multiprocessing
+
+from django.db import models, connection, transaction, IntegrityError
+
+from ella.core.cache.utils import invalidate_cached_objects
+from ella.photos import models as photos_models
+from ella.photos.models import Photo, Format, FormatedPhoto, REDIS_FORMATTED_PHOTO_KEY
+
+log = logging.getLogger('ella.photos.regenerate')
+
+def get_outdated(formats, since=None, chunk_size=1000):
+    """
+    Yield (photo_id, format_id) for every format and photo (created since
+    ``since`` if given) without an up to date ``FormatedPhoto``.
+    """
+    photos = Photo.objects.all()
+    if since is not None:
+        photos = photos.filter(created__gte=since)
+
+    for format in formats:
+        fingerprint = format.get_fingerprint()
+        last = 0
+        while True:
+            photo_ids = list(photos.filter(pk__gt=last).order_by('pk').values_list('pk', flat=True)[:chunk_size])
+            if not photo_ids:
+                break
+            last = photo_ids[-1]
+
+            current = set(FormatedPhoto.objects.filter(
+                    format=format, photo__in=photo_ids, fingerprint=fingerprint
+                ).values_list('photo_id', flat=True))
+            for photo_id in photo_ids:
+                if photo_id not in current:
+                    yield photo_id, format.pk
+
+def _init_worker():
+    # The workers get everything they need from the parent and never touch
+    # the database. Forget the connection inherited from the parent without
+    # closing it though, closing it would end the parent's session on the
+    # database server.
+    connection.connection = None
+
+CROP_FIELDS = ('crop_left', 'crop_top', 'crop_width', 'crop_height')
+
+def _generate(job):
+    """
+    Generate and store the image for a (photo, format, crop) job, ``crop``
+    being the crop box of the outdated ``FormatedPhoto`` (if any). Returns
+    the (photo_id, format_id) pair, values of the ``FormatedPhoto`` fields
+    (``None`` on failure) and the error message.
+    """
+    photo, format, crop = job
+    try:
+        formated_photo = FormatedPhoto(photo=photo, format=format)
+        if crop is not None:
+            # the crop box might have been set by an editor
+            for f, value in zip(CROP_FIELDS, crop):
+                setattr(formated_photo, f, value)
+        formated_photo.generate(save=False)
+    except (IOError, SystemError), e:
+        return (photo.pk, format.pk), None, str(e)
+
+    values = dict((f, getattr(formated_photo, f)) for f in (
+        'width', 'height', 'crop_left', 'crop_top', 'crop_width', 'crop_height', 'fingerprint'))
+    values['image'] = formated_photo.image.name
+    return (photo.pk, format.pk), values, None
+
+def _get_jobs(chunk, formats):
+    """
+    Turn (photo_id, format_id) pairs into (photo, format, crop) jobs for the
+    workers, photos deleted in the meantime are left out. ``crop`` is the
+    crop box of the outdated ``FormatedPhoto`` or ``None`` if it's missing.
+    """
+    photos = Photo.objects.in_bulk(set(photo_id for photo_id, format_id in chunk))
+    crops = {}
+    for values in FormatedPhoto.objects.filter(
+            photo__in=photos.keys(), format__in=set(format_id for photo_id, format_id in chunk)
+        ).values_list('photo', 'format', *CROP_FIELDS):
+        crops[values[:2]] = values[2:]
+    return [(photos[photo_id], formats[format_id], crops.get((photo_id, format_id)))
+        for photo_id, format_id in chunk if photo_id in photos]
+
+def _store(results):
+    """
+    Write results of ``_generate`` to the database, redis and cache and
+    delete the files they replace. Returns the number of failed jobs.
+    """
+    failed = 0
+    jobs = [job for job, values, error in results if values is not None]
+    existing = {}
+    if jobs:
+        for fp in FormatedPhoto.objects.filter(
+                photo__in=set(j[0] for j in jobs), format__in=set(j[1] for j in jobs)):
+            existing[(fp.photo_id, fp.format_id)] = fp
+
+    storage = FormatedPhoto._meta.get_field('image').storage
+    stored = []
+    old_files = []
+    for job, values, error in results:
+        if values is None:
+            log.warning('Cannot generate photo %s in format %s: %s', job[0], job[1], error)
+            failed += 1
+            continue
+
+        fp = existing.get(job)
+        if fp is None:
+            fp = FormatedPhoto(photo_id=job[0], format_id=job[1], **values)
+            try:
+                # bypass FormatedPhoto.save, the image is already generated
+                models.Model.save(fp, force_insert=True)
+            except IntegrityError:
+                # created in the meantime
+                transaction.rollback_unless_managed()
+                fp = FormatedPhoto.objects.get(photo=job[0], format=job[1])
+            else:
+                stored.append((job, values))
+                continue
+
+        if fp.image.name and fp.image.name != values['image']:
+            old_files.append(fp.image.name)
+        FormatedPhoto.objects.filter(pk=fp.pk).update(**values)
+        stored.append((job, values))
+
+    invalidate_cached_objects(FormatedPhoto, [{'photo': j[0], 'format': j[1]} for j, v in stored])
+
+    redis = photos_models.redis
+    if redis and stored:
+        pipe = redis.pipeline()
+        for (photo_id, format_id), values in stored:
+            pipe.hmset(REDIS_FORMATTED_PHOTO_KEY % (photo_id, format_id), {
+                'url': storage.url(values['image']),
+                'width': values['width'],
+                'height': values['height'],
+            })
+        pipe.execute()
+
+    for name in old_files:
+        try:
+            storage.delete(name)
+        except (IOError, OSError), e:
+            log.warning('Cannot delete %s: %s', name, e)
+
+    return failed
+
+def regenerate_formats(formats=None, sites=None, since=None, workers=None,
+        chunk_size=100, max_tasks_per_child=100, progress=None):
+    """
+    Generate all missing and out of date formatted photos.
+
+    Params:
+        formats - Formats to process, all of them (on ``sites``) by default
+        sites - list of Site IDs, only process formats of these sites
+        since - only process photos created after this datetime
+        workers - number of worker processes, CPU count by default, 0 to
+                  generate the photos in the current process
+        chunk_size - number of photos stored at once
+        max_tasks_per_child - workers are replaced after this many photos to
+                  keep their memory bounded
+        progress - callable receiving (done, failed, elapsed seconds) after
+                  each chunk
+
+    Returns a dict with stats (generated, failed, seconds, rate).
+    """
+    if formats is None:
+        formats = Format.objects.order_by('pk')
+        if sites:
+            formats = formats.filter(sites__id__in=sites).distinct()
+    formats = list(formats)
+
+    if workers is None:
+        workers = multiprocessing.cpu_count()
+
+    pool = None
+    if workers:
+        pool = multiprocessing.Pool(workers, _init_worker, maxtasksperchild=max_tasks_per_child)
+
+    start = time.time()
+    done = failed = 0
+    try:
+        formats_by_id = dict((f.pk, f) for f in formats)
+        outdated = get_outdated(formats, since)
+        while True:
+            chunk = []
+            for pair in outdated:
+                chunk.append(pair)
+                if len(chunk) >= chunk_size:
+                    break
+            if not chunk:
+                break
+
+            jobs = _get_jobs(chunk, formats_by_id)
+            if pool is not None:
+                results = pool.map(_generate, jobs)
+            else:
+                results = map(_generate, jobs)
+            failed += _store(results) + len(chunk) - len(jobs)
+            done += len(chunk)
+
+            if progress is not None:
+                progress(done, failed, time.time() - start)
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    elapsed = time.time() - start
+    return {
+        'generated': done - failed,
+        'failed': failed,
+        'seconds': elapsed,
+        'rate': elapsed and done / elapsed or 0,
+    }
@@ -92,3 +92,66 @@ def _parse_img(bits):
     return ImgTag(formated_photo, format, bits[-1])
 
 
+
+class ImgPrefetchNode(template.Node):
+    def __init__(self, format, objects):
+        self.format, self.objects = format, objects
+
+    def render(self, context):
+        try:
+            objects = self.objects.resolve(context)
+        except template.VariableDoesNotExist:
+            return ''
+
+        photo_ids = []
+        for obj in objects or ():
+            if isinstance(obj, Photo):
+                photo_ids.append(obj.pk)
+                continue
+            if hasattr(obj, 'publishable'):
+                # listing
+                obj = obj.publishable
+            photo_id = getattr(obj, 'photo_id', None)
+            if photo_id:
+                photo_ids.append(photo_id)
+
+        if photo_ids:
+            FormatedPhoto.objects.get_photos_in_format(photo_ids, self.format)
+        return ''
+
+@register.tag
+def img_prefetch(parser, token):
+    """
+    Retrieves formatted photos for all the objects at once so that the
+    ``{% img %}`` tags rendering them don't have to look them up one by one.
+    Works with listings, publishables and photos. Requires the identity map
+    to be active (see ``ella.core.middleware.IdentityMapMiddleware``).
+
+    syntax::
+
+        {% img_prefetch <format> for <objects> %}
+
+    example::
+
+        {% img_prefetch category_listing for listings %}
+        {% for l in listings %}
+            {% img category_listing for l.publishable.photo as thumb %}
+            ...
+        {% endfor %}
+    """
+    bits = token.split_contents()
+    if len(bits) != 4 or bits[2] != 'for':
+        raise template.TemplateSyntaxError, "{% img_prefetch FORMAT for OBJECTS %}"
+
+    try:
+        format = Format.objects.get_for_name(bits[1])
+    except Format.DoesNotExist:
+        logmsg = "Format with name %r does not exist (for site id %d)" % (bits[1], settings.SITE_ID)
+        log.error(logmsg)
+
+        if not settings.TEMPLATE_DEBUG:
+            return template.Node()
+
+        raise template.TemplateSyntaxError(logmsg)
+
+    return ImgPrefetchNode(format, template.Variable(bits[3]))
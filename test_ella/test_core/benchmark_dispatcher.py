@@ -0,0 +1,60 @@
+"""
+Compare resolving of ``ella.core.urls`` paths by the sequential regex
+matching and by ``SegmentDispatcher``.
+
+Run as::
+
+    DJANGO_SETTINGS_MODULE=test_ella.settings python -m test_ella.test_core.benchmark_dispatcher [REPEAT]
+"""
+import sys
+import time
+
+from ella.core import urls
+from ella.core.dispatcher import SegmentDispatcher
+
+PATHS = (
+    ('homepage', ''),
+    ('export', 'export/'),
+    ('category', 'nested-category/'),
+    ('nested category', 'nested-category/second-nested-category/'),
+    ('category feed', 'nested-category/feeds/'),
+    ('category archive', 'nested-category/2008/1/10/'),
+    ('object detail', 'nested-category/2008/1/10/articles/first-article/'),
+    ('nested object detail', 'nested-category/second-nested-category/2008/1/10/articles/first-article/'),
+    ('home object detail', '2008/1/10/articles/first-article/'),
+    ('static detail', 'nested-category/articles/1-first-article/'),
+    ('home static detail', 'articles/1-first-article/'),
+    ('static detail action', 'nested-category/articles/1-first-article/comments/new/'),
+)
+
+def regex_resolve(patterns, path):
+    for pattern in patterns:
+        match = pattern.resolve(path)
+        if match:
+            return match
+
+def measure(func, path, repeat, number=20000):
+    best = None
+    for x in xrange(repeat):
+        start = time.time()
+        for y in xrange(number):
+            func(path)
+        t = (time.time() - start) / number
+        best = best is None and t or min(best, t)
+    return best
+
+def main(repeat=5):
+    patterns = [p for p in urls.urlpatterns if not isinstance(p, SegmentDispatcher)]
+    dispatcher = SegmentDispatcher(patterns, multi_segment=[urls.res['cat']], remainder=[urls.res['rest']])
+
+    total_regex = total_trie = 0
+    for name, path in PATHS:
+        regex = measure(lambda p: regex_resolve(patterns, p), path, repeat)
+        trie = measure(dispatcher.resolve, path, repeat)
+        total_regex += regex
+        total_trie += trie
+        print '%-22s regex %5.1fus, dispatcher %5.1fus (%.2fx)' % (name, regex * 1e6, trie * 1e6, regex / trie)
+    print '%-22s regex %5.1fus, dispatcher %5.1fus (%.2fx)' % ('mean', total_regex / len(PATHS) * 1e6, total_trie / len(PATHS) * 1e6, total_regex / total_trie)
+
+if __name__ == '__main__':
+    main(repeat=len(sys.argv) > 1 and int(sys.argv[1]) or 5)
@@ -1,13 +1,21 @@
 # -*- coding: utf-8 -*-
 from django.test import TestCase
+from django.template import Context
+from django.core.cache import get_cache
+from django.contrib.sites.models import Site
+from django.contrib.contenttypes.models import ContentType
+from django.conf import settings
 
 from nose import tools
 
-from ella.core.models import Publishable
+from ella.core import box, managers
+from ella.core.cache import utils
+from ella.core.models import Publishable, Listing
 from ella.core.box import Box
 from ella.articles.models import Article
 
 from test_ella.test_core import create_basic_categories, create_and_place_a_publishable
+from test_ella import template_loader
 
 
 class ArticleBox(Box):
@@ -46,3 +54,82 @@ class TestPublishableBox(TestCase):
         box = publishable.box_class(publishable, 'box_type', [])
         tools.assert_equals(ArticleBox, box.__class__)
 
+
+class TestBoxDependencies(TestCase):
+    def setUp(self):
+        super(TestBoxDependencies, self).setUp()
+        self.old_caches = box.cache, utils.cache
+        box.cache = utils.cache = self.cache = get_cache('locmem://')
+        self.cache.clear()
+        create_basic_categories(self)
+        create_and_place_a_publishable(self)
+
+    def tearDown(self):
+        box.cache, utils.cache = self.old_caches
+        template_loader.templates = {}
+        super(TestBoxDependencies, self).tearDown()
+
+    def render(self, template_name, obj):
+        return Box(obj, template_name, []).render(Context())
+
+    def test_saving_subclass_invalidates_box(self):
+        template_loader.templates['box/title.html'] = '{{ object.title }}'
+        tools.assert_equals(u'First Article', self.render('title', self.only_publishable))
+        self.publishable.title = u'Changed'
+        self.publishable.save()
+        only_publishable = Publishable.objects.get(pk=self.publishable.pk)
+        tools.assert_equals(u'Changed', self.render('title', only_publishable))
+
+    def test_box_is_not_invalidated_by_unrelated_save(self):
+        template_loader.templates['box/title.html'] = '{{ object.title }}'
+        self.render('title', self.only_publishable)
+        self.category.save()
+        self.only_publishable.title = u'Changed'
+        tools.assert_equals(u'First Article', self.render('title', self.only_publishable))
+
+    def test_objects_used_in_template_invalidate_box(self):
+        template_loader.templates['box/cat.html'] = '{{ object.category.title }}'
+        self.render('cat', self.only_publishable)
+        b = Box(self.only_publishable, 'cat', [])
+        b.prepare(Context())
+        tools.assert_false(self.cache.get(b.get_cache_key()) is None)
+        self.category_nested.save()
+        tools.assert_true(self.cache.get(b.get_cache_key()) is None)
+
+    def test_nested_box_dependencies_propagate(self):
+        template_loader.templates['box/outer.html'] = '{% box inner for sites.site with pk 1 %}{% endbox %}'
+        template_loader.templates['box/inner.html'] = '{{ object.domain }}'
+        tools.assert_equals('example.com', self.render('outer', self.only_publishable))
+        site = Site.objects.get(pk=1)
+        site.domain = 'example.org'
+        site.save()
+        tools.assert_equals('example.org', self.render('outer', self.only_publishable))
+
+    def test_overflowed_index_is_replaced_by_generation(self):
+        settings.BOX_DEPENDENCY_INDEX_LIMIT = 1
+        try:
+            template_loader.templates['box/title.html'] = '{{ object.title }}'
+            template_loader.templates['box/slug.html'] = '{{ object.slug }}'
+            self.render('title', self.only_publishable)
+            self.render('slug', self.only_publishable)
+            ct_id = ContentType.objects.get_for_model(Publishable).pk
+            tools.assert_false(isinstance(self.cache.get(box._get_deps_key(ct_id, self.publishable.pk)), set))
+
+            self.publishable.title = u'Changed'
+            self.publishable.slug = u'changed'
+            self.publishable.save()
+            only_publishable = Publishable.objects.get(pk=self.publishable.pk)
+            tools.assert_equals(u'Changed', self.render('title', only_publishable))
+            tools.assert_equals(u'changed', self.render('slug', only_publishable))
+        finally:
+            del settings.BOX_DEPENDENCY_INDEX_LIMIT
+
+    def test_new_listing_invalidates_box_listing_the_category(self):
+        old_cache, managers.cache = managers.cache, self.cache
+        try:
+            template_loader.templates['box/listing.html'] = '{% listing 10 for object.category as listings %}{{ listings|length }}'
+            tools.assert_equals(u'0', self.render('listing', self.only_publishable))
+            Listing.objects.create(publishable=self.publishable, category=self.category_nested, publish_from=self.publishable.publish_from)
+            tools.assert_equals(u'1', self.render('listing', self.only_publishable))
+        finally:
+            managers.cache = old_cache
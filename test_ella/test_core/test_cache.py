@@ -1,5 +1,5 @@
 import time
-from datetime import datetime, date
+from datetime import datetime, date, timedelta
 
 from django.core.cache import get_cache
 from django.conf import settings
@@ -8,14 +8,19 @@ from django.test.client import RequestFactory
 from django.contrib.sites.models import Site
 from django.contrib.contenttypes.models import ContentType
 from django.db.models.signals import pre_save, post_save, post_delete, pre_delete
+from django.dispatch.dispatcher import _make_id
 
-from ella.core.cache import utils, redis
-from ella.core.models import Listing
+from ella.core.cache import utils, redis, tiered
+from ella.core.middleware import IdentityMapMiddleware
+from ella.core.models import Listing, Publishable, Category
+from ella.articles.models import Article
 from ella.core.views import ListContentType
 from ella.core.managers import ListingHandler
-from ella.core.signals import content_published, content_unpublished
+from ella.core.signals import content_published, content_unpublished, \
+        content_published_bulk, content_unpublished_bulk, disconnect_publishable_signal
+from ella.core.management import generate_publish_signals
 
-from test_ella.test_core import create_basic_categories, \
+from test_ella.test_core import create_basic_categories, create_and_place_a_publishable, \
         create_and_place_more_publishables, list_all_publishables_in_category_by_hour
 
 from nose import tools, SkipTest
@@ -60,6 +65,53 @@ class TestCacheUtils(CacheTestCase):
         objs = utils.get_cached_objects([(ct_ct.id, ct_ct.id), (ct_ct.id, site_ct.id), (site_ct.id, 1), (site_ct.id, 100)], missing=utils.SKIP)
         tools.assert_equals([ct_ct, site_ct, Site.objects.get(pk=1)], objs)
 
+    def test_get_many_objects_by_field(self):
+        site = Site.objects.get(pk=1)
+        objs = utils.get_cached_objects_by(Site, 'domain', [site.domain, 'missing.example.com'])
+        tools.assert_equals({site.domain: site}, objs)
+
+    def test_get_many_objects_by_field_shares_cache_with_get_cached_object(self):
+        site = Site.objects.get(pk=1)
+        utils.get_cached_objects_by(Site, 'domain', [site.domain, 'missing.example.com'])
+        self.assertNumQueries(0, utils.get_cached_object, Site, domain=site.domain)
+        self.assertNumQueries(0, lambda: tools.assert_raises(Site.DoesNotExist, utils.get_cached_object, Site, domain='missing.example.com'))
+        self.assertNumQueries(0, utils.get_cached_objects_by, Site, 'domain', [site.domain, 'missing.example.com'])
+
+class TestNegativeCaching(CacheTestCase):
+    def setUp(self):
+        super(TestNegativeCaching, self).setUp()
+        self.cache.clear()
+
+    def test_missing_object_is_not_retrieved_twice(self):
+        tools.assert_raises(Site.DoesNotExist, utils.get_cached_object, Site, pk=100)
+        self.assertNumQueries(0, lambda: tools.assert_raises(Site.DoesNotExist, utils.get_cached_object, Site, pk=100))
+
+    def test_tombstone_removed_when_object_created(self):
+        tools.assert_raises(Site.DoesNotExist, utils.get_cached_object, Site, pk=100)
+        site = Site.objects.create(pk=100, domain='example.org', name='example.org')
+        tools.assert_equals(site, utils.get_cached_object(Site, pk=100))
+
+    def test_tombstone_for_other_lookups_invalidated_when_object_created(self):
+        tools.assert_raises(Site.DoesNotExist, utils.get_cached_object, Site, domain='example.org')
+        self.assertNumQueries(0, lambda: tools.assert_raises(Site.DoesNotExist, utils.get_cached_object, Site, domain='example.org'))
+        site = Site.objects.create(domain='example.org', name='example.org')
+        tools.assert_equals(site, utils.get_cached_object(Site, domain='example.org'))
+
+    def test_tombstones_of_parent_model_removed_when_subclass_created(self):
+        create_basic_categories(self)
+        tools.assert_raises(Publishable.DoesNotExist, utils.get_cached_object, Publishable, pk=100)
+        tools.assert_raises(Publishable.DoesNotExist, utils.get_cached_object, Publishable, slug='first-article', category=self.category_nested)
+        create_and_place_a_publishable(self, pk=100)
+        tools.assert_equals(self.only_publishable, utils.get_cached_object(Publishable, pk=100))
+        tools.assert_equals(self.only_publishable, utils.get_cached_object(Publishable, slug='first-article', category=self.category_nested))
+
+    def test_get_many_objects_remembers_missing_objects(self):
+        site_ct = ContentType.objects.get_for_model(Site)
+        utils.get_cached_objects([(site_ct.id, 1), (site_ct.id, 100)], missing=utils.SKIP)
+        self.assertNumQueries(0, utils.get_cached_objects, [(site_ct.id, 1), (site_ct.id, 100)], missing=utils.NONE)
+        tools.assert_equals([Site.objects.get(pk=1), None], utils.get_cached_objects([(site_ct.id, 1), (site_ct.id, 100)], missing=utils.NONE))
+        tools.assert_raises(Site.DoesNotExist, utils.get_cached_object, Site, pk=100)
+
 class TestCacheInvalidation(CacheTestCase):
     def test_save_invalidates_object(self):
         self.ct = ContentType.objects.get_for_model(ContentType)
@@ -70,6 +122,174 @@ class TestCacheInvalidation(CacheTestCase):
         self.ct.save()
         tools.assert_equals(None, self.cache.get(utils._get_key(utils.KEY_PREFIX, self.ct, pkr=self.ct.pk)))
 
+class TestCacheThis(CacheTestCase):
+    def setUp(self):
+        super(TestCacheThis, self).setUp()
+        self.cache.clear()
+        self.calls = []
+        def func(value):
+            self.calls.append(value)
+            return value
+        self.func = utils.cache_this(lambda value: 'key', stale_timeout=60)(func)
+
+    def test_value_is_computed_once(self):
+        tools.assert_equals(1, self.func(1))
+        tools.assert_equals(1, self.func(2))
+        tools.assert_equals([1], self.calls)
+        tools.assert_equals({'hit': 1, 'miss': 1, 'recompute': 0, 'stale': 0}, self.func.stats)
+
+    def test_expired_value_gets_recomputed(self):
+        self.cache.set('key', utils.CachedValue(1, time.time() - 1, 0))
+        tools.assert_equals(2, self.func(2))
+        tools.assert_equals([2], self.calls)
+        tools.assert_equals(1, self.func.stats['recompute'])
+
+    def test_stale_value_served_while_other_worker_recomputes(self):
+        self.cache.set('key', utils.CachedValue(1, time.time() - 1, 0))
+        self.cache.set('key:lock', 1)
+        tools.assert_equals(1, self.func(2))
+        tools.assert_equals([], self.calls)
+        tools.assert_equals(1, self.func.stats['stale'])
+
+    def test_value_is_refreshed_early_with_xfetch(self):
+        func = utils.cache_this(lambda value: 'key', stale_timeout=60, beta=1)(lambda value: value)
+        # took a very long time to compute, expires soon
+        self.cache.set('key', utils.CachedValue(1, time.time() + 1, 10 ** 6))
+        tools.assert_equals(2, func(2))
+        tools.assert_equals(1, func.stats['recompute'])
+
+    def test_value_in_unknown_format_is_a_miss(self):
+        # stored by an older version
+        self.cache.set('key', (time.time() + 60, 0, 1))
+        tools.assert_equals(2, self.func(2))
+        tools.assert_equals(1, self.func.stats['miss'])
+
+    def test_value_of_previous_version_gets_recomputed(self):
+        self.version = 1
+        func = utils.cache_this(lambda value: 'key', stale_timeout=60, version_getter=lambda value: self.version)(lambda value: value)
+        tools.assert_equals(1, func(1))
+        tools.assert_equals(1, func(2))
+        self.version = 2
+        tools.assert_equals(3, func(3))
+        tools.assert_equals({'hit': 1, 'miss': 1, 'recompute': 1, 'stale': 0}, func.stats)
+
+    def test_value_of_previous_version_served_while_other_worker_recomputes(self):
+        func = utils.cache_this(lambda value: 'key', stale_timeout=60, version_getter=lambda value: 2)(lambda value: value)
+        self.cache.set('key', utils.CachedValue(1, time.time() + 60, 0, 1))
+        self.cache.set('key:lock', 1)
+        tools.assert_equals(1, func(2))
+        tools.assert_equals(1, func.stats['stale'])
+
+class TestIdentityMap(CacheTestCase):
+    def setUp(self):
+        super(TestIdentityMap, self).setUp()
+        self.ct = ContentType.objects.get_for_model(ContentType)
+        self.key = utils._get_key(utils.KEY_PREFIX, self.ct, pk=self.ct.pk)
+        utils.activate_identity_map()
+
+    def tearDown(self):
+        utils.deactivate_identity_map()
+        super(TestIdentityMap, self).tearDown()
+
+    def test_same_instance_returned_without_hitting_cache(self):
+        ct = utils.get_cached_object(self.ct, pk=self.ct.pk)
+        self.cache.delete(self.key)
+        tools.assert_true(ct is utils.get_cached_object(self.ct, pk=self.ct.pk))
+        tools.assert_equals(None, self.cache.get(self.key))
+
+    def test_get_cached_objects_populates_identity_map(self):
+        objs = utils.get_cached_objects([self.ct.pk], model=self.ct)
+        self.cache.delete(self.key)
+        tools.assert_true(objs[0] is utils.get_cached_object(self.ct, pk=self.ct.pk))
+
+    def test_save_removes_object_from_identity_map(self):
+        ct = utils.get_cached_object(self.ct, pk=self.ct.pk)
+        ct.save()
+        tools.assert_false(self.key in utils.get_identity_map())
+
+    def test_middleware_drops_identity_map_at_the_end_of_request(self):
+        request = RequestFactory().get('/')
+        mw = IdentityMapMiddleware()
+        mw.process_request(request)
+        utils.get_cached_object(self.ct, pk=self.ct.pk)
+        tools.assert_true(self.key in utils.get_identity_map())
+        mw.process_response(request, None)
+        tools.assert_equals(None, utils.get_identity_map())
+
+class TestLRUCache(TestCase):
+    def test_least_recently_used_item_is_evicted(self):
+        lru = tiered.LRUCache(max_entries=2)
+        lru.set('a', 1)
+        lru.set('b', 2)
+        lru.get('a')
+        lru.set('c', 3)
+        tools.assert_equals(2, len(lru))
+        tools.assert_equals(None, lru.get('b'))
+        tools.assert_equals(1, lru.get('a'))
+
+    def test_size_limit_is_respected(self):
+        lru = tiered.LRUCache(max_size=100)
+        lru.set('a', 'x' * 60)
+        lru.set('b', 'x' * 60)
+        tools.assert_equals(None, lru.get('a'))
+        lru.set('c', 'x' * 200)
+        tools.assert_equals(None, lru.get('c'))
+        tools.assert_equals('x' * 60, lru.get('b'))
+
+    def test_expired_item_is_not_returned(self):
+        lru = tiered.LRUCache(timeout=60)
+        lru.set('a', 1)
+        lru._data['a'][tiered.EXPIRES] = time.time() - 1
+        tools.assert_equals(None, lru.get('a'))
+        tools.assert_equals(0, len(lru))
+
+class TestTieredCache(CacheTestCase):
+    def setUp(self):
+        super(TestTieredCache, self).setUp()
+        self.cache.clear()
+        self.ct = ContentType.objects.get_for_model(ContentType)
+        self.key = utils._get_key(utils.KEY_PREFIX, self.ct, pk=self.ct.pk)
+        self.tiers = [
+            tiered.get_tiered_cache(self.cache, {}, utils.KEY_PREFIX + ':'),
+            tiered.get_tiered_cache(self.cache, {}, utils.KEY_PREFIX + ':'),
+        ]
+        utils.cache = self.tiers[0]
+
+    def test_object_served_from_local_tier(self):
+        utils.get_cached_object(self.ct, pk=self.ct.pk)
+        self.cache.delete(self.key)
+        tools.assert_equals(self.ct, utils.get_cached_object(self.ct, pk=self.ct.pk))
+        tools.assert_equals(None, self.cache.get(self.key))
+
+    def test_other_keys_bypass_local_tier(self):
+        self.tiers[0].set('some:key', 1)
+        tools.assert_equals(0, len(self.tiers[0].local))
+        tools.assert_equals(1, self.cache.get('some:key'))
+
+    def test_delete_invalidates_other_processes_on_sync(self):
+        for t in self.tiers:
+            t.sync()
+            t.get_many([self.key])
+            t.set(self.key, 'value')
+        self.ct.save()
+        tools.assert_equals(None, self.tiers[0].get(self.key))
+        tools.assert_equals('value', self.tiers[1].get(self.key))
+        self.tiers[1].sync()
+        tools.assert_equals(None, self.tiers[1].get(self.key))
+
+    def test_unrelated_save_does_not_flush_other_processes(self):
+        self.tiers = [tiered.get_tiered_cache(self.cache, {'models': ['contenttypes.contenttype']}, utils.KEY_PREFIX + ':') for i in range(2)]
+        utils.cache = self.tiers[0]
+        for t in self.tiers:
+            t.sync()
+            t.set(self.key, 'value')
+        Site.objects.get_current().save()
+        self.tiers[1].sync()
+        tools.assert_equals('value', self.tiers[1].get(self.key))
+        self.ct.save()
+        self.tiers[1].sync()
+        tools.assert_equals(None, self.tiers[1].get(self.key))
+
 class TestRedisListings(TestCase):
     def setUp(self):
         super(TestRedisListings, self).setUp()
@@ -94,6 +314,10 @@ class TestRedisListings(TestCase):
         post_delete.disconnect(redis.listing_post_delete, sender=Listing)
         content_published.disconnect(redis.publishable_published)
         content_unpublished.disconnect(redis.publishable_unpublished)
+        content_published_bulk.disconnect(redis.publishables_published)
+        content_unpublished_bulk.disconnect(redis.publishables_unpublished)
+        disconnect_publishable_signal(post_save, redis.publishable_post_save)
+        disconnect_publishable_signal(post_delete, redis.publishable_post_delete)
 
         super(TestRedisListings, self).tearDown()
         self.redis.flushdb()
@@ -190,6 +414,100 @@ class TestRedisListings(TestCase):
         tools.assert_equals(['%d:1' % ct_id], self.redis.zrange('listing:c:1', 0, 100))
         tools.assert_equals(['%d:1' % ct_id, '%d:3' % ct_id], self.redis.zrange('listing:ct:%d' % ct_id, 0, 100))
 
+    def test_add_publishables_writes_each_key_once(self):
+        ct_id = self.publishables[0].content_type_id
+        items = [(self.category_nested_second, p, 10 + i) for i, p in enumerate(self.publishables)]
+        items.append((self.category_nested, self.publishables[0], 5))
+        # load category hierarchy
+        redis.RedisListingHandler.get_keys(self.category_nested_second, self.publishables[0])
+
+        pipe = self.redis.pipeline()
+        self.assertNumQueries(0, redis.RedisListingHandler.add_publishables, items, pipe=pipe, commit=False)
+        tools.assert_equals(9, len(pipe.command_stack))
+        pipe.execute()
+
+        tools.assert_equals(
+            [('%d:1' % ct_id, 10.0), ('%d:2' % ct_id, 11.0), ('%d:3' % ct_id, 12.0)],
+            self.redis.zrange('listing:d:1', 0, -1, withscores=True)
+        )
+        tools.assert_equals(['%d:1' % ct_id], self.redis.zrange('listing:2', 0, -1))
+
+    def test_remove_publishables_removes_from_all_keys(self):
+        list_all_publishables_in_category_by_hour(self)
+        ct_id = self.publishables[0].content_type_id
+        redis.RedisListingHandler.remove_publishables([(l.category, l.publishable) for l in self.listings[1:]])
+        tools.assert_equals(['%d:3' % ct_id], self.redis.zrange('listing:d:1', 0, -1))
+        tools.assert_equals(['%d:3' % ct_id], self.redis.zrange('listing:ct:%d' % ct_id, 0, -1))
+
+    def test_rebuild_restores_lost_data(self):
+        list_all_publishables_in_category_by_hour(self)
+        expected = dict((k, self.redis.zrange(k, 0, -1, withscores=True)) for k in self.redis.keys())
+        self.redis.flushdb()
+        self.redis.zadd('listing:c:1', **{'0:0': 1})
+
+        stats = redis.rebuild_listings(chunk_size=2)
+        tools.assert_equals(3, stats['listings'])
+        tools.assert_equals(expected, dict((k, self.redis.zrange(k, 0, -1, withscores=True)) for k in self.redis.keys()))
+
+    def test_rebuild_of_category_leaves_other_keys_alone(self):
+        list_all_publishables_in_category_by_hour(self)
+        ct_id = self.publishables[0].content_type_id
+        self.redis.delete('listing:d:2')
+        self.redis.zrem('listing:d:1', '%d:2' % ct_id)
+
+        redis.rebuild_listings(self.category_nested)
+        tools.assert_equals(['%d:2' % ct_id, '%d:3' % ct_id], self.redis.zrange('listing:d:2', 0, -1))
+        tools.assert_equals(['%d:1' % ct_id, '%d:3' % ct_id], self.redis.zrange('listing:d:1', 0, -1))
+
+    def test_generate_publish_signals_writes_whole_chunk(self):
+        list_all_publishables_in_category_by_hour(self)
+        ct_id = self.publishables[0].content_type_id
+        now = datetime.now()
+        Listing.objects.all().update(publish_from=now)
+        Publishable.objects.all().update(announced=False, publish_from=now - timedelta(days=1), publish_to=now + timedelta(days=1))
+        self.redis.flushdb()
+
+        generate_publish_signals(chunk_size=2)
+        tools.assert_equals(['%d:1' % ct_id, '%d:2' % ct_id, '%d:3' % ct_id], sorted(self.redis.zrange('listing:d:1', 0, -1)))
+
+        generate_publish_signals(now + timedelta(days=2), chunk_size=2)
+        tools.assert_equals([], self.redis.zrange('listing:d:1', 0, -1))
+
+    def test_publishable_save_schedules_next_transition(self):
+        p = self.publishables[0]
+        p.publish_from = datetime.now() + timedelta(hours=1)
+        p.save()
+        tools.assert_equals([str(p.pk)], self.redis.zrange(redis.SCHEDULE_KEY, 0, -1))
+        p.published = False
+        p.save()
+        tools.assert_equals([], self.redis.zrange(redis.SCHEDULE_KEY, 0, -1))
+
+    def test_only_saves_of_publishables_are_watched(self):
+        receivers = lambda model: post_save._live_receivers(_make_id(model))
+        tools.assert_true(redis.publishable_post_save in receivers(Article))
+        tools.assert_false(redis.publishable_post_save in receivers(Category))
+
+    def test_process_schedule_announces_due_publishables(self):
+        list_all_publishables_in_category_by_hour(self)
+        ct_id = self.publishables[0].content_type_id
+        now = datetime.now()
+        p = self.publishables[0]
+        p.publish_from = now + timedelta(hours=1)
+        p.publish_to = now + timedelta(hours=2)
+        p.save()
+        tools.assert_false(Publishable.objects.get(pk=p.pk).announced)
+        tools.assert_equals(['%d:2' % ct_id, '%d:3' % ct_id], sorted(self.redis.zrange('listing:d:1', 0, -1)))
+
+        tools.assert_equals(0, redis.process_schedule(now))
+        tools.assert_equals(1, redis.process_schedule(now + timedelta(hours=1, seconds=1)))
+        tools.assert_true(Publishable.objects.get(pk=p.pk).announced)
+        tools.assert_equals(['%d:1' % ct_id, '%d:2' % ct_id, '%d:3' % ct_id], sorted(self.redis.zrange('listing:d:1', 0, -1)))
+
+        tools.assert_equals(1, redis.process_schedule(now + timedelta(hours=2, seconds=1)))
+        tools.assert_false(Publishable.objects.get(pk=p.pk).announced)
+        tools.assert_equals(['%d:2' % ct_id, '%d:3' % ct_id], sorted(self.redis.zrange('listing:d:1', 0, -1)))
+        tools.assert_equals([], self.redis.zrange(redis.SCHEDULE_KEY, 0, -1))
+
     def test_get_listing_uses_data_from_redis(self):
         ct_id = self.publishables[0].content_type_id
         t1, t2 = time.time()-90, time.time()-100
@@ -254,9 +572,51 @@ class TestRedisListings(TestCase):
         tools.assert_equals(1, len(l))
         tools.assert_equals(l[0].publishable, self.publishables[1])
 
+    def test_excluded_publishable_is_skipped_when_paginating(self):
+        ct_id = self.publishables[0].content_type_id
+        t1, t2, t3 = time.time()-90, time.time()-100, time.time() - 110
+        self.redis.zadd('listing:c:2', '%d:1' % ct_id, repr(t1))
+        self.redis.zadd('listing:c:2', '%d:3' % ct_id, repr(t2))
+        self.redis.zadd('listing:c:2', '%d:2' % ct_id, repr(t3))
+
+        lh = Listing.objects.get_queryset_wrapper(category=self.category_nested, children=ListingHandler.IMMEDIATE, exclude=self.publishables[2], source='redis')
+        tools.assert_equals(2, lh.count())
+        tools.assert_equals([self.publishables[0]], [l.publishable for l in lh.get_listings(0, 1)])
+        tools.assert_equals([self.publishables[1]], [l.publishable for l in lh.get_listings(1, 1)])
+        # excluded value is never copied
+        tools.assert_equals(['listing:c:2'], self.redis.keys('listing:*:2*'))
+
+    def test_get_listing_with_content_types_reuses_result_key(self):
+        ct_id = self.publishables[0].content_type_id
+        t1, t2 = time.time()-90, time.time()-100
+        self.redis.zadd('listing:c:2', '%d:1' % ct_id, repr(t1))
+        self.redis.zadd('listing:c:2', '%d:3' % ct_id, repr(t2))
+        self.redis.zadd('listing:ct:%d' % ct_id, '%d:1' % ct_id, repr(t1))
+        self.redis.zadd('listing:ct:%d' % ct_id, '%d:3' % ct_id, repr(t2))
+
+        ct = ContentType.objects.get_for_id(ct_id)
+        lh = Listing.objects.get_queryset_wrapper(category=self.category_nested, children=ListingHandler.IMMEDIATE, content_types=[ct], source='redis')
+        tools.assert_equals(2, lh.count())
+        self.redis.zrem('listing:c:2', '%d:3' % ct_id)
+        tools.assert_equals([self.publishables[0], self.publishables[2]], [l.publishable for l in lh.get_listings(0, 10)])
+
+    def test_get_listing_without_lua(self):
+        ct_id = self.publishables[0].content_type_id
+        t1, t2 = time.time()-90, time.time()-100
+        self.redis.zadd('listing:c:2', '%d:1' % ct_id, repr(t1))
+        self.redis.zadd('listing:c:2', '%d:3' % ct_id, repr(t2))
+
+        lh = Listing.objects.get_queryset_wrapper(category=self.category_nested, children=ListingHandler.IMMEDIATE, exclude=self.publishables[0], source='redis')
+        lh.USE_LUA = False
+        tools.assert_equals(1, lh.count())
+        tools.assert_equals([self.publishables[2]], [l.publishable for l in lh.get_listings(0, 10)])
+
 class SlidingLH(redis.SlidingListingHandler):
     PREFIX = 'sliding'
 
+class IncrementalLH(SlidingLH):
+    INCREMENTAL = True
+
 class TestSlidingListings(TestCase):
     def setUp(self):
         super(TestSlidingListings, self).setUp()
@@ -291,6 +651,12 @@ class TestSlidingListings(TestCase):
         tools.assert_equals(set(expected), set(self.redis.keys(SlidingLH.PREFIX + '*')))
         tools.assert_equals(self.redis.zrange('sliding:d:1', 0, -1, withscores=True), self.redis.zrange('sliding:d:1' + ':' + day, 0, -1, withscores=True))
 
+    def test_add_publishables_registers_keys_in_same_pipeline(self):
+        pipe = SlidingLH.add_publishables([(self.category, p, 10) for p in self.publishables], commit=False)
+        tools.assert_equals([], self.redis.keys(SlidingLH.PREFIX + '*'))
+        pipe.execute()
+        tools.assert_equals(set(['sliding:1', 'sliding:c:1', 'sliding:d:1', 'sliding:ct:%s' % self.ct_id]), self.redis.smembers('sliding:KEYS'))
+
     def test_slide_windows_regenerates_aggregates(self):
         SlidingLH.add_publishable(self.category, self.publishables[0], 10)
         # register the keys that should exist
@@ -327,3 +693,61 @@ class TestSlidingListings(TestCase):
             ],
             self.redis.zrange('sliding:WINDOWS', 0, -1, withscores=True)
         )
+
+    def test_incremental_regenerate_subtracts_expired_days(self):
+        self.redis.sadd('sliding:KEYS', 'sliding:1')
+        self.redis.zadd('sliding:WINDOWS', **{'sliding:1:20101003': 20101003, 'sliding:1:20101004': 20101004})
+        self.redis.zadd('sliding:1:20101003', **{'17:1': 8, '17:2': 3})
+        self.redis.zadd('sliding:1:20101004', **{'17:1': 9, '17:3': 2})
+        self.redis.zadd('sliding:1:20101010', **{'17:1': 10})
+
+        IncrementalLH.regenerate(date(2010, 10, 9))
+        tools.assert_equals([('17:3', 2.0), ('17:2', 3.0), ('17:1', 17.0)], self.redis.zrange('sliding:1', 0, -1, withscores=True))
+
+        # hits go directly to the aggregate
+        self.redis.zincrby('sliding:1', '17:1', 10)
+        IncrementalLH.regenerate(date(2010, 10, 10))
+        tools.assert_equals([('17:3', 2.0), ('17:1', 19.0)], self.redis.zrange('sliding:1', 0, -1, withscores=True))
+        tools.assert_false(self.redis.exists('sliding:1:20101003'))
+        tools.assert_equals('20101004', self.redis.hget('sliding:STARTS', 'sliding:1'))
+
+    def test_regenerate_only_touches_keys_in_shard(self):
+        keys = ['sliding:%d' % i for i in xrange(10)]
+        self.redis.sadd('sliding:KEYS', *keys)
+        for k in keys:
+            self.redis.zadd(k + ':20101010', **{'17:1': 1})
+
+        SlidingLH.regenerate(date(2010, 10, 10), shard=1, shards=2)
+        tools.assert_equals(
+            set(k for k in keys if SlidingLH._in_shard(k, 1, 2)),
+            set(k for k in keys if self.redis.exists(k))
+        )
+        tools.assert_true(0 < len(filter(self.redis.exists, keys)) < 10)
+
+    def test_hit_buffer_flushes_after_max_hits(self):
+        hits = redis.HitBuffer(SlidingLH, max_hits=3, interval=60)
+        hits.track_hit(None, category=self.category, publishable=self.publishables[0])
+        hits.track_hit(None, category=self.category, publishable=self.publishables[1])
+        tools.assert_equals([], self.redis.zrange('sliding:d:1', 0, -1))
+        tools.assert_equals(2, hits.pending())
+
+        hits.track_hit(None, category=self.category, publishable=self.publishables[0])
+        tools.assert_equals(
+            [('%d:2' % self.ct_id, 1.0), ('%d:1' % self.ct_id, 2.0)],
+            self.redis.zrange('sliding:d:1', 0, -1, withscores=True)
+        )
+        tools.assert_equals({'hits': 3, 'flushed': 3, 'dropped': 0, 'flushes': 1}, hits.stats)
+
+    def test_hit_buffer_counts_dropped_hits(self):
+        hits = redis.HitBuffer(SlidingLH, max_hits=10, interval=60)
+        hits.add(self.category, self.publishables[0], 2)
+        redis.client = None
+        hits.flush()
+        tools.assert_equals(2, hits.stats['dropped'])
+        tools.assert_equals(0, hits.pending())
+
+    def test_track_hit_increments_score(self):
+        SlidingLH.track_hit(None, category=self.category, publishable=self.publishables[0])
+        SlidingLH.track_hit(None, category=self.category, publishable=self.publishables[0])
+        SlidingLH.track_hit(None, category=self.category, publishable=None)
+        tools.assert_equals([('%d:1' % self.ct_id, 2.0)], self.redis.zrange('sliding:d:1', 0, -1, withscores=True))
@@ -1,11 +1,15 @@
 # -*- coding: utf-8 -*-
 from django.test import TestCase
+from django.core.cache import get_cache
+from django.db import models
+from django.core.management import call_command
 
 from nose import tools
 
 from django.core.urlresolvers import reverse
 
-from ella.core.models import Category
+from ella.core.models import Category, CategoryClosure
+from ella.core import managers
 
 from test_ella.test_core import create_basic_categories
 
@@ -71,3 +75,86 @@ class TestCategory(TestCase):
         url = reverse('category_detail', args=(self.category_nested.tree_path, ))
         tools.assert_equals(url, self.category_nested.get_absolute_url())
 
+
+class TestCategoryClosure(TestCase):
+    def setUp(self):
+        super(TestCategoryClosure, self).setUp()
+        create_basic_categories(self)
+
+    def get_closure(self, propagates=None):
+        qset = CategoryClosure.objects.all()
+        if propagates is not None:
+            qset = qset.filter(propagates=propagates)
+        return sorted(qset.values_list('ancestor', 'descendant', 'depth'))
+
+    def test_closure_contains_all_ancestors(self):
+        c, n, s = self.category.pk, self.category_nested.pk, self.category_nested_second.pk
+        tools.assert_equals(sorted([
+                (c, c, 0), (n, n, 0), (s, s, 0),
+                (c, n, 1), (n, s, 1),
+                (c, s, 2)
+            ]), self.get_closure())
+
+    def test_closure_respects_propagate_listings(self):
+        self.category_nested.app_data = {'ella': {'propagate_listings': False}}
+        self.category_nested.save()
+        c, n, s = self.category.pk, self.category_nested.pk, self.category_nested_second.pk
+        tools.assert_equals([(c, n, 1), (c, s, 2)], self.get_closure(propagates=False))
+
+    def test_closure_follows_moved_category(self):
+        self.category_nested_second.tree_parent = self.category
+        self.category_nested_second.save()
+        c, s = self.category.pk, self.category_nested_second.pk
+        tools.assert_equals([(c, s, 1), (s, s, 0)], sorted(CategoryClosure.objects.filter(descendant=s).values_list('ancestor', 'descendant', 'depth')))
+
+    def test_raw_save_is_skipped(self):
+        category = Category(title=u'Raw', slug=u'raw', tree_path=u'nested-category/raw',
+            tree_parent=self.category_nested, site=self.category.site)
+        # what loaddata does
+        models.Model.save_base(category, raw=True)
+        tools.assert_equals([], list(CategoryClosure.objects.filter(descendant=category.pk)))
+
+    def test_command_rebuilds_whole_closure(self):
+        closure = self.get_closure()
+        CategoryClosure.objects.all().delete()
+        call_command('rebuild_category_closure', verbosity=0)
+        tools.assert_equals(closure, self.get_closure())
+
+class TestCategoryTree(TestCase):
+    def setUp(self):
+        super(TestCategoryTree, self).setUp()
+        self.old_cache = managers.cache
+        managers.cache = get_cache('locmem://')
+        managers.cache.clear()
+        create_basic_categories(self)
+
+    def tearDown(self):
+        managers.cache = self.old_cache
+        super(TestCategoryTree, self).tearDown()
+
+    def test_lookups_dont_hit_db_once_tree_is_loaded(self):
+        Category.objects.get_tree()
+        self.assertNumQueries(0, lambda: (
+            Category.objects.get_for_id(self.category_nested.pk),
+            Category.objects.get_by_tree_path('nested-category/second-nested-category'),
+            Category.objects.get_children(self.category, recursive=True)
+        ))
+
+    def test_tree_reloaded_when_other_process_changes_category(self):
+        Category.objects.get_tree()
+        Category.objects.filter(pk=self.category_nested.pk).update(title=u'Changed')
+        tools.assert_not_equals(u'Changed', Category.objects.get_for_id(self.category_nested.pk).title)
+
+        # as done by clear_cache() in another process
+        managers.cache.set(managers.CATEGORY_TREE_VERSION_KEY, 'other')
+        managers.CategoryManager._checked = 0
+        tools.assert_equals(u'Changed', Category.objects.get_for_id(self.category_nested.pk).title)
+
+    def test_saved_category_visible_immediately(self):
+        c = Category.objects.create(
+            title=u'third nested category',
+            tree_parent=self.category_nested,
+            site_id=self.site_id,
+            slug=u'third-nested-category',
+        )
+        tools.assert_equals(c, Category.objects.get_by_tree_path('nested-category/third-nested-category'))
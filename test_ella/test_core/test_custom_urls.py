@@ -229,3 +229,29 @@ class TestCustomObjectDetailReverse(CustomObjectDetailTestCase):
 
         tools.assert_raises(NoReverseMatch,  custom_urls.resolver.reverse, self.publishable, 'prefix')
 
+
+    def test_resolver_is_reused(self):
+        custom_urls.resolver.register(self.urlpatterns, prefix='prefix')
+
+        tools.assert_true(custom_urls.resolver._get_resolver(self.publishable) is custom_urls.resolver._get_resolver(self.publishable))
+
+    def test_registration_is_seen_by_existing_resolver(self):
+        custom_urls.resolver.register(self.urlpatterns, prefix='prefix', model=self.publishable.__class__)
+        custom_urls.resolver.reverse(self.publishable, 'prefix')
+        custom_urls.resolver.register(patterns('', url(r'^other/$', dummy_view, name='other')))
+
+        tools.assert_equals(self.url + 'other/', custom_urls.resolver.reverse(self.publishable, 'other'))
+
+class TestCustomObjectDetailReverseMany(CustomObjectDetailTestCase):
+    def test_works_for_multiple_models(self):
+        custom_urls.resolver.register(self.urlpatterns, prefix='prefix')
+
+        tools.assert_equals(
+            [self.url + 'prefix/new/41/', self.category.get_absolute_url() + 'prefix/new/41/'],
+            custom_urls.resolver.reverse_many([self.publishable, self.category], 'prefix-new', 41)
+        )
+
+    def test_raises_if_one_model_doesnt_have_the_view(self):
+        custom_urls.resolver.register(self.urlpatterns, prefix='prefix', model=self.publishable.__class__)
+
+        tools.assert_raises(NoReverseMatch,  custom_urls.resolver.reverse_many, [self.publishable, self.category], 'prefix')
@@ -0,0 +1,73 @@
+# -*- coding: utf-8 -*-
+import random
+from unittest import TestCase
+
+from nose import tools
+
+from django.core import urlresolvers
+from django.core.urlresolvers import RegexURLResolver
+
+from ella.core import urls
+from ella.core.dispatcher import SegmentDispatcher
+
+# segments the paths are generated from
+SEGMENTS = (
+    '', 'x', 'y', 'A', 'a-b', 'nested-category', 'export', 'xml', 'feeds',
+    'atom', 'articles', 'comments', 'new', '2008', '1', '10', '123',
+    'first-article', '1-first-article',
+)
+
+def generate_paths(count, seed=0):
+    r = random.Random(seed)
+    for i in xrange(count):
+        path = '/'.join(r.choice(SEGMENTS) for j in xrange(r.randint(0, 9)))
+        if r.random() < 0.9:
+            path += '/'
+        yield path
+
+class TestSegmentDispatcher(TestCase):
+    def setUp(self):
+        super(TestSegmentDispatcher, self).setUp()
+        self.patterns = [p for p in urls.urlpatterns if not isinstance(p, SegmentDispatcher)]
+        self.dispatcher = SegmentDispatcher(self.patterns, multi_segment=[urls.res['cat']], remainder=[urls.res['rest']])
+
+    def test_all_core_patterns_are_handled(self):
+        tools.assert_equals(len(self.patterns), len(self.dispatcher.patterns))
+
+    def assert_resolves_same_as_django(self, path):
+        try:
+            expected = urlresolvers.resolve('/' + path)
+        except urlresolvers.Resolver404:
+            expected = None
+        match = self.dispatcher.resolve(path)
+        if expected is None:
+            tools.assert_equals(None, match, path)
+        else:
+            tools.assert_not_equals(None, match, path)
+            tools.assert_equals(
+                (expected.func, expected.kwargs, expected.url_name),
+                (match.func, match.kwargs, match.url_name),
+                path
+            )
+
+    def test_resolves_same_as_django(self):
+        for path in generate_paths(20000):
+            self.assert_resolves_same_as_django(path)
+
+    def test_category_is_matched_greedily(self):
+        path = 'x/y/comments/1-first-article/1/new/1-first-article/feeds/A/'
+        self.assert_resolves_same_as_django(path)
+        tools.assert_equals('x/y/comments/1-first-article/1', self.dispatcher.resolve(path).kwargs['category'])
+
+    def test_patterns_after_unsupported_one_are_left_out(self):
+        patterns = self.patterns[:2] + [urls.url(r'^(\d+)/$', urls.home)] + self.patterns[2:]
+        dispatcher = SegmentDispatcher(patterns)
+        tools.assert_equals(2, len(dispatcher.patterns))
+        tools.assert_equals(None, dispatcher.resolve('export/'))
+
+    def test_works_within_url_resolver(self):
+        class urlconf:
+            urlpatterns = [self.dispatcher] + self.patterns
+        resolver = RegexURLResolver(r'^/', urlconf)
+        tools.assert_equals('category_detail', resolver.resolve('/nested-category/').url_name)
+        tools.assert_equals('nested-category/', resolver.reverse('category_detail', category='nested-category'))
@@ -2,11 +2,18 @@
 from datetime import datetime, timedelta
 
 from django.test import TestCase
+from django.core.cache import get_cache
+from django.db.models.signals import post_save
+from django.dispatch.dispatcher import _make_id
 
 from nose import tools
 
 from ella.core.models import Listing, Category
-from ella.core.managers import ListingHandler
+from ella.core.models.publishable import publishable_changed
+from ella.articles.models import Article
+from ella.core import managers
+from ella.core.cache import utils
+from ella.core.managers import ListingHandler, get_listing_generation
 
 from test_ella.test_core import create_basic_categories, create_and_place_a_publishable, \
         create_and_place_more_publishables, list_all_publishables_in_category_by_hour
@@ -74,6 +81,67 @@ class TestListing(TestCase):
         tools.assert_equals(len(self.listings), len(l))
         tools.assert_equals(listing, l[0])
 
+    def test_get_listing_with_all_children_no_duplicates_paginates_correctly(self):
+        for c in (self.category, self.category_nested, self.category_nested_second):
+            Listing.objects.create(
+                    publishable=self.publishables[0],
+                    category=c,
+                    publish_from=datetime.now() - timedelta(days=2),
+                )
+        expected = Listing.objects.get_listing(category=self.category, children=ListingHandler.ALL, count=10)
+        tools.assert_equals(len(self.listings), len(expected))
+        tools.assert_equals(len(set(l.publishable_id for l in expected)), len(expected))
+        tools.assert_equals(expected[1:3], Listing.objects.get_listing(category=self.category, children=ListingHandler.ALL, count=2, offset=1))
+
+    def page_with_cursors(self, start, direction):
+        " Collect listings of self.category with children after ``start`` one by one. "
+        listings = []
+        cursor = managers.get_cursor(start, grouped=True)
+        while True:
+            page = Listing.objects.get_listing(category=self.category, children=ListingHandler.ALL, count=1,
+                **{direction: managers.parse_cursor(cursor)})
+            if not page:
+                return listings
+            listings.extend(page)
+            cursor = managers.get_cursor(page[0], grouped=True)
+
+    def test_get_listing_with_children_cursors_go_through_ties(self):
+        Listing.objects.all().update(publish_from=datetime(2008, 1, 10))
+        expected = Listing.objects.get_listing(category=self.category, children=ListingHandler.ALL, count=10)
+        tools.assert_equals(len(self.listings), len(expected))
+        tools.assert_equals(expected[1:], self.page_with_cursors(expected[0], 'before'))
+        tools.assert_equals(expected[-2::-1], self.page_with_cursors(expected[-1], 'after'))
+
+    def test_get_listing_with_children_cursors_dont_repeat_publishables(self):
+        for c in (self.category_nested, self.category_nested_second):
+            Listing.objects.create(
+                    publishable=self.publishables[0],
+                    category=c,
+                    publish_from=self.listings[-1].publish_from - timedelta(days=2),
+                )
+        expected = Listing.objects.get_listing(category=self.category, children=ListingHandler.ALL, count=10)
+        tools.assert_equals(len(self.listings), len(expected))
+        tools.assert_equals(expected[1:], self.page_with_cursors(expected[0], 'before'))
+        tools.assert_equals(expected[-2::-1], self.page_with_cursors(expected[-1], 'after'))
+
+    def test_get_listing_with_children_uses_two_queries(self):
+        Listing.objects.create(
+                publishable=self.publishables[0],
+                category=self.category_nested_second,
+                publish_from=datetime.now() - timedelta(days=2),
+            )
+        # load category hierarchy
+        Listing.objects.get_listing(category=self.category, children=ListingHandler.ALL)
+        self.assertNumQueries(2, lambda: Listing.objects.get_listing(category=self.category, children=ListingHandler.ALL))
+
+    def test_get_listing_count_counts_publishables(self):
+        Listing.objects.create(
+                publishable=self.publishables[0],
+                category=self.category_nested_second,
+                publish_from=datetime.now() - timedelta(days=2),
+            )
+        tools.assert_equals(len(self.listings), Listing.objects.get_listing_count(category=self.category, children=ListingHandler.ALL))
+
     def test_get_listing_IMMEDIATE_without_limited_categories(self):
         self.category_nested.app_data = {'ella': {'propagate_listings': False}}
         self.category_nested.save()
@@ -106,3 +174,69 @@ class TestListing(TestCase):
         l = Listing.objects.get_listing(category=self.category, children=ListingHandler.ALL, exclude=l.publishable)
         tools.assert_equals(self.listings[1:], l)
 
+
+class TestListingGenerations(TestCase):
+    def setUp(self):
+        super(TestListingGenerations, self).setUp()
+        self.old_caches = managers.cache, utils.cache
+        managers.cache = utils.cache = self.cache = get_cache('locmem://')
+        self.cache.clear()
+        create_basic_categories(self)
+        create_and_place_a_publishable(self)
+        create_and_place_more_publishables(self)
+        list_all_publishables_in_category_by_hour(self)
+
+    def tearDown(self):
+        managers.cache, utils.cache = self.old_caches
+        super(TestListingGenerations, self).tearDown()
+
+    def test_generation_is_stable(self):
+        tools.assert_equals(get_listing_generation(self.category), get_listing_generation(self.category))
+
+    def test_listing_is_cached(self):
+        l = Listing.objects.get_listing(category=self.category, children=ListingHandler.ALL)
+        Listing.objects.filter(pk=self.listings[0].pk).update(publish_to=datetime.now() - timedelta(days=1))
+        tools.assert_equals(l, Listing.objects.get_listing(category=self.category, children=ListingHandler.ALL))
+
+    def test_saving_listing_bumps_generation_of_ancestors_only(self):
+        root = get_listing_generation(self.category)
+        nested = get_listing_generation(self.category_nested)
+        sibling = get_listing_generation(self.category_nested_second)
+        [l for l in self.listings if l.category == self.category_nested][0].save()
+        tools.assert_not_equals(root, get_listing_generation(self.category))
+        tools.assert_not_equals(nested, get_listing_generation(self.category_nested))
+        tools.assert_equals(sibling, get_listing_generation(self.category_nested_second))
+
+    def test_listing_changes_immediately_when_listing_changes(self):
+        Listing.objects.get_listing(category=self.category, children=ListingHandler.ALL)
+        l = self.listings[0]
+        l.publish_to = datetime.now() - timedelta(days=1)
+        l.save()
+        tools.assert_equals(self.listings[1:], Listing.objects.get_listing(category=self.category, children=ListingHandler.ALL))
+
+    def test_unpublishing_publishable_changes_listing(self):
+        Listing.objects.get_listing(category=self.category, children=ListingHandler.ALL)
+        p = self.listings[0].publishable
+        p.published = False
+        p.save()
+        tools.assert_equals(self.listings[1:], Listing.objects.get_listing(category=self.category, children=ListingHandler.ALL))
+
+    def test_category_with_listings_can_be_deleted(self):
+        gen = get_listing_generation(self.category)
+        # the tree gets reloaded without the deleted categories
+        Category.objects.clear_cache()
+        self.category_nested.delete()
+        tools.assert_equals(0, Listing.objects.filter(category=self.category_nested_second).count())
+        tools.assert_not_equals(gen, get_listing_generation(self.category))
+
+    def test_only_saves_of_publishables_are_watched(self):
+        receivers = lambda model: post_save._live_receivers(_make_id(model))
+        tools.assert_true(publishable_changed in receivers(Article))
+        tools.assert_false(publishable_changed in receivers(Category))
+
+    def test_moving_listing_bumps_old_category(self):
+        l = [l for l in self.listings if l.category == self.category_nested_second][0]
+        gen = get_listing_generation(self.category_nested_second)
+        l.category = self.category
+        l.save()
+        tools.assert_not_equals(gen, get_listing_generation(self.category_nested_second))
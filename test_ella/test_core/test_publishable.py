@@ -176,3 +176,19 @@ class TestSignals(TestCase):
         tools.assert_equals(0, len(self.unpublish_received))
         tools.assert_equals(self.publishable, self.publish_received[0]['publishable'].target)
 
+
+    def test_generate_sends_bulk_signal_per_chunk(self):
+        received = []
+        def publish_bulk(publishables, **kwargs):
+            received.append(publishables)
+        signals.content_published_bulk.connect(publish_bulk)
+        try:
+            self.publishable.publish_from = datetime.now() + timedelta(days=1)
+            self.publishable.save()
+            self._signal_clear()
+            generate_publish_signals(datetime.now() + timedelta(days=1, seconds=2), chunk_size=1)
+        finally:
+            signals.content_published_bulk.disconnect(publish_bulk)
+
+        tools.assert_equals([[self.publishable.publishable_ptr]], received)
+        tools.assert_true(self.publish_received[0]['bulk'])
@@ -9,7 +9,10 @@ from django.template import TemplateSyntaxError
 from django.contrib.sites.models import Site
 from django.contrib.contenttypes.models import ContentType
 from django.core.paginator import Paginator
+from django.core.cache import get_cache
 
+from ella.core import box
+from ella.core.box import Box
 from ella.core.templatetags.core import listing_parse, ListingNode, _parse_box, BoxNode, EmptyNode
 from ella.core.templatetags.pagination import _do_paginator
 from ella.core.models import Category
@@ -63,6 +66,23 @@ class TestPaginate(UnitTestCase):
     def test_dont_fail_on_missing_page(self):
         tools.assert_equals(('inclusion_tags/paginator.html', {}),  _do_paginator({}, 2, None))
 
+    def test_cursors_are_used_without_page(self):
+        req = self.rf.get('/', {'using': 'custom_lh', 'before': '20080101000000000000-1'})
+        context = {
+            'request': req,
+            'page': None,
+            'results_per_page': 10,
+            'next_cursor': '20070101000000000000-2',
+            'prev_cursor': None,
+        }
+        tools.assert_equals(('inclusion_tags/paginator.html', {
+            'cursor': True,
+            'query_params': '?using=custom_lh&',
+            'results_per_page': 10,
+            'next_url': '?using=custom_lh&before=20070101000000000000-2',
+            'prev_url': None,
+        }), _do_paginator(context, 2, None))
+
     def test_proper_template_gets_rendered(self):
         template_loader.templates['inclusion_tags/paginator_special.html'] = 'special'
         t = template.Template('{% load pagination %}{% paginator template_name="special" %}')
@@ -226,6 +246,46 @@ class TestBoxTag(UnitTestCase):
         t = template.Template('{% box name for var %}{% endbox %}')
         tools.assert_equals('', t.render(template.Context({'var': None})))
 
+class TestPrefetchBoxesTag(TestCase):
+    def setUp(self):
+        super(TestPrefetchBoxesTag, self).setUp()
+        self.old_cache = box.cache
+        box.cache = self.cache = get_cache('locmem://')
+        self.cache.clear()
+        self.site = Site.objects.get(pk=1)
+        self.other_site = Site.objects.create(domain='example.org', name='example.org')
+        template_loader.templates['box/box.html'] = '{{ object }}'
+
+    def tearDown(self):
+        box.cache = self.old_cache
+        template_loader.templates = {}
+        super(TestPrefetchBoxesTag, self).tearDown()
+
+    def test_renders_boxes_in_loop(self):
+        t = template.Template('{% prefetchboxes %}{% for s in sites %}{% box name for s %}{% endbox %}|{% endfor %}{% endprefetchboxes %}')
+        tools.assert_equals('example.com|example.org|', t.render(template.Context({'sites': [self.site, self.other_site]})))
+
+    def test_rendered_boxes_are_stored_in_cache(self):
+        t = template.Template('{% prefetchboxes %}{% box name for s %}{% endbox %}{% endprefetchboxes %}')
+        t.render(template.Context({'s': self.site}))
+        b = Box(self.site, 'name', None)
+        b.prepare(template.Context())
+        tools.assert_equals('example.com', self.cache.get(b.get_cache_key()))
+
+    def test_boxes_are_taken_from_cache(self):
+        b = Box(self.site, 'name', None)
+        b.prepare(template.Context())
+        self.cache.set(b.get_cache_key(), 'cached')
+        t = template.Template('{% prefetchboxes %}{% box name for s %}{% endbox %}:{% box name for o %}{% endbox %}{% endprefetchboxes %}')
+        tools.assert_equals('cached:example.org', t.render(template.Context({'s': self.site, 'o': self.other_site})))
+
+    def test_objects_are_fetched_in_one_query(self):
+        t = template.Template('{% prefetchboxes %}{% box name for sites.site with pk 1 %}{% endbox %}:{% box name for sites.site with pk pk %}{% endbox %}{% endprefetchboxes %}')
+        ContentType.objects.get_for_model(Site)
+        c = template.Context({'pk': self.other_site.pk})
+        self.assertNumQueries(1, lambda: t.render(c))
+        tools.assert_equals('example.com:example.org', t.render(c))
+
 class TestBoxTagParser(UnitTestCase):
     def test_parse_box_with_pk(self):
         node = _parse_box([], ['box', 'box_type', 'for', 'core.category', 'with', 'pk', '1'])
@@ -15,6 +15,7 @@ from test_ella import template_loader
 
 from ella.core.models import Category
 from ella.core.views import get_templates
+from ella.core.managers import get_cursor
 from ella.core.signals import object_rendering, object_rendered
 
 class ViewsTestCase(TestCase):
@@ -127,6 +128,44 @@ class TestListContentType(ViewsTestCase):
         response = self.client.get('/2008/', {'p': 200})
         tools.assert_equals(404, response.status_code)
 
+    def test_incorrect_cursor_raises_404(self):
+        template_loader.templates['404.html'] = ''
+        response = self.client.get('/nested-category/', {'before': 'xxx'})
+        tools.assert_equals(404, response.status_code)
+
+    def test_cursors_paginate_through_all_listings(self):
+        template_loader.templates['page/listing.html'] = ''
+        self.category.app_data = {'ella': {'paginate_by': 2}}
+        self.category.save()
+
+        response = self.client.get('/', {'p': 2})
+        tools.assert_equals(self.listings[2:4], response.context['listings'])
+        tools.assert_equals(get_cursor(self.listings[2]), response.context['prev_cursor'])
+
+        listings = []
+        cursor = get_cursor(self.listings[0])
+        listings.append(self.listings[0])
+        while cursor:
+            response = self.client.get('/', {'before': cursor})
+            listings.extend(response.context['listings'])
+            cursor = response.context['next_cursor']
+        tools.assert_equals(self.listings, listings)
+        tools.assert_equals(None, response.context['page'])
+
+        response = self.client.get('/', {'after': get_cursor(self.listings[-1])})
+        tools.assert_equals(self.listings[-3:-1], response.context['listings'])
+        tools.assert_equals(get_cursor(self.listings[-2]), response.context['next_cursor'])
+        tools.assert_equals(None, response.context['prev_cursor'])
+
+    def test_paginator_renders_cursor_links(self):
+        template_loader.templates['page/listing.html'] = '{% load pagination %}{% paginator %}'
+        template_loader.templates['inclusion_tags/paginator.html'] = '{{ prev_url }}|{{ next_url }}'
+        self.category.app_data = {'ella': {'paginate_by': 1}}
+        self.category.save()
+
+        response = self.client.get('/', {'before': get_cursor(self.listings[0])})
+        tools.assert_equals(200, response.status_code)
+        tools.assert_equals('?after=%s|?before=%s' % (get_cursor(self.listings[1]), get_cursor(self.listings[1])), response.content)
 
 class TestObjectDetailTemplateOverride(ViewsTestCase):
     def setUp(self):
@@ -0,0 +1,88 @@
+"""
+Compare throughput of Formatter with and without the JPEG draft fast path
+and of generating several formats separately and from one shared Pyramid.
+
+Run as::
+
+    python -m test_ella.test_photos.benchmark_formatter [REPEAT]
+"""
+import sys
+import time
+from cStringIO import StringIO
+
+from PIL import Image, ImageChops, ImageStat
+
+from ella.photos.formatter import Formatter, Pyramid
+
+class Format(object):
+    " Stand-in for ella.photos.models.Format, no database needed. "
+    flexible_height = False
+    flexible_max_height = None
+    stretch = False
+    nocrop = False
+
+    def __init__(self, max_width, max_height):
+        self.max_width, self.max_height = max_width, max_height
+
+def create_jpeg(size):
+    gradient = Image.linear_gradient('L')
+    i = Image.merge('RGB', (
+        gradient.resize(size),
+        gradient.rotate(90).resize(size),
+        Image.radial_gradient('L').resize(size),
+    ))
+    data = StringIO()
+    i.save(data, format='JPEG', quality=90)
+    return data.getvalue()
+
+def run(data, format, use_draft, repeat):
+    start = time.time()
+    for x in xrange(repeat):
+        f = Formatter(Image.open(StringIO(data)), format)
+        f.USE_DRAFT = use_draft
+        image, crop_box = f.format()
+    return image, (time.time() - start) / repeat
+
+def main(size=(5472, 3648), formats=((150, 150), (600, 400)), repeat=5):
+    data = create_jpeg(size)
+    print '%dx%d JPEG (%.1f MPix)' % (size[0], size[1], size[0] * size[1] / 1e6)
+    for w, h in formats:
+        format = Format(max_width=w, max_height=h)
+        slow, slow_time = run(data, format, False, repeat)
+        fast, fast_time = run(data, format, True, repeat)
+        diff = max(ImageStat.Stat(ImageChops.difference(slow, fast)).mean)
+        print '%4dx%-4d full decode %6.1f ms, draft %6.1f ms (%.1fx), mean difference %.2f' % (
+            w, h, slow_time * 1000, fast_time * 1000, slow_time / fast_time, diff)
+
+def run_all(data, formats, repeat):
+    " Generate all ``formats`` from one Pyramid, like Photo.generate_formats. "
+    start = time.time()
+    for x in xrange(repeat):
+        image = Image.open(StringIO(data))
+        width = height = 0
+        for format in formats:
+            f = Formatter(image, format)
+            w, h = f.get_source_size(*f.get_plan()[1:]) or image.size
+            width, height = max(width, w), max(height, h)
+        pyramid = Pyramid(image, (width, height))
+        images = [Formatter(image, format, pyramid=pyramid).format()[0] for format in formats]
+    return images, (time.time() - start) / repeat
+
+def main_multiple(size=(5472, 3648), formats=((1200, 800), (600, 400), (300, 200), (150, 150), (100, 100), (60, 60)), repeat=5):
+    data = create_jpeg(size)
+    formats = [Format(max_width=w, max_height=h) for w, h in formats]
+    separate_time = 0
+    separate = []
+    for format in formats:
+        image, t = run(data, format, True, repeat)
+        separate.append(image)
+        separate_time += t
+    shared, shared_time = run_all(data, formats, repeat)
+    diff = max(max(ImageStat.Stat(ImageChops.difference(a, b)).mean) for a, b in zip(separate, shared))
+    print '%d formats separately %6.1f ms, from one pyramid %6.1f ms (%.1fx), max mean difference %.2f' % (
+        len(formats), separate_time * 1000, shared_time * 1000, separate_time / shared_time, diff)
+
+if __name__ == '__main__':
+    repeat = len(sys.argv) > 1 and int(sys.argv[1]) or 5
+    main(repeat=repeat)
+    main_multiple(repeat=repeat)
@@ -1,12 +1,15 @@
 # -*- coding: utf-8 -*-
 import os
 
+from django.conf import settings
 from django.core.files.base import ContentFile
 from django.test import TestCase
 from django.contrib.sites.models import Site
 
 from nose import tools
 
+from ella.core.cache.utils import activate_identity_map, deactivate_identity_map
+from ella.photos import models
 from ella.photos.models import Format, FormatedPhoto, redis, REDIS_FORMATTED_PHOTO_KEY
 
 from test_ella.test_photos.fixtures import create_photo_formats, create_photo
@@ -66,9 +69,104 @@ class TestPhoto(TestCase):
 
         tools.assert_equals(0, len(self.photo.formatedphoto_set.all()))
 
+    def test_retrieving_multiple_formatted_photos(self):
+        formatted = FormatedPhoto.objects.get_photos_in_format([self.photo.pk, self.photo.pk + 1], self.basic_format)
+        tools.assert_equals(set([self.photo.pk, self.photo.pk + 1]), set(formatted.keys()))
+        tools.assert_equals(self.basic_format.get_blank_img(), formatted[self.photo.pk + 1])
+        tools.assert_equals(FormatedPhoto.objects.get_photo_in_format(self.photo, self.basic_format)['url'], formatted[self.photo.pk]['url'])
+
+    def test_retrieving_multiple_formatted_photos_without_redis(self):
+        expected = FormatedPhoto.objects.get_photo_in_format(self.photo, self.basic_format)
+        models.redis = None
+        try:
+            formatted = FormatedPhoto.objects.get_photos_in_format([self.photo], self.basic_format)
+        finally:
+            models.redis = redis
+        tools.assert_equals({self.photo.pk: expected}, formatted)
+
+    def test_prefetched_photos_are_used_by_get_photo_in_format(self):
+        activate_identity_map()
+        try:
+            formatted = FormatedPhoto.objects.get_photos_in_format([self.photo.pk], self.basic_format)
+            tools.assert_true(formatted[self.photo.pk] is FormatedPhoto.objects.get_photo_in_format(self.photo, self.basic_format))
+        finally:
+            deactivate_identity_map()
+
     def test_retrieving_ratio(self):
         tools.assert_equals(2, self.photo.ratio())
 
+    def test_generate_formats_creates_all_formats_of_site(self):
+        small = Format.objects.create(name='small', max_width=10, max_height=10,
+            flexible_height=False, stretch=False, nocrop=False, resample_quality=85)
+        small.sites.add(Site.objects.get_current())
+
+        created = self.photo.generate_formats()
+        tools.assert_equals(
+            {'basic': (20, 20), 'small': (10, 10)},
+            dict((fp.format.name, (fp.width, fp.height)) for fp in created)
+        )
+        tools.assert_true(all(fp.image.storage.exists(fp.image.name) for fp in created))
+        tools.assert_equals(2, self.photo.formatedphoto_set.count())
+        tools.assert_equals([], self.photo.generate_formats())
+
+    def test_generate_formats_replaces_outdated_formats(self):
+        FormatedPhoto.objects.get_photo_in_format(self.photo, self.basic_format)
+        self.basic_format.max_width = 10
+        self.basic_format.save()
+
+        old = FormatedPhoto.objects.get(photo=self.photo, format=self.basic_format)
+
+        created = self.photo.generate_formats([self.basic_format])
+        tools.assert_equals(1, len(created))
+        fp = FormatedPhoto.objects.get(photo=self.photo, format=self.basic_format)
+        tools.assert_equals((old.pk, 10), (fp.pk, fp.width))
+        tools.assert_true(fp.image.storage.exists(fp.image.name))
+        tools.assert_false(fp.image.storage.exists(old.image.name))
+        if redis:
+            tools.assert_equals(fp.image.url, redis.hget(REDIS_FORMATTED_PHOTO_KEY % (self.photo.id, self.basic_format.id), 'url'))
+
+    def test_generate_formats_keeps_custom_crop_box(self):
+        FormatedPhoto.objects.get_photo_in_format(self.photo, self.basic_format)
+        FormatedPhoto.objects.filter(photo=self.photo, format=self.basic_format).update(
+            crop_left=10, crop_top=0, crop_width=100, crop_height=100)
+        self.basic_format.resample_quality = 95
+        self.basic_format.save()
+
+        self.photo.generate_formats([self.basic_format])
+        fp = FormatedPhoto.objects.get(photo=self.photo, format=self.basic_format)
+        tools.assert_equals((10, 0, 100, 100), (fp.crop_left, fp.crop_top, fp.crop_width, fp.crop_height))
+        tools.assert_equals(self.basic_format.get_fingerprint(), fp.fingerprint)
+
+    def test_outdated_format_is_kept_when_generation_fails(self):
+        FormatedPhoto.objects.get_photo_in_format(self.photo, self.basic_format)
+        old = FormatedPhoto.objects.get(photo=self.photo, format=self.basic_format)
+        self.basic_format.max_width = 10
+        self.basic_format.save()
+
+        def generate(*args, **kwargs):
+            raise IOError('broken image')
+        orig_generate, FormatedPhoto.generate = FormatedPhoto.generate, generate
+        try:
+            tools.assert_equals([], self.photo.generate_formats([self.basic_format]))
+        finally:
+            FormatedPhoto.generate = orig_generate
+
+        fp = FormatedPhoto.objects.get(photo=self.photo, format=self.basic_format)
+        tools.assert_equals((old.image.name, 20), (fp.image.name, fp.width))
+        tools.assert_true(fp.image.storage.exists(fp.image.name))
+
+    def test_formats_are_generated_when_image_changes(self):
+        f = open(self.image_file_name)
+        file = ContentFile(f.read())
+        f.close()
+
+        settings.PHOTOS_GENERATE_ON_SAVE = ['basic']
+        try:
+            self.photo.image.save("newzaaah.jpg", file)
+        finally:
+            del settings.PHOTOS_GENERATE_ON_SAVE
+        tools.assert_equals([self.basic_format], [fp.format for fp in self.photo.formatedphoto_set.all()])
+
     def tearDown(self):
         os.remove(self.image_file_name)
         if self.photo.pk:
@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+import os
+
+from django.conf import settings
+from django.test import TestCase
+
+from nose import tools
+
+from ella.photos import queue
+from ella.photos.models import FormatedPhoto, redis, REDIS_FORMATTED_PHOTO_KEY
+
+from test_ella.test_photos.fixtures import create_photo_formats, create_photo
+
+class QueueTests(object):
+    def setUp(self):
+        super(QueueTests, self).setUp()
+        create_photo_formats(self)
+        create_photo(self)
+        self.queue = queue._queue = self.get_queue()
+
+    def tearDown(self):
+        queue._queue = None
+        os.remove(self.image_file_name)
+        if self.photo.pk:
+            self.photo.delete()
+        super(QueueTests, self).tearDown()
+        if redis:
+            redis.flushdb()
+
+    def test_missing_photo_is_queued_and_placeholder_returned(self):
+        formatted = FormatedPhoto.objects.get_photo_in_format(self.photo, self.basic_format)
+        tools.assert_equals(self.basic_format.get_blank_img(), formatted)
+        tools.assert_equals(0, FormatedPhoto.objects.count())
+        tools.assert_equals(1, len(self.queue))
+
+    def test_job_is_queued_only_once(self):
+        tools.assert_true(self.queue.enqueue(self.photo.pk, self.basic_format.pk))
+        tools.assert_false(self.queue.enqueue(self.photo.pk, self.basic_format.pk))
+        tools.assert_equals(1, len(self.queue))
+
+    def test_processing_generates_photo(self):
+        FormatedPhoto.objects.get_photo_in_format(self.photo, self.basic_format)
+        tools.assert_equals((self.photo.pk, self.basic_format.pk), self.queue.process(timeout=0))
+        tools.assert_equals(None, self.queue.process(timeout=0))
+
+        tools.assert_equals(1, FormatedPhoto.objects.count())
+        formatted = FormatedPhoto.objects.get_photo_in_format(self.photo, self.basic_format)
+        tools.assert_equals((20, 20), (int(formatted['width']), int(formatted['height'])))
+        if redis:
+            tools.assert_equals('20', redis.hget(REDIS_FORMATTED_PHOTO_KEY % (self.photo.id, self.basic_format.id), 'width'))
+
+    def test_job_can_be_queued_again_after_processing(self):
+        self.queue.enqueue(self.photo.pk, self.basic_format.pk)
+        self.queue.process(timeout=0)
+        tools.assert_true(self.queue.enqueue(self.photo.pk, self.basic_format.pk))
+
+    def test_job_for_deleted_photo_is_skipped(self):
+        self.queue.enqueue(self.photo.pk + 1, self.basic_format.pk)
+        tools.assert_equals((self.photo.pk + 1, self.basic_format.pk), self.queue.process(timeout=0))
+        tools.assert_equals(0, FormatedPhoto.objects.count())
+
+    def test_original_can_be_used_as_placeholder(self):
+        settings.PHOTOS_GENERATE_PLACEHOLDER = 'original'
+        try:
+            formatted = FormatedPhoto.objects.get_photo_in_format(self.photo, self.basic_format)
+        finally:
+            del settings.PHOTOS_GENERATE_PLACEHOLDER
+        tools.assert_equals(self.photo.image.url, formatted['url'])
+        tools.assert_equals((20, 10), (formatted['width'], formatted['height']))
+
+class TestLocalQueue(QueueTests, TestCase):
+    def get_queue(self):
+        return queue.LocalQueue(workers=0)
+
+if redis:
+    class TestRedisQueue(QueueTests, TestCase):
+        def get_queue(self):
+            return queue.RedisQueue(client=redis)
@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+import os
+from datetime import datetime, timedelta
+
+from django.test import TestCase
+from django.contrib.sites.models import Site
+
+from nose import tools
+
+from ella.photos.models import Photo, FormatedPhoto, redis, REDIS_FORMATTED_PHOTO_KEY
+from ella.photos.regenerate import regenerate_formats
+
+from test_ella.test_photos.fixtures import create_photo_formats, create_photo
+
+class TestRegenerateFormats(TestCase):
+    def setUp(self):
+        super(TestRegenerateFormats, self).setUp()
+        create_photo_formats(self)
+        create_photo(self)
+
+    def tearDown(self):
+        os.remove(self.image_file_name)
+        for fp in FormatedPhoto.objects.all():
+            fp.delete()
+        self.photo.delete()
+        super(TestRegenerateFormats, self).tearDown()
+        if redis:
+            redis.flushdb()
+
+    def test_missing_formated_photo_is_generated(self):
+        stats = regenerate_formats(workers=0)
+        tools.assert_equals(1, stats['generated'])
+        tools.assert_equals(0, stats['failed'])
+
+        fp = FormatedPhoto.objects.get(photo=self.photo, format=self.basic_format)
+        tools.assert_equals(self.basic_format.get_fingerprint(), fp.fingerprint)
+        tools.assert_equals((20, 20), (fp.width, fp.height))
+        tools.assert_true(fp.image.storage.exists(fp.image.name))
+        if redis:
+            tools.assert_equals(fp.image.url, redis.hget(REDIS_FORMATTED_PHOTO_KEY % (self.photo.id, self.basic_format.id), 'url'))
+
+    def test_photos_are_generated_in_worker_processes(self):
+        photo = self.photo
+        photos = [create_photo(self, slug='photo-%d' % i) for i in range(3)]
+        self.photo = photo
+        try:
+            stats = regenerate_formats(workers=2, chunk_size=2, max_tasks_per_child=1)
+            tools.assert_equals((4, 0), (stats['generated'], stats['failed']))
+            # the connection of this process still works
+            tools.assert_equals(4, FormatedPhoto.objects.filter(fingerprint=self.basic_format.get_fingerprint()).count())
+        finally:
+            for p in photos:
+                p.delete()
+
+    def test_up_to_date_photos_are_skipped(self):
+        regenerate_formats(workers=0)
+        tools.assert_equals(0, regenerate_formats(workers=0)['generated'])
+
+    def test_changed_format_is_regenerated_under_new_name(self):
+        regenerate_formats(workers=0)
+        old = FormatedPhoto.objects.get(photo=self.photo, format=self.basic_format)
+
+        self.basic_format.max_width = 10
+        self.basic_format.save()
+        tools.assert_equals(1, regenerate_formats(workers=0)['generated'])
+
+        fp = FormatedPhoto.objects.get(photo=self.photo, format=self.basic_format)
+        tools.assert_equals(old.pk, fp.pk)
+        tools.assert_equals(10, fp.width)
+        tools.assert_not_equals(old.image.name, fp.image.name)
+        tools.assert_false(fp.image.storage.exists(old.image.name))
+        tools.assert_equals(10, int(FormatedPhoto.objects.get_photo_in_format(self.photo, self.basic_format)['width']))
+        if redis:
+            tools.assert_equals('10', redis.hget(REDIS_FORMATTED_PHOTO_KEY % (self.photo.id, self.basic_format.id), 'width'))
+
+    def test_custom_crop_box_is_kept(self):
+        regenerate_formats(workers=0)
+        FormatedPhoto.objects.filter(photo=self.photo, format=self.basic_format).update(
+            crop_left=10, crop_top=0, crop_width=100, crop_height=100)
+        self.basic_format.resample_quality = 95
+        self.basic_format.save()
+        tools.assert_equals(1, regenerate_formats(workers=0)['generated'])
+
+        fp = FormatedPhoto.objects.get(photo=self.photo, format=self.basic_format)
+        tools.assert_equals((10, 0, 100, 100), (fp.crop_left, fp.crop_top, fp.crop_width, fp.crop_height))
+
+    def test_formats_of_other_sites_are_skipped(self):
+        other = Site.objects.create(domain='other.example.com', name='other')
+        tools.assert_equals(0, regenerate_formats(sites=[other.pk], workers=0)['generated'])
+        tools.assert_equals(0, FormatedPhoto.objects.count())
+
+    def test_older_photos_are_skipped(self):
+        Photo.objects.filter(pk=self.photo.pk).update(created=datetime.now() - timedelta(days=2))
+        tools.assert_equals(0, regenerate_formats(since=datetime.now() - timedelta(days=1), workers=0)['generated'])
+        tools.assert_equals(1, regenerate_formats(since=datetime.now() - timedelta(days=3), workers=0)['generated'])
@@ -1,12 +1,13 @@
 # -*- coding: utf-8 -*-
 from unittest import TestCase
+from cStringIO import StringIO
 
 from nose import tools
 
-from PIL import Image
+from PIL import Image, ImageChops, ImageStat
 
 from ella.photos.models import Format
-from ella.photos.formatter import Formatter
+from ella.photos.formatter import Formatter, Pyramid
 
 class TestPhotoResize(TestCase):
 
@@ -142,3 +143,97 @@ class TestPhotoResize(TestCase):
         tools.assert_equals((100, 100), i.size)
         tools.assert_equals((0,0,0), i.getpixel((0,0)))
 
+
+class TestJPEGDraftResize(TestCase):
+
+    def setUp(self):
+        super(TestJPEGDraftResize, self).setUp()
+        self.format = Format(max_height=150, max_width=150)
+
+        # something not entirely uniform to compare
+        gradient = Image.linear_gradient('L')
+        i = Image.merge('RGB', (
+            gradient.resize((1600, 1200)),
+            gradient.rotate(90).resize((1600, 1200)),
+            Image.radial_gradient('L').resize((1600, 1200)),
+        ))
+        i.paste((255, 255, 255), (700, 500, 900, 700))
+        self.data = StringIO()
+        i.save(self.data, format='JPEG', quality=90)
+
+    def get_image(self):
+        self.data.seek(0)
+        return Image.open(self.data)
+
+    def format_image(self, **kwargs):
+        return Formatter(self.get_image(), self.format, **kwargs).format()
+
+    def format_image_without_draft(self, **kwargs):
+        f = Formatter(self.get_image(), self.format, **kwargs)
+        f.USE_DRAFT = False
+        return f.format()
+
+    def assert_similar(self, expected, actual):
+        tools.assert_equals(expected.size, actual.size)
+        diff = ImageStat.Stat(ImageChops.difference(expected, actual)).mean
+        tools.assert_true(max(diff) < 4, diff)
+
+    def test_image_is_decoded_at_reduced_scale(self):
+        f = Formatter(self.get_image(), self.format)
+        tools.assert_equals((0.25, 0.25), f.draft((1200, 1200), (150, 150)))
+        tools.assert_equals((400, 300), f.image.size)
+
+    def test_supplied_image_is_not_affected_by_draft(self):
+        i = self.get_image()
+        Formatter(i, self.format).format()
+        i.load()
+        tools.assert_equals((1600, 1200), i.size)
+
+    def test_loaded_image_is_not_drafted(self):
+        i = self.get_image()
+        i.load()
+        f = Formatter(i, self.format)
+        tools.assert_equals((1, 1), f.draft((1200, 1200), (150, 150)))
+
+    def test_small_reduction_doesnt_use_draft(self):
+        self.format.max_width = self.format.max_height = 500
+        f = Formatter(self.get_image(), self.format)
+        tools.assert_equals((1, 1), f.draft((1200, 1200), (500, 500)))
+
+    def test_result_matches_full_decode(self):
+        expected, expected_box = self.format_image_without_draft()
+        i, crop_box = self.format_image()
+        tools.assert_equals((200, 0, 1400, 1200), crop_box)
+        tools.assert_equals(expected_box, crop_box)
+        self.assert_similar(expected, i)
+
+    def test_crop_box_is_mapped_to_reduced_image(self):
+        expected, _ = self.format_image_without_draft(crop_box=(100, 100, 700, 700))
+        i, crop_box = self.format_image(crop_box=(100, 100, 700, 700))
+        tools.assert_equals((100, 100, 700, 700), crop_box)
+        self.assert_similar(expected, i)
+
+    def test_important_box_is_mapped_to_reduced_image(self):
+        expected, _ = self.format_image_without_draft(important_box=(1000, 0, 1600, 600))
+        i, crop_box = self.format_image(important_box=(1000, 0, 1600, 600))
+        tools.assert_equals((400, 0, 1600, 1200), crop_box)
+        self.assert_similar(expected, i)
+
+    def test_pyramid_is_decoded_at_reduced_scale(self):
+        p = Pyramid(self.get_image(), (400, 300))
+        tools.assert_equals((400, 300), p.levels[0].size)
+
+    def test_pyramid_returns_smallest_big_enough_reduction(self):
+        p = Pyramid(self.get_image())
+        tools.assert_equals((1600, 1200), p.get((1000, 1000)).size)
+        tools.assert_equals((400, 300), p.get((300, 300)).size)
+        tools.assert_equals(3, len(p.levels))
+        tools.assert_true(p.get((800, 600)) is p.levels[1])
+
+    def test_result_from_pyramid_matches_full_decode(self):
+        p = Pyramid(self.get_image(), (800, 600))
+        for crop_box in (None, (100, 100, 700, 700)):
+            expected, expected_box = self.format_image_without_draft(crop_box=crop_box)
+            i, box = self.format_image(crop_box=crop_box, pyramid=p)
+            tools.assert_equals(expected_box, box)
+            self.assert_similar(expected, i)
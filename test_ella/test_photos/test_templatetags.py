@@ -1,12 +1,16 @@
-from django.template import Node
+import os
+
+from django.template import Node, Template, Context
 from django.test import TestCase
 from django.conf import settings
 
 from nose import tools, SkipTest
 
+from ella.core.cache.utils import activate_identity_map, deactivate_identity_map, get_identity_map
+from ella.photos.models import IDENTITY_MAP_KEY
 from ella.photos.templatetags.photos import _parse_img, ImgTag
 
-from test_ella.test_photos.fixtures import create_photo_formats
+from test_ella.test_photos.fixtures import create_photo_formats, create_photo
 
 class TestImgParsing(TestCase):
     def setUp(self):
@@ -23,3 +27,26 @@ class TestImgParsing(TestCase):
             raise SkipTest()
         img_node = _parse_img('img unknownformat for VAR as VAR_NAME'.split())
         tools.assert_equals(Node, img_node.__class__)
+
+class TestImgPrefetch(TestCase):
+    def setUp(self):
+        super(TestImgPrefetch, self).setUp()
+        create_photo_formats(self)
+        create_photo(self)
+        activate_identity_map()
+
+    def tearDown(self):
+        deactivate_identity_map()
+        os.remove(self.image_file_name)
+        self.photo.delete()
+        super(TestImgPrefetch, self).tearDown()
+
+    def test_photos_are_prefetched(self):
+        t = Template('{% load photos %}{% img_prefetch basic for photos %}')
+        tools.assert_equals('', t.render(Context({'photos': [self.photo]})))
+        tools.assert_true(IDENTITY_MAP_KEY % (self.photo.pk, self.basic_format.pk) in get_identity_map())
+
+    def test_img_uses_prefetched_photos(self):
+        t = Template('{% load photos %}{% img_prefetch basic for photos %}{% for p in photos %}{% img basic for p as thumb %}{{ thumb.url }}{% endfor %}')
+        out = t.render(Context({'photos': [self.photo]}))
+        tools.assert_equals(get_identity_map()[IDENTITY_MAP_KEY % (self.photo.pk, self.basic_format.pk)]['url'], out)